@@ -0,0 +1,346 @@
+import logging
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bson.objectid import ObjectId
+from pymongo.database import Database
+from werkzeug.datastructures import FileStorage
+from attachments import store_upload
+
+# Competition data for offline analytics, written as Parquet. Each dataset is read with one cursor
+# and its rows are grouped into Arrow record batches per partition, so memory holds at most a batch
+# per partition no matter how large the collections are. Files are laid out Hive-style,
+# <dataset>/competition_id=<id>/year=<yyyy>/part-0.parquet, which pyarrow, DuckDB and Spark read
+# as a partitioned dataset. Challenges are shared by every competition and have no competition_id,
+# so they can't be split by competition and are partitioned by year only. The partition values are
+# only in the paths, not in the files. Exports leave out names, contact details, passwords, flags
+# and solutions.
+
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+# The name Hive, Spark and pyarrow use for a null partition value
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+CURSOR_BATCH_SIZE = 1000
+EXPORT_SPOOL_BYTES = 32 * 1024 * 1024
+
+# Readers should pass these as the partitioning schema, a dataset whose partitions are all null
+# has nothing to infer the partition types from
+PARTITION_SCHEMA = pa.schema([("competition_id", pa.string()), ("year", pa.int32())])
+YEAR_PARTITION_SCHEMA = pa.schema([("year", pa.int32())])
+
+TIMESTAMP = pa.timestamp("ms")
+DIVISIONS = pa.list_(pa.int32())
+
+TEAMS_SCHEMA = pa.schema([
+    ("team_id", pa.string()),
+    ("teacher_id", pa.string()),
+    ("name", pa.string()),
+    ("division", DIVISIONS),
+    ("is_virtual", pa.bool_()),
+    ("student_count", pa.int32()),
+    ("created_at", TIMESTAMP),
+])
+STUDENTS_SCHEMA = pa.schema([
+    ("student_id", pa.string()),
+    ("team_id", pa.string()),
+    ("student_account_id", pa.string()),
+    ("shirt_size", pa.string()),
+    ("has_liability_form", pa.bool_()),
+    ("is_verified", pa.bool_()),
+    ("created_at", TIMESTAMP),
+])
+TEACHERS_SCHEMA = pa.schema([
+    ("teacher_id", pa.string()),
+    ("account_id", pa.string()),
+    ("school_name", pa.string()),
+    ("shirt_size", pa.string()),
+    ("team_count", pa.int32()),
+    ("created_at", TIMESTAMP),
+])
+CHALLENGES_SCHEMA = pa.schema([
+    ("challenge_id", pa.string()),
+    ("challenge_name", pa.string()),
+    ("challenge_category", pa.string()),
+    ("creator_name", pa.string()),
+    ("points", pa.int32()),
+    ("division", DIVISIONS),
+    ("verified", pa.bool_()),
+    ("hint_count", pa.int32()),
+    ("hint_point_cost", pa.int32()),
+    ("has_file", pa.bool_()),
+    ("created_at", TIMESTAMP),
+])
+
+# (competition_id, year, row), the year is None when the creation time is unknown
+PartitionedRow = Tuple[Optional[str], Optional[int], Dict]
+# (dataset, competition_id, year, path, file, rows)
+ExportedFile = Tuple[str, Optional[str], Optional[int], str, BinaryIO, int]
+
+
+def _id_or_none(value) -> Optional[str]:
+    return str(value) if value is not None else None
+
+
+def _created_at(document: Dict) -> Optional[datetime]:
+    # Older documents have no created_at, their id still records when they were inserted unless
+    # it was set to something other than an ObjectId
+    created_at = document.get("created_at")
+    if created_at is None and isinstance(document["_id"], ObjectId):
+        created_at = document["_id"].generation_time.replace(tzinfo=None)
+    return created_at
+
+
+def _year(created_at: Optional[datetime]) -> Optional[int]:
+    return created_at.year if created_at is not None else None
+
+
+def partition_path(dataset: str, partitioning: pa.Schema, competition_id: Optional[str], year: Optional[int]) -> str:
+    directories = []
+    if "competition_id" in partitioning.names:
+        directories.append(f"competition_id={quote(competition_id, safe='') if competition_id else NULL_PARTITION}")
+    directories.append(f"year={year if year is not None else NULL_PARTITION}")
+    return "/".join([dataset, *directories, "part-0.parquet"])
+
+
+class _PartitionWriter:
+    def __init__(self, schema: pa.Schema, file: BinaryIO, compression: str):
+        self.schema = schema
+        self.file = file
+        self.writer = pq.ParquetWriter(file, schema, compression=compression)
+        self.pending: List[Dict] = []
+        self.rows = 0
+
+    def add(self, row: Dict, batch_rows: int) -> None:
+        self.pending.append(row)
+        if len(self.pending) >= batch_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        # One row group per batch
+        self.writer.write_batch(pa.RecordBatch.from_pylist(self.pending, schema=self.schema))
+        self.rows += len(self.pending)
+        self.pending = []
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+
+def write_partitioned(dataset: str, schema: pa.Schema, partitioning: pa.Schema, rows: Iterable[PartitionedRow],
+                      open_file: Callable[[str], BinaryIO], compression: str, batch_rows: int) -> List[ExportedFile]:
+    writers: Dict[Tuple[Optional[str], Optional[int]], _PartitionWriter] = {}
+    try:
+        for competition_id, year, row in rows:
+            writer = writers.get((competition_id, year))
+            if writer is None:
+                writer = writers[(competition_id, year)] = _PartitionWriter(
+                    schema, open_file(partition_path(dataset, partitioning, competition_id, year)), compression
+                )
+            writer.add(row, batch_rows)
+        for writer in writers.values():
+            writer.close()
+    except Exception:
+        for writer in writers.values():
+            writer.file.close()
+        raise
+    return [
+        (dataset, competition_id, year, partition_path(dataset, partitioning, competition_id, year), writer.file, writer.rows)
+        for (competition_id, year), writer in sorted(writers.items(), key=lambda item: (item[0][0] or "", item[0][1] or 0))
+    ]
+
+
+class _TeamIndex:
+    # Filled while the teams are exported, students and teachers are partitioned by their team's competition
+    def __init__(self):
+        self.competitions: Dict[ObjectId, Optional[str]] = {}
+        self.teacher_teams: Dict[str, Dict[Optional[str], int]] = defaultdict(lambda: defaultdict(int))
+
+
+def iter_team_rows(db: Database, config, index: _TeamIndex) -> Iterator[PartitionedRow]:
+    student_counts = {
+        count["_id"]: count["students"]
+        for count in db[config['DB_STUDENT_INFO_COLLECTION']].aggregate([
+            {"$group": {"_id": "$team_id", "students": {"$sum": 1}}}
+        ])
+    }
+    for team in db[config['DB_TEAMS_COLLECTION']].find().batch_size(CURSOR_BATCH_SIZE):
+        competition_id = team.get("competition_id")
+        index.competitions[team["_id"]] = competition_id
+        if team.get("teacher_id"):
+            index.teacher_teams[str(team["teacher_id"])][competition_id] += 1
+        created_at = _created_at(team)
+        yield competition_id, _year(created_at), {
+            "team_id": str(team["_id"]),
+            "teacher_id": _id_or_none(team.get("teacher_id")),
+            "name": team["name"],
+            "division": team["division"],
+            "is_virtual": team["is_virtual"],
+            "student_count": student_counts.get(team["_id"], 0),
+            "created_at": created_at,
+        }
+
+
+def iter_student_rows(db: Database, config, index: _TeamIndex) -> Iterator[PartitionedRow]:
+    projection = {"team_id": 1, "competition_id": 1, "student_account_id": 1, "shirt_size": 1, "liability_form_id": 1, "is_verified": 1, "created_at": 1}
+    for student in db[config['DB_STUDENT_INFO_COLLECTION']].find({}, projection).batch_size(CURSOR_BATCH_SIZE):
+        created_at = _created_at(student)
+        # Students registered before competitions were tracked go by their team
+        competition_id = student.get("competition_id") or index.competitions.get(student.get("team_id"))
+        yield competition_id, _year(created_at), {
+            "student_id": str(student["_id"]),
+            "team_id": _id_or_none(student.get("team_id")),
+            "student_account_id": student.get("student_account_id"),
+            "shirt_size": student.get("shirt_size"),
+            "has_liability_form": student.get("liability_form_id") is not None,
+            "is_verified": student.get("is_verified"),
+            "created_at": created_at,
+        }
+
+
+def iter_teacher_rows(db: Database, config, index: _TeamIndex) -> Iterator[PartitionedRow]:
+    # A teacher appears once in every competition they have teams in, teachers without teams
+    # go in the null partition
+    projection = {"account_id": 1, "school_name": 1, "shirt_size": 1, "created_at": 1}
+    for teacher in db[config['DB_TEACHER_INFO_COLLECTION']].find({}, projection).batch_size(CURSOR_BATCH_SIZE):
+        # Teams store either the teacher's account id or their teacher_info id
+        team_counts: Dict[Optional[str], int] = defaultdict(int)
+        for teacher_id in {str(teacher["_id"]), _id_or_none(teacher.get("account_id"))}:
+            for competition_id, count in index.teacher_teams.get(teacher_id, {}).items():
+                team_counts[competition_id] += count
+        created_at = _created_at(teacher)
+        for competition_id, team_count in (team_counts.items() if team_counts else [(None, 0)]):
+            yield competition_id, _year(created_at), {
+                "teacher_id": str(teacher["_id"]),
+                "account_id": _id_or_none(teacher.get("account_id")),
+                "school_name": teacher.get("school_name"),
+                "shirt_size": teacher.get("shirt_size"),
+                "team_count": team_count,
+                "created_at": created_at,
+            }
+
+
+def iter_challenge_rows(db: Database, config, index: _TeamIndex) -> Iterator[PartitionedRow]:
+    projection = {"flag": 0, "solution_explanation": 0, "challenge_description": 0}
+    for challenge in db[config['DB_CHALLENGES_COLLECTION']].find({}, projection).batch_size(CURSOR_BATCH_SIZE):
+        hints = challenge.get("hints") or []
+        created_at = _created_at(challenge)
+        yield None, _year(created_at), {
+            "challenge_id": str(challenge["_id"]),
+            "challenge_name": challenge.get("challenge_name"),
+            "challenge_category": challenge.get("challenge_category"),
+            "creator_name": challenge.get("creator_name"),
+            "points": challenge.get("points"),
+            "division": challenge.get("division"),
+            "verified": challenge.get("verified"),
+            "hint_count": len(hints),
+            "hint_point_cost": sum(hint["point_cost"] for hint in hints),
+            "has_file": challenge.get("challenge_file_attachment_id") is not None,
+            "created_at": created_at,
+        }
+
+
+# (schema, partitioning, rows). Teams go first, the others are partitioned with what was read from them.
+EXPORT_DATASETS: Dict[str, Tuple[pa.Schema, pa.Schema, Callable[[Database, object, _TeamIndex], Iterator[PartitionedRow]]]] = {
+    "teams": (TEAMS_SCHEMA, PARTITION_SCHEMA, iter_team_rows),
+    "students": (STUDENTS_SCHEMA, PARTITION_SCHEMA, iter_student_rows),
+    "teachers": (TEACHERS_SCHEMA, PARTITION_SCHEMA, iter_teacher_rows),
+    "challenges": (CHALLENGES_SCHEMA, YEAR_PARTITION_SCHEMA, iter_challenge_rows),
+}
+
+
+def _export_datasets(db: Database, config, open_file: Callable[[str], BinaryIO],
+                     handle_files: Callable[[List[ExportedFile]], None]) -> None:
+    index = _TeamIndex()
+    for dataset, (schema, partitioning, iter_rows) in EXPORT_DATASETS.items():
+        files = write_partitioned(
+            dataset, schema, partitioning, iter_rows(db, config, index), open_file,
+            config['ANALYTICS_EXPORT_COMPRESSION'], config['ANALYTICS_EXPORT_BATCH_ROWS']
+        )
+        handle_files(files)
+
+
+def _count_file(report: Dict, dataset: str, rows: int) -> None:
+    counts = report["datasets"].setdefault(dataset, {"files": 0, "rows": 0})
+    counts["files"] += 1
+    counts["rows"] += rows
+
+
+def export_to_directory(db: Database, config, output_dir: str) -> Dict:
+    # Written to a staging directory first, then each dataset replaces the previous export's
+    os.makedirs(output_dir, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=".export-", dir=output_dir)
+    report = {"output_dir": output_dir, "datasets": {}}
+
+    def open_file(path: str) -> BinaryIO:
+        full_path = os.path.join(staging_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        return open(full_path, "wb")
+
+    def handle_files(files: List[ExportedFile]) -> None:
+        for dataset, _, _, _, file, rows in files:
+            file.close()
+            _count_file(report, dataset, rows)
+
+    try:
+        _export_datasets(db, config, open_file, handle_files)
+        for dataset in EXPORT_DATASETS:
+            target = os.path.join(output_dir, dataset)
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            if os.path.exists(os.path.join(staging_dir, dataset)):
+                os.replace(os.path.join(staging_dir, dataset), target)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    logging.info("Analytics export finished: %s", report)
+    return report
+
+
+def export_to_storage(db: Database, config) -> Dict:
+    # Stored as attachments and listed in an analytics_exports document, which keeps them from
+    # being swept until it expires
+    exported_files: List[Dict] = []
+    started_at = datetime.now()
+
+    def open_file(path: str) -> BinaryIO:
+        return tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+
+    def handle_files(files: List[ExportedFile]) -> None:
+        try:
+            for dataset, competition_id, year, path, file, rows in files:
+                size = file.tell()
+                file.seek(0)
+                exported_files.append({
+                    "dataset": dataset,
+                    "competition_id": competition_id,
+                    "year": year,
+                    "path": path,
+                    "rows": rows,
+                    "bytes": size,
+                    "file_id": store_upload(db, FileStorage(stream=file, filename=path, content_type=PARQUET_CONTENT_TYPE), None),
+                })
+        finally:
+            for _, _, _, _, file, _ in files:
+                file.close()
+
+    _export_datasets(db, config, open_file, handle_files)
+    now = datetime.now()
+    export_id = db[config['DB_ANALYTICS_EXPORTS_COLLECTION']].insert_one({
+        "files": exported_files,
+        "file_ids": [file["file_id"] for file in exported_files],
+        "started_at": started_at,
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=config['ANALYTICS_EXPORT_RETENTION_SECONDS']),
+    }).inserted_id
+
+    report = {"export_id": str(export_id), "datasets": {}}
+    for file in exported_files:
+        _count_file(report, file["dataset"], file["rows"])
+    logging.info("Analytics export finished: %s", report)
+    return report
@@ -4,11 +4,26 @@ from config import config
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 import logging
+import threading
 from typing import Optional, Tuple
 from dotenv import load_dotenv
 import http_status_codes as status
 from flask_cors import CORS
 from middleware import Middleware
+from schemas import install_schema_validators
+from indexes import ensure_indexes
+from file_gc import sweep_files, start_file_gc_scheduler
+from email_outbox import deliver_pending_emails, requeue_dead_emails, start_email_worker
+from team_roster import check_team_rosters, rebuild_team_rosters
+from competition_scope import assign_legacy_teams, find_active_competition_id
+from flag_verifier import start_flag_verifier_refresh
+from challenge_index import start_challenge_index_refresh
+from scoreboard import publish_score_rebuilt, rebuild_scores, start_scoreboard_sync
+from events import ensure_events_collection, start_event_publisher
+from datetime import timedelta
+from bson.objectid import ObjectId
+import click
+import json
 
 load_dotenv()
 
@@ -52,6 +67,25 @@ def create_app(config_name="dev"):
     except Exception as e:
         logging.error(f"Failed to initialize MongoDB client: {e}")
 
+    # Install collection-level validators so read paths can trust stored documents
+    try:
+        if uri is not None:
+            install_schema_validators(client[app.config['DB_NAME']], app.config)
+    except Exception as e:
+        logging.error(f"Failed to install schema validators: {e}")
+
+    try:
+        if uri is not None:
+            ensure_indexes(client[app.config['DB_NAME']], app.config)
+    except Exception as e:
+        logging.error(f"Failed to create indexes: {e}")
+
+    try:
+        if uri is not None:
+            ensure_events_collection(client[app.config['DB_NAME']], app.config)
+    except Exception as e:
+        logging.error(f"Failed to create the events collection: {e}")
+
 
     @app.route("/")
     def get_main_route() -> Tuple[Response, int]:
@@ -84,6 +118,10 @@ def create_app(config_name="dev"):
     from routes.files import files_blueprint
     from routes.reports import reports_blueprint
     from routes.admin import admin_blueprint
+    from routes.uploads import uploads_blueprint
+    from routes.archive import archive_blueprint
+    from routes.scoreboard import scoreboard_blueprint
+    from routes.events import events_blueprint
 
     app.register_blueprint(challenges_blueprint)
     app.register_blueprint(refresh_blueprint)
@@ -95,6 +133,154 @@ def create_app(config_name="dev"):
     app.register_blueprint(files_blueprint)
     app.register_blueprint(reports_blueprint)
     app.register_blueprint(admin_blueprint)
+    app.register_blueprint(uploads_blueprint)
+    app.register_blueprint(archive_blueprint)
+    app.register_blueprint(scoreboard_blueprint)
+    app.register_blueprint(events_blueprint)
+
+    @app.cli.command("sweep-files")
+    @click.option("--dry-run", is_flag=True, help="Report orphans and dangling references without deleting anything.")
+    @click.option("--grace-period", default=None, type=int, help="Only delete files older than this many seconds.")
+    def sweep_files_command(dry_run: bool, grace_period: Optional[int]) -> None:
+        if grace_period is None:
+            grace_period = app.config['FILE_GC_GRACE_PERIOD_SECONDS']
+        report = sweep_files(client[app.config['DB_NAME']], app.config, timedelta(seconds=grace_period), app.config['FILE_GC_BATCH_SIZE'], dry_run)
+        click.echo(json.dumps(report, indent=2))
+
+    from storage import STORAGE_BACKENDS, create_storage, migrate_files
+
+    @app.cli.command("migrate-storage")
+    @click.option("--source", required=True, type=click.Choice(STORAGE_BACKENDS), help="Backend to copy files from.")
+    @click.option("--target", required=True, type=click.Choice(STORAGE_BACKENDS), help="Backend to copy files to.")
+    @click.option("--delete-source", is_flag=True, help="Delete each file from the source once it is in the target.")
+    def migrate_storage_command(source: str, target: str, delete_source: bool) -> None:
+        if source == target:
+            raise click.BadParameter("The source and target backends must differ.")
+        db = client[app.config['DB_NAME']]
+        report = migrate_files(create_storage(source, db, app.config), create_storage(target, db, app.config), delete_source)
+        click.echo(json.dumps(report, indent=2))
+
+    @app.cli.command("deliver-emails")
+    def deliver_emails_command() -> None:
+        from emails import email_transport
+        report = deliver_pending_emails(client[app.config['DB_NAME']], app.config, email_transport)
+        click.echo(json.dumps(report, indent=2))
+
+    @app.cli.command("requeue-emails")
+    def requeue_emails_command() -> None:
+        requeued = requeue_dead_emails(client[app.config['DB_NAME']], app.config)
+        click.echo(f"Requeued {requeued} dead-lettered emails.")
+
+    @app.cli.command("rebuild-team-roster")
+    def rebuild_team_roster_command() -> None:
+        report = rebuild_team_rosters(client[app.config['DB_NAME']], app.config)
+        click.echo(json.dumps(report, indent=2))
+
+    @app.cli.command("check-team-roster")
+    @click.option("--repair", is_flag=True, help="Rewrite missing or stale roster documents and remove ones for deleted teams.")
+    def check_team_roster_command(repair: bool) -> None:
+        report = check_team_rosters(client[app.config['DB_NAME']], app.config, repair)
+        click.echo(json.dumps(report, indent=2))
+        if not repair and (report["missing"] or report["stale"] or report["orphaned"]):
+            raise SystemExit(1)
+
+    @app.cli.command("assign-competition")
+    @click.option("--competition-id", required=True, help="Competition to tag teams registered before competitions were tracked with.")
+    def assign_competition_command(competition_id: str) -> None:
+        db = client[app.config['DB_NAME']]
+        if not ObjectId.is_valid(competition_id) or db[app.config['DB_COMPETITION_COLLECTION']].find_one({"_id": ObjectId(competition_id)}) is None:
+            raise click.BadParameter("No competition has this id.")
+        report = assign_legacy_teams(db, app.config, competition_id)
+        click.echo(json.dumps(report, indent=2))
+
+    @app.cli.command("rebuild-scoreboard")
+    @click.option("--competition-id", default=None, help="Competition whose scores are recomputed, the active one by default.")
+    def rebuild_scoreboard_command(competition_id: Optional[str]) -> None:
+        db = client[app.config['DB_NAME']]
+        competition_id = competition_id or find_active_competition_id(db, app.config)
+        if competition_id is None:
+            raise click.BadParameter("There is no active competition, pass --competition-id.")
+        report = rebuild_scores(db, app.config, competition_id)
+        publish_score_rebuilt(db, app.config, competition_id)
+        click.echo(json.dumps(report, indent=2))
+
+    # report_jobs, analytics_export and archive store files as attachments, which read the app config when they are imported
+    from report_jobs import start_report_workers
+    from analytics_export import export_to_directory, export_to_storage
+    from archive import ArchiveError, archive_challenges, archive_competition, get_archive_db, restore_challenges, restore_competition
+
+    def run_archive_command(move, target) -> None:
+        db = client[app.config['DB_NAME']]
+        try:
+            report = move(db, get_archive_db(client, app.config), app.config, target, app.config['ARCHIVE_BATCH_SIZE'])
+        except ArchiveError as e:
+            raise click.ClickException(str(e))
+        click.echo(json.dumps(report, indent=2))
+
+    @app.cli.command("archive-competition")
+    @click.option("--competition-id", required=True, help="Finished competition whose teams, students and accounts are archived.")
+    def archive_competition_command(competition_id: str) -> None:
+        run_archive_command(archive_competition, competition_id)
+
+    @app.cli.command("restore-competition")
+    @click.option("--competition-id", required=True, help="Archived competition to move back into the live collections.")
+    def restore_competition_command(competition_id: str) -> None:
+        run_archive_command(restore_competition, competition_id)
+
+    @app.cli.command("archive-challenges")
+    @click.option("--year", required=True, type=int, help="Archive the challenges created in this past year.")
+    def archive_challenges_command(year: int) -> None:
+        run_archive_command(archive_challenges, year)
+
+    @app.cli.command("restore-challenges")
+    @click.option("--year", required=True, type=int, help="Restore the archived challenges created in this year.")
+    def restore_challenges_command(year: int) -> None:
+        run_archive_command(restore_challenges, year)
+
+    @app.cli.command("export-analytics")
+    @click.option("--output-dir", default=None, help="Write the Parquet files to this directory instead of attachment storage.")
+    def export_analytics_command(output_dir: Optional[str]) -> None:
+        db = client[app.config['DB_NAME']]
+        report = export_to_directory(db, app.config, output_dir) if output_dir else export_to_storage(db, app.config)
+        click.echo(json.dumps(report, indent=2))
+
+    # Background threads only start in processes that serve requests, or in flask run-workers.
+    # One-shot CLI commands and the reloader's watcher process would otherwise claim emails
+    # or report jobs under a lease and exit halfway through them.
+    def start_job_workers() -> None:
+        start_file_gc_scheduler(app)
+        start_email_worker(app)
+        start_report_workers(app)
+
+    def start_cache_refreshers() -> None:
+        start_flag_verifier_refresh(app)
+        start_challenge_index_refresh(app)
+        start_scoreboard_sync(app)
+        start_event_publisher(app)
+
+    started_lock = threading.Lock()
+    started = threading.Event()
+
+    @app.before_request
+    def start_background_threads() -> None:
+        if started.is_set() or uri is None:
+            return
+        with started_lock:
+            if started.is_set():
+                return
+            start_cache_refreshers()
+            if app.config['BACKGROUND_WORKERS']:
+                start_job_workers()
+            started.set()
+
+    @app.cli.command("run-workers")
+    def run_workers_command() -> None:
+        # For deployments that run the workers apart from the web processes
+        if uri is None:
+            raise click.ClickException("The database is not configured.")
+        start_job_workers()
+        click.echo("Workers started, press Ctrl+C to stop.")
+        threading.Event().wait()
 
     return app
 
@@ -0,0 +1,263 @@
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReplaceOne
+from pymongo.database import Database
+from attachments import release_attachment, restore_attachment
+from competition_scope import get_active_competition_id
+from scoreboard import publish_score_rebuilt
+from storage import AttachmentStorage, GridFSStorage, attachment_storage, copy_file
+from team_roster import refresh_team_rosters
+
+# Finished competitions and old challenges are moved out of the live collections into a separate
+# archive database, where the collections keep their names, so the live season's working set and
+# indexes only hold current data. Documents are moved in batches: each batch is copied with upserts
+# and then deleted from the source, children before their teams, so an interrupted run can simply
+# be repeated. Attachments are copied into GridFS in the archive database and released from
+# attachment storage. Restoring runs the same steps the other way and rebuilds the team rosters.
+# Archived attachments are shared by every archived document with the same content and are
+# deleted from the archive once a restore leaves nothing there referencing them. API processes
+# hold scores in memory and only see changed score documents, so archived scores are left behind
+# as removed tombstones that expire a day later, and restored scores get a newer version.
+
+# (collection key, field) of attachments on archived documents
+ARCHIVED_FILE_FIELDS = [
+    ("DB_STUDENT_INFO_COLLECTION", "liability_form_id"),
+    ("DB_CHALLENGES_COLLECTION", "challenge_file_attachment_id"),
+]
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def get_archive_db(client, config) -> Database:
+    return client[config['ARCHIVE_DB_NAME']]
+
+
+def get_archive_storage(archive_db: Database) -> AttachmentStorage:
+    return GridFSStorage(archive_db)
+
+
+def ensure_archive_indexes(archive_db: Database, config) -> None:
+    # Only what the read-only archive routes and restores query
+    archive_db[config['DB_TEAMS_COLLECTION']].create_index([("competition_id", ASCENDING), ("teacher_id", ASCENDING)])
+    archive_db[config['DB_STUDENT_INFO_COLLECTION']].create_index("team_id")
+    archive_db[config['DB_STUDENT_INFO_COLLECTION']].create_index("liability_form_id", sparse=True)
+    archive_db[config['DB_STUDENT_ACCOUNTS_COLLECTION']].create_index("student_info_id")
+    archive_db[config['DB_TEAM_ACCOUNTS_COLLECTION']].create_index("team_id")
+    archive_db[config['DB_SUBMISSIONS_COLLECTION']].create_index("team_id")
+    archive_db[config['DB_HINT_UNLOCKS_COLLECTION']].create_index("team_id")
+    archive_db[config['DB_CHALLENGES_COLLECTION']].create_index("created_at")
+    archive_db[config['DB_CHALLENGES_COLLECTION']].create_index("challenge_file_attachment_id", sparse=True)
+
+
+def _copy_documents(target: Database, collection_name: str, documents: List[Dict]) -> None:
+    if documents:
+        target[collection_name].bulk_write([ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents], ordered=False)
+
+
+def _file_ids(documents: Iterable[Dict], field: str) -> List[ObjectId]:
+    return [document[field] for document in documents if document.get(field) is not None]
+
+
+def _is_referenced(archive_db: Database, config, file_id: ObjectId) -> bool:
+    return any(
+        archive_db[config[collection_key]].count_documents({field: file_id}, limit=1)
+        for collection_key, field in ARCHIVED_FILE_FIELDS
+    )
+
+
+def _copy_files_to_archive(archive_storage: AttachmentStorage, file_ids: List[ObjectId]) -> None:
+    # Runs before the documents are deleted, so a file is always reachable from wherever its
+    # document is. The live copies are only released once the documents are gone, a run that
+    # stops in between leaves them for the file sweeper.
+    for file_id in file_ids:
+        if not archive_storage.exists(file_id):
+            copy_file(attachment_storage, archive_storage, file_id)
+
+
+def _release_files(db: Database, file_ids: List[ObjectId]) -> None:
+    for file_id in file_ids:
+        release_attachment(db, file_id)
+
+
+def _restore_files(db: Database, archive_storage: AttachmentStorage, documents: List[Dict], field: str) -> List[ObjectId]:
+    # Points each document at its restored file, which can be an existing copy of the same
+    # content, and returns the archived files that were restored
+    restored_ids = []
+    for document in documents:
+        file_id = document.get(field)
+        if file_id is None:
+            continue
+        document[field] = restore_attachment(db, archive_storage, file_id)
+        restored_ids.append(file_id)
+    return restored_ids
+
+
+def _drop_unreferenced_files(archive_db: Database, config, archive_storage: AttachmentStorage, file_ids: Iterable[ObjectId]) -> None:
+    for file_id in set(file_ids):
+        if not _is_referenced(archive_db, config, file_id):
+            archive_storage.delete(file_id)
+
+
+def _team_batches(source: Database, config, competition_id: str, batch_size: int) -> Iterable[List[Dict]]:
+    # Moved teams are deleted from the source, so every batch starts from the top again
+    while True:
+        teams = list(source[config['DB_TEAMS_COLLECTION']].find({"competition_id": competition_id}).limit(batch_size))
+        if not teams:
+            return
+        yield teams
+
+
+def _team_documents(source: Database, config, teams: List[Dict]) -> Dict[str, List[Dict]]:
+    # A batch of teams with their students, accounts, submissions, hint unlocks and scores, by
+    # collection, teams last
+    team_ids = [team["_id"] for team in teams]
+    students = list(source[config['DB_STUDENT_INFO_COLLECTION']].find({"team_id": {"$in": team_ids}}))
+    student_ids = [student["_id"] for student in students]
+    return {
+        config['DB_STUDENT_INFO_COLLECTION']: students,
+        config['DB_STUDENT_ACCOUNTS_COLLECTION']: list(source[config['DB_STUDENT_ACCOUNTS_COLLECTION']].find({"student_info_id": {"$in": student_ids}})),
+        config['DB_TEAM_ACCOUNTS_COLLECTION']: list(source[config['DB_TEAM_ACCOUNTS_COLLECTION']].find({"team_id": {"$in": team_ids}})),
+        config['DB_SUBMISSIONS_COLLECTION']: list(source[config['DB_SUBMISSIONS_COLLECTION']].find({"team_id": {"$in": team_ids}})),
+        config['DB_HINT_UNLOCKS_COLLECTION']: list(source[config['DB_HINT_UNLOCKS_COLLECTION']].find({"team_id": {"$in": team_ids}})),
+        config['DB_SCORES_COLLECTION']: list(source[config['DB_SCORES_COLLECTION']].find({"_id": {"$in": team_ids}})),
+        config['DB_TEAMS_COLLECTION']: teams,
+    }
+
+
+def _copy_all(target: Database, documents: Dict[str, List[Dict]]) -> None:
+    for collection_name, collection_documents in documents.items():
+        _copy_documents(target, collection_name, collection_documents)
+
+
+def _delete_moved(source: Database, documents: Dict[str, List[Dict]], keep: Iterable[str] = ()) -> None:
+    # In insertion order, so the teams go last
+    for collection_name, collection_documents in documents.items():
+        if collection_documents and collection_name not in keep:
+            source[collection_name].delete_many({"_id": {"$in": [document["_id"] for document in collection_documents]}})
+
+
+def _mark_scores_archived(db: Database, config, scores: List[Dict]) -> None:
+    # The scoreboard sync of every process reads the tombstones and drops the teams
+    if scores:
+        now = datetime.now()
+        db[config['DB_SCORES_COLLECTION']].update_many(
+            {"_id": {"$in": [score["_id"] for score in scores]}},
+            {"$set": {"removed": True, "updated_at": now, "archived_at": now}, "$inc": {"version": 1}}
+        )
+
+
+def _mark_scores_restored(db: Database, config, scores: List[Dict]) -> None:
+    # The restored documents replaced the tombstones, which were one version ahead of them
+    if scores:
+        db[config['DB_SCORES_COLLECTION']].update_many(
+            {"_id": {"$in": [score["_id"] for score in scores]}},
+            {"$set": {"updated_at": datetime.now()}, "$inc": {"version": 2}}
+        )
+
+
+def archive_competition(db: Database, archive_db: Database, config, competition_id: str, batch_size: int) -> Dict:
+    if competition_id == get_active_competition_id(db, config):
+        raise ArchiveError("The active competition can't be archived.")
+    ensure_archive_indexes(archive_db, config)
+    archive_storage = get_archive_storage(archive_db)
+    report = {"competition_id": competition_id, "teams": 0, "students": 0, "files": 0}
+
+    for teams in _team_batches(db, config, competition_id, batch_size):
+        documents = _team_documents(db, config, teams)
+        file_ids = _file_ids(documents[config['DB_STUDENT_INFO_COLLECTION']], "liability_form_id")
+        _copy_all(archive_db, documents)
+        _copy_files_to_archive(archive_storage, file_ids)
+        # Rosters aren't archived, they are rebuilt on restore
+        db[config['DB_TEAM_ROSTER_COLLECTION']].delete_many({"_id": {"$in": [team["_id"] for team in teams]}})
+        _delete_moved(db, documents, keep=[config['DB_SCORES_COLLECTION']])
+        _mark_scores_archived(db, config, documents[config['DB_SCORES_COLLECTION']])
+        _release_files(db, file_ids)
+        report["teams"] += len(teams)
+        report["students"] += len(documents[config['DB_STUDENT_INFO_COLLECTION']])
+        report["files"] += len(file_ids)
+
+    if ObjectId.is_valid(competition_id):
+        db[config['DB_COMPETITION_COLLECTION']].update_one({"_id": ObjectId(competition_id)}, {"$set": {"archived_at": datetime.now()}})
+    publish_score_rebuilt(db, config, competition_id)
+    logging.info("Archived competition: %s", report)
+    return report
+
+
+def restore_competition(db: Database, archive_db: Database, config, competition_id: str, batch_size: int) -> Dict:
+    archive_storage = get_archive_storage(archive_db)
+    report = {"competition_id": competition_id, "teams": 0, "students": 0, "files": 0}
+
+    for teams in _team_batches(archive_db, config, competition_id, batch_size):
+        documents = _team_documents(archive_db, config, teams)
+        students = documents[config['DB_STUDENT_INFO_COLLECTION']]
+        # The students are copied with the ids of their restored files
+        restored_file_ids = _restore_files(db, archive_storage, students, "liability_form_id")
+        _copy_all(db, documents)
+        _mark_scores_restored(db, config, documents[config['DB_SCORES_COLLECTION']])
+        refresh_team_rosters(db, config, [team["_id"] for team in teams])
+        _delete_moved(archive_db, documents)
+        _drop_unreferenced_files(archive_db, config, archive_storage, restored_file_ids)
+        report["teams"] += len(teams)
+        report["students"] += len(students)
+        report["files"] += len(restored_file_ids)
+
+    if ObjectId.is_valid(competition_id):
+        db[config['DB_COMPETITION_COLLECTION']].update_one({"_id": ObjectId(competition_id)}, {"$unset": {"archived_at": ""}})
+    publish_score_rebuilt(db, config, competition_id)
+    logging.info("Restored competition: %s", report)
+    return report
+
+
+def _year_filter(year: int) -> Dict:
+    # The same range /challenges/get filters by
+    return {"created_at": {"$gte": datetime(year, 1, 1), "$lt": datetime(year + 1, 1, 1)}}
+
+
+def _challenge_batches(source: Database, config, year: int, batch_size: int) -> Iterable[List[Dict]]:
+    while True:
+        challenges = list(source[config['DB_CHALLENGES_COLLECTION']].find(_year_filter(year)).limit(batch_size))
+        if not challenges:
+            return
+        yield challenges
+
+
+def archive_challenges(db: Database, archive_db: Database, config, year: int, batch_size: int) -> Dict:
+    if year >= datetime.now().year:
+        raise ArchiveError("Only challenges from past years can be archived.")
+    ensure_archive_indexes(archive_db, config)
+    archive_storage = get_archive_storage(archive_db)
+    collection_name = config['DB_CHALLENGES_COLLECTION']
+    report = {"year": year, "challenges": 0, "files": 0}
+
+    for challenges in _challenge_batches(db, config, year, batch_size):
+        file_ids = _file_ids(challenges, "challenge_file_attachment_id")
+        _copy_documents(archive_db, collection_name, challenges)
+        _copy_files_to_archive(archive_storage, file_ids)
+        _delete_moved(db, {collection_name: challenges})
+        _release_files(db, file_ids)
+        report["challenges"] += len(challenges)
+        report["files"] += len(file_ids)
+
+    logging.info("Archived challenges: %s", report)
+    return report
+
+
+def restore_challenges(db: Database, archive_db: Database, config, year: int, batch_size: int) -> Dict:
+    archive_storage = get_archive_storage(archive_db)
+    collection_name = config['DB_CHALLENGES_COLLECTION']
+    report = {"year": year, "challenges": 0, "files": 0}
+
+    for challenges in _challenge_batches(archive_db, config, year, batch_size):
+        restored_file_ids = _restore_files(db, archive_storage, challenges, "challenge_file_attachment_id")
+        _copy_documents(db, collection_name, challenges)
+        _delete_moved(archive_db, {collection_name: challenges})
+        _drop_unreferenced_files(archive_db, config, archive_storage, restored_file_ids)
+        report["challenges"] += len(challenges)
+        report["files"] += len(restored_file_ids)
+
+    logging.info("Restored challenges: %s", report)
+    return report
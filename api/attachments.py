@@ -0,0 +1,233 @@
+import hashlib
+import mimetypes
+import zlib
+from datetime import datetime
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+from bson.objectid import ObjectId
+from flask import current_app, request
+from pymongo import ReturnDocument
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+from werkzeug.datastructures import FileStorage
+from file_cache import attachment_cache
+from storage import AttachmentStorage, attachment_storage, copy_file
+
+# Attachments are written to the attachment storage one chunk at a time so a request never
+# holds more than a single chunk of the upload in memory, whatever the size of the file.
+# Stored files are content addressed: identical uploads share one stored file, with a
+# reference count kept in the file_refs collection keyed by the sha256 of the content.
+# Compressible content is gzipped on the way in. The stored file's metadata records the
+# encoding and the original length, and downloads decide whether to decompress.
+
+COPY_BUFFER_SIZE = 255 * 1024  # Same as the default GridFS chunk size
+FORM_OVERHEAD_BYTES = 64 * 1024  # Room for the JSON form fields sent next to a file
+COMPRESSED_ENCODING = "gzip"
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/x-sh",
+    "application/x-ndjson",
+    "application/sql",
+    "application/vnd.tcpdump.pcap",
+    "image/svg+xml",
+)
+# Common challenge files that mimetypes has no type for
+COMPRESSIBLE_EXTENSIONS = (".log", ".yaml", ".yml", ".ndjson", ".pcapng")
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"Upload exceeds the maximum size of {max_bytes} bytes.")
+        self.max_bytes = max_bytes
+
+
+class UploadNotFound(Exception):
+    pass
+
+
+def limit_request_body(max_file_size: int) -> None:
+    # Werkzeug enforces this while reading the body, before the multipart form is spooled
+    request.max_content_length = max_file_size + FORM_OVERHEAD_BYTES
+
+
+def _limit_blocks(blocks: Iterable[bytes], max_bytes: Optional[int]) -> Iterator[bytes]:
+    read = 0
+    for block in blocks:
+        read += len(block)
+        if max_bytes is not None and read > max_bytes:
+            raise UploadTooLarge(max_bytes)
+        yield block
+
+
+def _read_blocks(stream: BinaryIO) -> Iterator[bytes]:
+    while True:
+        block = stream.read(COPY_BUFFER_SIZE)
+        if not block:
+            return
+        yield block
+
+
+def _hash_blocks(blocks: Iterable[bytes]) -> str:
+    hasher = hashlib.sha256()
+    for block in blocks:
+        hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _is_compressible(filename: Optional[str], content_type: Optional[str]) -> bool:
+    if not current_app.config['ATTACHMENT_COMPRESSION']:
+        return False
+    if (filename or "").lower().endswith(COMPRESSIBLE_EXTENSIONS):
+        return True
+    # Browsers send application/octet-stream for types they don't know
+    if not content_type or content_type == "application/octet-stream":
+        content_type = mimetypes.guess_type(filename or "")[0]
+    return content_type is not None and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def _write_file(db: Database, blocks: Iterable[bytes], filename: Optional[str], content_type: Optional[str]) -> Tuple[ObjectId, str]:
+    hasher = hashlib.sha256()
+    length = 0
+    compressor = None
+    if _is_compressible(filename, content_type):
+        # wbits=31 writes a gzip stream, which can be sent as-is with Content-Encoding: gzip
+        compressor = zlib.compressobj(current_app.config['ATTACHMENT_COMPRESSION_LEVEL'], zlib.DEFLATED, 31)
+
+    writer = attachment_storage.new_file(filename=filename, content_type=content_type)
+    try:
+        for block in blocks:
+            # Deduplication hashes the original content, not the stored bytes
+            hasher.update(block)
+            length += len(block)
+            writer.write(compressor.compress(block) if compressor is not None else block)
+        metadata = {"sha256": hasher.hexdigest()}
+        if compressor is not None:
+            writer.write(compressor.flush())
+            metadata["encoding"] = COMPRESSED_ENCODING
+            metadata["length"] = length
+        writer.metadata = metadata
+        # A failed upload is aborted too, so no partial file is left behind
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return writer._id, hasher.hexdigest()
+
+
+def _retain_existing(db: Database, digest: str) -> Optional[ObjectId]:
+    file_ref = db[current_app.config['DB_FILE_REFS_COLLECTION']].find_one_and_update(
+        {"_id": digest},
+        # The sweeper leaves files referenced recently alone while the owning document is written
+        {"$inc": {"ref_count": 1}, "$set": {"last_referenced_at": datetime.now()}}
+    )
+    return file_ref["file_id"] if file_ref else None
+
+
+def _register_file(db: Database, digest: str, file_id: ObjectId) -> ObjectId:
+    # Returns the id every reference to this content should use. If the same content was
+    # stored concurrently, the copy that was registered first wins and ours is removed.
+    while True:
+        existing_file_id = _retain_existing(db, digest)
+        if existing_file_id is not None:
+            if existing_file_id != file_id:
+                attachment_storage.delete(file_id)
+            return existing_file_id
+        try:
+            db[current_app.config['DB_FILE_REFS_COLLECTION']].insert_one({
+                "_id": digest,
+                "file_id": file_id,
+                "ref_count": 1,
+                "created_at": datetime.now(),
+                "last_referenced_at": datetime.now(),
+            })
+            return file_id
+        except DuplicateKeyError:
+            continue
+
+
+def store_upload(db: Database, file: FileStorage, max_bytes: Optional[int]) -> ObjectId:
+    stream = file.stream
+    if stream.seekable():
+        # Werkzeug spools uploads, so hash them first and never write a duplicate
+        digest = _hash_blocks(_limit_blocks(_read_blocks(stream), max_bytes))
+        existing_file_id = _retain_existing(db, digest)
+        if existing_file_id is not None:
+            return existing_file_id
+        stream.seek(0)
+
+    file_id, digest = _write_file(db, _limit_blocks(_read_blocks(stream), max_bytes), file.filename, file.mimetype)
+    return _register_file(db, digest, file_id)
+
+
+def store_upload_chunks(db: Database, upload_session: dict) -> ObjectId:
+    # Assembles the staged chunks of a resumable upload into one stored file
+    chunks_collection = db[current_app.config['DB_UPLOAD_CHUNKS_COLLECTION']]
+    max_bytes = upload_session["total_size"]
+
+    def staged_blocks() -> Iterator[bytes]:
+        chunks = chunks_collection.find({"upload_id": upload_session["_id"]}).sort("index", 1).batch_size(1)
+        return _limit_blocks((chunk["data"] for chunk in chunks), max_bytes)
+
+    existing_file_id = _retain_existing(db, _hash_blocks(staged_blocks()))
+    if existing_file_id is not None:
+        return existing_file_id
+
+    file_id, digest = _write_file(db, staged_blocks(), upload_session["filename"], upload_session.get("content_type"))
+    return _register_file(db, digest, file_id)
+
+
+def restore_attachment(db: Database, source: AttachmentStorage, file_id: ObjectId) -> ObjectId:
+    # Takes a reference to a file kept in another storage, such as the archive, copying it back
+    # unless the same content is already stored. Returns the id references should use.
+    source_file = source.open(file_id)
+    digest = (source_file.metadata or {}).get("sha256")
+    source_file.close()
+    if digest is not None:
+        existing_file_id = _retain_existing(db, digest)
+        if existing_file_id is not None:
+            return existing_file_id
+    if not attachment_storage.exists(file_id):
+        copy_file(source, attachment_storage, file_id)
+    if digest is None:
+        # Stored before deduplication, so not reference counted
+        return file_id
+    return _register_file(db, digest, file_id)
+
+
+def release_attachment(db: Database, file_id: ObjectId) -> None:
+    # Drops one reference to a stored file, deleting it when nothing references it anymore
+    if attachment_cache is not None:
+        attachment_cache.invalidate(file_id)
+
+    file_refs_collection = db[current_app.config['DB_FILE_REFS_COLLECTION']]
+    file_ref = file_refs_collection.find_one_and_update(
+        {"file_id": file_id},
+        {"$inc": {"ref_count": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+
+    if file_ref is None:
+        # Files stored before deduplication are not reference counted
+        attachment_storage.delete(file_id)
+        return
+
+    if file_ref["ref_count"] <= 0:
+        # Only delete if no upload retained the content again in the meantime
+        delete_attempt = file_refs_collection.delete_one({"_id": file_ref["_id"], "ref_count": {"$lte": 0}})
+        if delete_attempt.deleted_count == 1:
+            attachment_storage.delete(file_id)
+
+
+def claim_completed_upload(db: Database, upload_id: str) -> ObjectId:
+    # A completed resumable upload can be attached to exactly one document
+    if not ObjectId.is_valid(upload_id):
+        raise UploadNotFound(upload_id)
+
+    upload_session = db[current_app.config['DB_UPLOAD_SESSIONS_COLLECTION']].find_one_and_delete(
+        {"_id": ObjectId(upload_id), "status": "completed"}
+    )
+    if upload_session is None:
+        raise UploadNotFound(upload_id)
+    return upload_session["file_id"]
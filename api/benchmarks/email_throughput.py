@@ -0,0 +1,83 @@
+# Measures how long a mass mailing takes through ResendTransport against a local fake of the Resend
+# API that answers every request after a fixed latency: one request per email in order (how routes
+# used to send), single sends in parallel, and the batch endpoint.
+# Run from the api folder: python benchmarks/email_throughput.py [emails] [latency_ms]
+import sys
+import os
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId
+from flask import Flask
+import resend
+from config import config
+
+EMAILS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+LATENCY_SECONDS = (int(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+
+
+class FakeResendHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(LATENCY_SECONDS)
+        if self.path == "/emails/batch":
+            payload = {"data": [{"id": str(uuid.uuid4())} for _ in body]}
+        else:
+            payload = {"id": str(uuid.uuid4())}
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_messages(count):
+    return [
+        {
+            "_id": ObjectId(),
+            "to": [f"student{index}@example.com"],
+            "subject": "UA CTF Account Details",
+            "text": f"Your username is student{index}.",
+            "attachments": [],
+        }
+        for index in range(count)
+    ]
+
+
+def report(name, send, messages):
+    start = time.perf_counter()
+    results = send(messages)
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    print(f"{name:<32} {elapsed:8.2f} s  {len(messages) / elapsed:9.1f} emails/s  failed: {failed}")
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeResendHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    app = Flask(__name__)
+    app.config.from_object(config["dev"])
+    with app.app_context():
+        from emails import ResendTransport, send_each
+
+        resend.api_key = "re_benchmark"
+        resend.api_url = f"http://127.0.0.1:{server.server_port}"
+        concurrency = app.config['EMAIL_SEND_CONCURRENCY']
+        transport = ResendTransport(concurrency)
+
+        print(f"{EMAILS} emails, {LATENCY_SECONDS * 1000:.0f} ms per provider request")
+        report("one request per email", lambda messages: send_each(transport.send, messages, 1), make_messages(EMAILS))
+        report(f"parallel sends ({concurrency} at a time)", lambda messages: send_each(transport.send, messages, concurrency), make_messages(EMAILS))
+        report("batch endpoint", transport.send_batch, make_messages(EMAILS))
+
+    server.shutdown()
@@ -0,0 +1,78 @@
+# Compares validating stored documents on every read against trusting them on read,
+# either through model_construct or by returning the projected fields directly.
+# Run from the api folder: python benchmarks/read_models.py
+import sys
+import os
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import GetChallengeResponse, GetTeamResponse, StudentInfoResponse
+
+ITERATIONS = 20000
+
+challenge = {
+    "challenge_name": "Packet Hunt",
+    "points": 300,
+    "creator_name": "Crimson Defense",
+    "division": [1, 2],
+    "challenge_description": "Find the flag hidden in the capture.",
+    "flag": "FLAG{example}",
+    "is_flag_case_sensitive": True,
+    "challenge_category": "Forensics",
+    "solution_explanation": "Follow the TCP stream.",
+    "hints": [{"hint": "Look at DNS", "point_cost": 10}, {"hint": "Base64", "point_cost": 20}],
+    "challenge_file_attachment": None,
+}
+
+student = {
+    "id": "6720d0f4c2a4b1e3f0a1b2c3",
+    "student_account_id": "test student account id",
+    "first_name": "Ada",
+    "last_name": "Lovelace",
+    "email": "ada@example.com",
+    "shirt_size": "M",
+    "signed_liability_release_form": None,
+    "is_verified": False,
+}
+
+team = {
+    "id": "6720d0f4c2a4b1e3f0a1b2c4",
+    "teacher_id": "6720d0f4c2a4b1e3f0a1b2c5",
+    "competition_id": "6720d0f4c2a4b1e3f0a1b2c6",
+    "name": "Team Rocket",
+    "division": [1],
+    "is_virtual": False,
+    "students": [student] * 4,
+}
+
+
+def validate_on_read(model, document):
+    return model.model_validate(document).model_dump()
+
+
+def construct_on_read(model, document):
+    return model.model_construct(**document).model_dump(warnings=False)
+
+
+def project_on_read(model, document):
+    # What the read routes do now: copy the projected fields straight into the response
+    return {field: document[field] for field in model.model_fields}
+
+
+def report(name, model, document):
+    validated_us = timeit.timeit(lambda: validate_on_read(model, document), number=ITERATIONS) / ITERATIONS * 1e6
+    constructed_us = timeit.timeit(lambda: construct_on_read(model, document), number=ITERATIONS) / ITERATIONS * 1e6
+    projected_us = timeit.timeit(lambda: project_on_read(model, document), number=ITERATIONS) / ITERATIONS * 1e6
+    print(
+        f"{name:<22} validate: {validated_us:7.2f} us/doc  "
+        f"model_construct: {constructed_us:7.2f} us/doc  "
+        f"projection: {projected_us:7.2f} us/doc  "
+        f"saved: {validated_us - projected_us:7.2f} us/doc"
+    )
+
+
+if __name__ == "__main__":
+    report("GetChallengeResponse", GetChallengeResponse, challenge)
+    report("StudentInfoResponse", StudentInfoResponse, student)
+    report("GetTeamResponse", GetTeamResponse, team)
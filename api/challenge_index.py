@@ -0,0 +1,152 @@
+import logging
+import threading
+from bisect import bisect_left
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from bson.objectid import ObjectId
+from pymongo.collection import Collection
+
+summary_projection = {
+    "challenge_name": 1,
+    "challenge_category": 1,
+    "points": 1,
+    "challenge_description": 1,
+    "division": 1,
+    "created_at": 1,
+}
+
+
+def _to_summary(document: Dict) -> Dict:
+    return {
+        "challenge_name": document["challenge_name"],
+        "challenge_category": document["challenge_category"],
+        "points": document["points"],
+        "challenge_description": document["challenge_description"],
+        "challenge_id": str(document["_id"]),
+        "division": document["division"],
+    }
+
+
+class DivisionChallengeIndex:
+    # In-memory map from division to the challenge summaries in that division, ordered by _id.
+    # A division is loaded from Mongo (through the multikey division index) the first time it
+    # is requested and is then kept current by the challenge create, update and delete routes
+    # of this process. Loaded divisions are read again every CHALLENGE_INDEX_REFRESH_SECONDS to
+    # pick up challenges written by other processes and the archive commands. Reads from Mongo
+    # happen outside the lock, and a read that overlapped a local change is repeated.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Dict[int, List[ObjectId]] = {}
+        self._summaries: Dict[int, List[Dict]] = {}
+        self._created_at: Dict[ObjectId, Optional[datetime]] = {}
+        # Bumped by every local change
+        self._generation = 0
+
+    @staticmethod
+    def _read_division(collection: Collection, division: int) -> Tuple[List[ObjectId], List[Dict], Dict[ObjectId, Optional[datetime]]]:
+        ids: List[ObjectId] = []
+        summaries: List[Dict] = []
+        created_at: Dict[ObjectId, Optional[datetime]] = {}
+        for document in collection.find({"division": division}, summary_projection).sort("_id", 1):
+            ids.append(document["_id"])
+            summaries.append(_to_summary(document))
+            created_at[document["_id"]] = document.get("created_at")
+        return ids, summaries, created_at
+
+    def _load_division(self, collection: Collection, division: int, attempts: int = 3) -> None:
+        for attempt in range(attempts):
+            with self._lock:
+                generation = self._generation
+            ids, summaries, created_at = self._read_division(collection, division)
+            with self._lock:
+                # A change made while reading may be missing from the read, so read again. The
+                # last attempt is kept regardless, the next refresh corrects it.
+                if generation != self._generation and attempt < attempts - 1:
+                    continue
+                self._ids[division] = ids
+                self._summaries[division] = summaries
+                self._created_at.update(created_at)
+                return
+
+    def _remove_locked(self, challenge_id: ObjectId) -> None:
+        for division, ids in self._ids.items():
+            position = bisect_left(ids, challenge_id)
+            if position < len(ids) and ids[position] == challenge_id:
+                del ids[position]
+                del self._summaries[division][position]
+        self._created_at.pop(challenge_id, None)
+
+    def get(self, collection: Collection, division: int, year: Optional[int] = None) -> List[Dict]:
+        with self._lock:
+            loaded = division in self._ids
+        if not loaded:
+            self._load_division(collection, division)
+
+        with self._lock:
+            if year is None:
+                return list(self._summaries[division])
+
+            return [
+                summary
+                for challenge_id, summary in zip(self._ids[division], self._summaries[division])
+                if self._created_at.get(challenge_id) is not None and self._created_at[challenge_id].year == year
+            ]
+
+    def upsert(self, document: Dict) -> None:
+        challenge_id = ObjectId(document["_id"])
+        summary = _to_summary(document)
+        with self._lock:
+            self._generation += 1
+            self._remove_locked(challenge_id)
+            self._created_at[challenge_id] = document.get("created_at")
+            for division in set(document["division"]):
+                # Divisions that were never loaded will pick the challenge up from Mongo
+                if division not in self._ids:
+                    continue
+                position = bisect_left(self._ids[division], challenge_id)
+                self._ids[division].insert(position, challenge_id)
+                self._summaries[division].insert(position, summary)
+
+    def remove(self, challenge_id) -> None:
+        with self._lock:
+            self._generation += 1
+            self._remove_locked(ObjectId(challenge_id))
+
+    def refresh(self, collection: Collection) -> None:
+        with self._lock:
+            divisions = list(self._ids)
+        for division in divisions:
+            self._load_division(collection, division)
+        with self._lock:
+            # Drop the creation dates of challenges that left every division
+            known = {challenge_id for ids in self._ids.values() for challenge_id in ids}
+            for challenge_id in [challenge_id for challenge_id in self._created_at if challenge_id not in known]:
+                del self._created_at[challenge_id]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._ids.clear()
+            self._summaries.clear()
+            self._created_at.clear()
+
+
+challenge_index = DivisionChallengeIndex()
+
+
+def start_challenge_index_refresh(app) -> None:
+    interval = app.config['CHALLENGE_INDEX_REFRESH_SECONDS']
+    if interval <= 0:
+        return
+
+    def run() -> None:
+        stop = threading.Event()
+        collection = app.client[app.config['DB_NAME']][app.config['DB_CHALLENGES_COLLECTION']]
+        while not stop.wait(interval):
+            try:
+                challenge_index.refresh(collection)
+            except Exception as e:
+                logging.error("Failed to refresh the challenge index: %s", e)
+
+    threading.Thread(target=run, name="challenge-index-refresh", daemon=True).start()
@@ -0,0 +1,99 @@
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+from flask import request
+from pymongo import DESCENDING
+from pymongo.database import Database
+from signed_urls import get_request_role
+from team_roster import refresh_team_rosters
+
+# Teams, their students and the students' and team's accounts are tagged with the id of the
+# competition they registered for, and listings and reports only read the active competition
+# (or the one an admin asks for with ?competition_id=). Every such query starts with
+# competition_id, so the compound indexes keep their cost proportional to one competition.
+# The active competition is looked up at most once every ACTIVE_COMPETITION_CACHE_SECONDS per
+# process, and the competition routes clear the cached value when they change a competition.
+
+# Teams registered before competitions were tracked
+LEGACY_COMPETITION_IDS = [None, "test_competition_id"]
+
+# Roles that may read a competition other than the active one
+COMPETITION_OVERRIDE_ROLES = ("admin",)
+
+_active_competition: Optional[Tuple[float, Optional[str]]] = None
+
+
+class NoActiveCompetition(Exception):
+    pass
+
+
+def find_active_competition_id(db: Database, config) -> Optional[str]:
+    # If several competitions are marked active, the newest one wins
+    competition = db[config['DB_COMPETITION_COLLECTION']].find_one(
+        {"is_active": True},
+        {"_id": 1},
+        sort=[("created_at", DESCENDING)]
+    )
+    return str(competition["_id"]) if competition else None
+
+
+def get_active_competition_id(db: Database, config) -> Optional[str]:
+    global _active_competition
+    now = time.monotonic()
+    cached = _active_competition
+    if cached is not None and now - cached[0] < config['ACTIVE_COMPETITION_CACHE_SECONDS']:
+        return cached[1]
+    competition_id = find_active_competition_id(db, config)
+    _active_competition = (now, competition_id)
+    return competition_id
+
+
+def clear_active_competition_cache() -> None:
+    global _active_competition
+    _active_competition = None
+
+
+def require_active_competition_id(db: Database, config) -> str:
+    competition_id = get_active_competition_id(db, config)
+    if competition_id is None:
+        raise NoActiveCompetition("There is no active competition.")
+    return competition_id
+
+
+def get_requested_competition_id(db: Database, config) -> str:
+    # Admins can read earlier competitions by passing their id, everyone else reads the active one
+    competition_id = request.args.get("competition_id")
+    if competition_id and get_request_role() in COMPETITION_OVERRIDE_ROLES:
+        return competition_id
+    return require_active_competition_id(db, config)
+
+
+def assign_legacy_teams(db: Database, config, competition_id: str, batch_size: int = 500) -> Dict:
+    # Tags teams registered before competitions were tracked, along with their students,
+    # accounts and roster documents. Safe to run again, tagged teams are no longer legacy.
+    teams_collection = db[config['DB_TEAMS_COLLECTION']]
+    report = {"competition_id": competition_id, "teams": 0, "students": 0}
+
+    while True:
+        team_ids: List = [
+            team["_id"]
+            for team in teams_collection.find({"competition_id": {"$in": LEGACY_COMPETITION_IDS}}, {"_id": 1}).limit(batch_size)
+        ]
+        if not team_ids:
+            break
+        student_ids = [
+            student["_id"]
+            for student in db[config['DB_STUDENT_INFO_COLLECTION']].find({"team_id": {"$in": team_ids}}, {"_id": 1})
+        ]
+        tag = {"$set": {"competition_id": competition_id}}
+        db[config['DB_STUDENT_INFO_COLLECTION']].update_many({"_id": {"$in": student_ids}}, tag)
+        db[config['DB_STUDENT_ACCOUNTS_COLLECTION']].update_many({"student_info_id": {"$in": student_ids}}, tag)
+        db[config['DB_TEAM_ACCOUNTS_COLLECTION']].update_many({"team_id": {"$in": team_ids}}, tag)
+        # Teams last, so an interrupted run picks the same teams up again
+        teams_collection.update_many({"_id": {"$in": team_ids}}, tag)
+        refresh_team_rosters(db, config, team_ids)
+        report["teams"] += len(team_ids)
+        report["students"] += len(student_ids)
+
+    logging.info("Assigned legacy teams to competition: %s", report)
+    return report
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,6 +9,8 @@ class Config:
     DB_USERNAME = os.environ.get("DB_USERNAME")
     DB_PASSWORD = os.environ.get("DB_PASSWORD")
     DB_NAME = "crimsondefense_ctf"
+    # Finished competitions and old challenges are moved here by the archive commands
+    ARCHIVE_DB_NAME = os.environ.get("ARCHIVE_DB_NAME", "crimsondefense_ctf_archive")
     DB_CHALLENGES_COLLECTION = "challenges"
     DB_ACCOUNTS_COLLECTION = "accounts"
     DB_STUDENT_INFO_COLLECTION = "student_info"
@@ -18,9 +21,110 @@ class Config:
     DB_TEACHER_INFO_COLLECTION = "teacher_info"
     DB_STUDENT_INFO_COLLECTION = "student_info"
     DB_TEAM_ACCOUNTS_COLLECTION = "team_accounts"
+    DB_UPLOAD_SESSIONS_COLLECTION = "upload_sessions"
+    DB_UPLOAD_CHUNKS_COLLECTION = "upload_chunks"
+    DB_FILE_REFS_COLLECTION = "file_refs"
+    DB_JOB_LEASES_COLLECTION = "job_leases"
+    DB_EMAIL_OUTBOX_COLLECTION = "email_outbox"
+    DB_REPORT_JOBS_COLLECTION = "report_jobs"
+    DB_TEAM_ROSTER_COLLECTION = "team_roster"
+    DB_ANALYTICS_EXPORTS_COLLECTION = "analytics_exports"
+    DB_SUBMISSIONS_COLLECTION = "submissions"
+    DB_HINT_UNLOCKS_COLLECTION = "hint_unlocks"
+    DB_SCORES_COLLECTION = "scores"
+    DB_EVENTS_COLLECTION = "events"
     CLIENT_ORIGIN = os.environ.get("CLIENT_ORIGIN")
     RESEND_API_KEY = os.environ.get("RESEND_API_KEY")
     SENDER_EMAIL_ACCOUNT = os.environ.get("SENDER_EMAIL_ACCOUNT")
+    SIGNED_URL_TTL_SECONDS = int(os.environ.get("SIGNED_URL_TTL_SECONDS", 15 * 60))
+    SIGNED_URL_BUCKET_SECONDS = int(os.environ.get("SIGNED_URL_BUCKET_SECONDS", 5 * 60))
+    # Upload size caps in bytes. Requests larger than MAX_CONTENT_LENGTH are rejected while reading,
+    # routes lower the cap for their own uploads. Larger files go through the resumable upload API.
+    MAX_CONTENT_LENGTH = int(os.environ.get("MAX_CONTENT_LENGTH", 100 * 1024 * 1024))
+    CHALLENGE_FILE_MAX_BYTES = int(os.environ.get("CHALLENGE_FILE_MAX_BYTES", 100 * 1024 * 1024))
+    LIABILITY_FORM_MAX_BYTES = int(os.environ.get("LIABILITY_FORM_MAX_BYTES", 10 * 1024 * 1024))
+    LIABILITY_FORMS_BULK_MAX_BYTES = int(os.environ.get("LIABILITY_FORMS_BULK_MAX_BYTES", 100 * 1024 * 1024))
+    LIABILITY_FORMS_UPLOAD_WORKERS = int(os.environ.get("LIABILITY_FORMS_UPLOAD_WORKERS", 4))
+    RESUMABLE_UPLOAD_MAX_BYTES = int(os.environ.get("RESUMABLE_UPLOAD_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+    RESUMABLE_UPLOAD_CHUNK_BYTES = int(os.environ.get("RESUMABLE_UPLOAD_CHUNK_BYTES", 8 * 1024 * 1024))
+    # Gzip compressible attachments (text, CSV, JSON, ...) when they are stored
+    ATTACHMENT_COMPRESSION = os.environ.get("ATTACHMENT_COMPRESSION", "true").lower() == "true"
+    ATTACHMENT_COMPRESSION_LEVEL = int(os.environ.get("ATTACHMENT_COMPRESSION_LEVEL", 6))
+    # Where attachment contents are stored: "gridfs", "local" or "s3". Existing files are moved with flask migrate-storage.
+    ATTACHMENT_STORAGE = os.environ.get("ATTACHMENT_STORAGE", "gridfs")
+    ATTACHMENT_STORAGE_DIR = os.environ.get("ATTACHMENT_STORAGE_DIR", "attachments")
+    S3_BUCKET = os.environ.get("S3_BUCKET")
+    S3_PREFIX = os.environ.get("S3_PREFIX", "attachments/")
+    S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+    S3_REGION = os.environ.get("S3_REGION")
+    S3_ACCESS_KEY_ID = os.environ.get("S3_ACCESS_KEY_ID")
+    S3_SECRET_ACCESS_KEY = os.environ.get("S3_SECRET_ACCESS_KEY")
+    # Local disk cache for hot attachments, set ATTACHMENT_CACHE_DIR to an empty string to disable it
+    ATTACHMENT_CACHE_DIR = os.environ.get("ATTACHMENT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "uactf-attachment-cache"))
+    ATTACHMENT_CACHE_MAX_BYTES = int(os.environ.get("ATTACHMENT_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+    ATTACHMENT_CACHE_MAX_FILE_BYTES = int(os.environ.get("ATTACHMENT_CACHE_MAX_FILE_BYTES", 512 * 1024 * 1024))
+    # Let a front-end server that supports X-Sendfile send cached files instead of the worker
+    USE_X_SENDFILE = os.environ.get("USE_X_SENDFILE", "false").lower() == "true"
+    # Background sweeper for orphaned stored files, set the interval to 0 to disable it
+    FILE_GC_INTERVAL_SECONDS = int(os.environ.get("FILE_GC_INTERVAL_SECONDS", 6 * 60 * 60))
+    FILE_GC_GRACE_PERIOD_SECONDS = int(os.environ.get("FILE_GC_GRACE_PERIOD_SECONDS", 24 * 60 * 60))
+    FILE_GC_BATCH_SIZE = int(os.environ.get("FILE_GC_BATCH_SIZE", 500))
+    # Web processes run the email, report and file sweeper workers once they serve their first request.
+    # Set to false when they run in separate flask run-workers processes instead.
+    BACKGROUND_WORKERS = os.environ.get("BACKGROUND_WORKERS", "true").lower() == "true"
+    # Email outbox delivery. EMAIL_TRANSPORT is "resend", or "stub" to keep messages in memory
+    # for tests and local development. Set EMAIL_WORKER_THREADS to 0 to run no worker in this process.
+    EMAIL_TRANSPORT = os.environ.get("EMAIL_TRANSPORT", "resend")
+    EMAIL_WORKER_THREADS = int(os.environ.get("EMAIL_WORKER_THREADS", 2))
+    EMAIL_POLL_INTERVAL_SECONDS = float(os.environ.get("EMAIL_POLL_INTERVAL_SECONDS", 2))
+    # Messages claimed per round, sent through Resend's batch endpoint, and the cap on parallel
+    # single sends for messages that can't be batched
+    EMAIL_BATCH_SIZE = int(os.environ.get("EMAIL_BATCH_SIZE", 100))
+    EMAIL_SEND_CONCURRENCY = int(os.environ.get("EMAIL_SEND_CONCURRENCY", 4))
+    EMAIL_MAX_ATTEMPTS = int(os.environ.get("EMAIL_MAX_ATTEMPTS", 8))
+    EMAIL_RETRY_BASE_SECONDS = int(os.environ.get("EMAIL_RETRY_BASE_SECONDS", 30))
+    EMAIL_RETRY_MAX_SECONDS = int(os.environ.get("EMAIL_RETRY_MAX_SECONDS", 60 * 60))
+    EMAIL_SEND_TIMEOUT_SECONDS = int(os.environ.get("EMAIL_SEND_TIMEOUT_SECONDS", 5 * 60))
+    # Sent and dead messages are deleted this long after they finished, their contents right away
+    EMAIL_OUTBOX_RETENTION_SECONDS = int(os.environ.get("EMAIL_OUTBOX_RETENTION_SECONDS", 30 * 24 * 60 * 60))
+    EMAIL_TEMPLATES_DIR = os.environ.get("EMAIL_TEMPLATES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "emails"))
+    # How long each process reuses its lookup of the active competition
+    ACTIVE_COMPETITION_CACHE_SECONDS = float(os.environ.get("ACTIVE_COMPETITION_CACHE_SECONDS", 30))
+    # Students embedded in each team_roster document
+    TEAM_ROSTER_MAX_STUDENTS = int(os.environ.get("TEAM_ROSTER_MAX_STUDENTS", 4))
+    # Report generation jobs. Finished jobs and their files are kept for REPORT_JOB_RETENTION_SECONDS.
+    REPORT_WORKER_THREADS = int(os.environ.get("REPORT_WORKER_THREADS", 2))
+    REPORT_POLL_INTERVAL_SECONDS = float(os.environ.get("REPORT_POLL_INTERVAL_SECONDS", 2))
+    REPORT_JOB_LEASE_SECONDS = int(os.environ.get("REPORT_JOB_LEASE_SECONDS", 60))
+    REPORT_JOB_MAX_ATTEMPTS = int(os.environ.get("REPORT_JOB_MAX_ATTEMPTS", 3))
+    REPORT_JOB_RETENTION_SECONDS = int(os.environ.get("REPORT_JOB_RETENTION_SECONDS", 7 * 24 * 60 * 60))
+    # Larger reports are emailed as a download link, outbox documents are limited to 16MB
+    REPORT_EMAIL_ATTACHMENT_MAX_BYTES = int(os.environ.get("REPORT_EMAIL_ATTACHMENT_MAX_BYTES", 5 * 1024 * 1024))
+    # How often each process reads the challenge lists it holds in memory again
+    CHALLENGE_INDEX_REFRESH_SECONDS = int(os.environ.get("CHALLENGE_INDEX_REFRESH_SECONDS", 30))
+    # Flag submissions are checked against challenge flags held in memory, reloaded this often to
+    # pick up challenges written by other processes. 0 disables the periodic reload.
+    FLAG_VERIFIER_REFRESH_SECONDS = int(os.environ.get("FLAG_VERIFIER_REFRESH_SECONDS", 30))
+    # How often each process reads score changes made by other processes, and the most teams
+    # one scoreboard page returns
+    SCOREBOARD_SYNC_SECONDS = float(os.environ.get("SCOREBOARD_SYNC_SECONDS", 2))
+    SCOREBOARD_PAGE_MAX_SIZE = int(os.environ.get("SCOREBOARD_PAGE_MAX_SIZE", 100))
+    # Server-Sent Events. The events collection is capped at EVENTS_CAPPED_BYTES, each process
+    # keeps the last EVENTS_REPLAY_SIZE events for clients that reconnect, and drops clients
+    # that fall EVENTS_CLIENT_QUEUE_SIZE events behind
+    EVENTS_CAPPED_BYTES = int(os.environ.get("EVENTS_CAPPED_BYTES", 16 * 1024 * 1024))
+    EVENTS_REPLAY_SIZE = int(os.environ.get("EVENTS_REPLAY_SIZE", 1000))
+    EVENTS_CLIENT_QUEUE_SIZE = int(os.environ.get("EVENTS_CLIENT_QUEUE_SIZE", 100))
+    EVENTS_MAX_CLIENTS = int(os.environ.get("EVENTS_MAX_CLIENTS", 1000))
+    EVENTS_HEARTBEAT_SECONDS = float(os.environ.get("EVENTS_HEARTBEAT_SECONDS", 15))
+    EVENTS_POLL_INTERVAL_SECONDS = float(os.environ.get("EVENTS_POLL_INTERVAL_SECONDS", 1))
+    EVENTS_RETRY_MS = int(os.environ.get("EVENTS_RETRY_MS", 3000))
+    # Documents moved per batch by the archive and restore commands
+    ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 500))
+    # Parquet exports for offline analytics, rows per record batch and row group
+    ANALYTICS_EXPORT_COMPRESSION = os.environ.get("ANALYTICS_EXPORT_COMPRESSION", "zstd")
+    ANALYTICS_EXPORT_BATCH_ROWS = int(os.environ.get("ANALYTICS_EXPORT_BATCH_ROWS", 50000))
+    ANALYTICS_EXPORT_RETENTION_SECONDS = int(os.environ.get("ANALYTICS_EXPORT_RETENTION_SECONDS", 30 * 24 * 60 * 60))
 
 
 class DevConfig(Config):
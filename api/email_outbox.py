@@ -0,0 +1,189 @@
+import logging
+import random
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Union
+from bson.objectid import ObjectId
+from flask import current_app
+from pymongo import UpdateOne
+from pymongo.client_session import ClientSession
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from pymongo.mongo_client import MongoClient
+from models import EmailRequest, EmailWithAttachmentRequest
+
+# Emails are written to the email_outbox collection by the request that causes them, in the same
+# transaction as the request's own writes, and delivered later by worker threads. Workers claim due
+# messages in batches by moving them to "sending" with a lease, so a worker that dies mid-send only
+# delays them, and hand each batch to the transport, which sends it through the provider's batch API.
+# Failed sends are retried with exponential backoff and jitter, and after EMAIL_MAX_ATTEMPTS the
+# message is dead-lettered with its last error. Messages can carry generated passwords and report
+# attachments, so their contents are removed once they are sent or dead, and the rest of the
+# message is deleted EMAIL_OUTBOX_RETENTION_SECONDS after that by a TTL index on completed_at.
+
+ILLEGAL_OPERATION = 20  # Returned by servers that are not part of a replica set
+
+
+def run_in_transaction(client: MongoClient, callback: Callable[[Optional[ClientSession]], object]):
+    # Commits the callback's writes and the emails it queues together. Standalone servers used for
+    # local development don't support transactions, so the writes are applied one after another there.
+    try:
+        with client.start_session() as session:
+            return session.with_transaction(callback)
+    except OperationFailure as e:
+        if e.code != ILLEGAL_OPERATION:
+            raise
+        logging.warning("Transactions are not supported by this deployment, writing without one: %s", e)
+        return callback(None)
+
+
+def enqueue_email(db: Database, email_request: Union[EmailRequest, EmailWithAttachmentRequest],
+                  session: Optional[ClientSession] = None) -> ObjectId:
+    attachments = []
+    if getattr(email_request, "attachment_content", None) and getattr(email_request, "attachment_filename", None):
+        attachments.append({
+            "content": email_request.attachment_content,
+            "filename": email_request.attachment_filename
+        })
+
+    now = datetime.now()
+    message = {
+        "to": [email_request.email_account],
+        "subject": email_request.subject,
+        "text": email_request.message,
+        "html": email_request.html,
+        "attachments": attachments,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "locked_until": None,
+        "last_error": None,
+        "provider_id": None,
+        "created_at": now,
+        "sent_at": None,
+    }
+    return db[current_app.config['DB_EMAIL_OUTBOX_COLLECTION']].insert_one(message, session=session).inserted_id
+
+
+def claim_emails(db: Database, config, limit: int) -> List[Dict]:
+    # Claims up to limit due messages in three round trips: pick the ids, mark them with a claim id
+    # and a lease in one update_many, then read back the ones this worker actually won
+    outbox_collection = db[config['DB_EMAIL_OUTBOX_COLLECTION']]
+    now = datetime.now()
+    claimable_filter = {
+        "$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            # The worker that claimed it stopped before recording the result
+            {"status": "sending", "locked_until": {"$lt": now}},
+        ]
+    }
+    message_ids = [
+        document["_id"]
+        for document in outbox_collection.find(claimable_filter, {"_id": 1}).sort("next_attempt_at", 1).limit(limit)
+    ]
+    if not message_ids:
+        return []
+
+    claim_id = ObjectId()
+    outbox_collection.update_many(
+        {"_id": {"$in": message_ids}, **claimable_filter},
+        {
+            "$set": {
+                "status": "sending",
+                "claim_id": claim_id,
+                "locked_until": now + timedelta(seconds=config['EMAIL_SEND_TIMEOUT_SECONDS'])
+            },
+            "$inc": {"attempts": 1}
+        }
+    )
+    return list(outbox_collection.find({"claim_id": claim_id, "status": "sending"}))
+
+
+def get_retry_delay(config, attempts: int) -> timedelta:
+    delay = min(config['EMAIL_RETRY_BASE_SECONDS'] * 2 ** (attempts - 1), config['EMAIL_RETRY_MAX_SECONDS'])
+    # Jitter spreads out retries of messages that failed together, e.g. during a provider outage
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+# Removed from messages once they are sent or dead
+CONTENT_FIELDS = {"text": "", "html": "", "attachments": ""}
+
+
+def record_results(db: Database, config, messages: List[Dict], results: List[Union[str, Exception]]) -> Dict:
+    report = {"sent": 0, "failed": 0, "dead": 0}
+    now = datetime.now()
+    updates = []
+    for message, result in zip(messages, results):
+        if isinstance(result, Exception):
+            logging.error("Failed to send email %s (attempt %s): %s", message["_id"], message["attempts"], result)
+            report["failed"] += 1
+            if message["attempts"] >= config['EMAIL_MAX_ATTEMPTS']:
+                report["dead"] += 1
+                update = {"status": "dead", "locked_until": None, "last_error": str(result), "completed_at": now}
+            else:
+                update = {
+                    "status": "pending",
+                    "locked_until": None,
+                    "last_error": str(result),
+                    "next_attempt_at": now + get_retry_delay(config, message["attempts"])
+                }
+        else:
+            report["sent"] += 1
+            update = {"status": "sent", "locked_until": None, "provider_id": result, "sent_at": now, "completed_at": now}
+        operation: Dict = {"$set": update}
+        if "completed_at" in update:
+            operation["$unset"] = CONTENT_FIELDS
+        # Only the worker holding the claim records the result
+        updates.append(UpdateOne({"_id": message["_id"], "claim_id": message["claim_id"]}, operation))
+
+    if updates:
+        db[config['DB_EMAIL_OUTBOX_COLLECTION']].bulk_write(updates, ordered=False)
+    return report
+
+
+def deliver_pending_emails(db: Database, config, transport, limit: Optional[int] = None) -> Dict:
+    # Delivers due messages in batches until none are left, used by the worker threads and the deliver-emails command
+    report = {"sent": 0, "failed": 0, "dead": 0}
+    while limit is None or report["sent"] + report["failed"] < limit:
+        batch_size = config['EMAIL_BATCH_SIZE']
+        if limit is not None:
+            batch_size = min(batch_size, limit - report["sent"] - report["failed"])
+        messages = claim_emails(db, config, batch_size)
+        if not messages:
+            break
+        batch_report = record_results(db, config, messages, transport.send_batch(messages))
+        for key in report:
+            report[key] += batch_report[key]
+    return report
+
+
+def requeue_dead_emails(db: Database, config) -> int:
+    # Only messages that were dead-lettered before contents were removed can still be sent
+    update_attempt = db[config['DB_EMAIL_OUTBOX_COLLECTION']].update_many(
+        {"status": "dead", "text": {"$exists": True}},
+        {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.now()}, "$unset": {"completed_at": ""}}
+    )
+    return update_attempt.modified_count
+
+
+def start_email_worker(app) -> None:
+    # Each thread works through one batch at a time
+    threads = app.config['EMAIL_WORKER_THREADS']
+    if threads <= 0:
+        return
+
+    def run() -> None:
+        stop = threading.Event()
+        with app.app_context():
+            # emails reads the app config when it is imported
+            from emails import email_transport
+            db = app.client[app.config['DB_NAME']]
+            while True:
+                try:
+                    deliver_pending_emails(db, app.config, email_transport)
+                except Exception as e:
+                    logging.error("Email delivery failed: %s", e)
+                stop.wait(app.config['EMAIL_POLL_INTERVAL_SECONDS'])
+
+    for index in range(threads):
+        threading.Thread(target=run, name=f"email-worker-{index}", daemon=True).start()
@@ -0,0 +1,113 @@
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+from markupsafe import escape
+from flask import current_app
+
+# Email templates live in templates/emails as <name>.txt with an optional <name>.html. The first line
+# of the text file is "Subject: ...", the subject template. Placeholders are written {{ field }}.
+# Each template is split once, when the registry is loaded, into its static parts and the slots the
+# fields go in, so rendering only fills the slots and joins. render_batch reuses one parts list
+# for every context, which keeps mass mailings from rebuilding the static text for each recipient.
+
+PLACEHOLDER = re.compile(r"{{\s*([A-Za-z_][A-Za-z0-9_]*)\s*}}")
+SUBJECT_PREFIX = "Subject:"
+
+
+class CompiledTemplate:
+    def __init__(self, name: str, source: str, html: bool = False):
+        self.name = name
+        self.html = html
+        # Static text at even positions, field names at odd ones
+        self.parts: List[str] = PLACEHOLDER.split(source)
+        self.slots: Tuple[Tuple[int, str], ...] = tuple((index, self.parts[index]) for index in range(1, len(self.parts), 2))
+        self.fields = frozenset(field for _, field in self.slots)
+
+    def _fill(self, parts: List[str], context: Dict) -> str:
+        for index, field in self.slots:
+            try:
+                value = context[field]
+            except KeyError:
+                raise ValueError(f"Email template {self.name!r} needs a value for {field!r}.") from None
+            parts[index] = str(escape(value)) if self.html else str(value)
+        return "".join(parts)
+
+    def render(self, context: Dict) -> str:
+        if not self.slots:
+            return self.parts[0]
+        return self._fill(self.parts.copy(), context)
+
+    def render_many(self, contexts: Iterable[Dict]) -> List[str]:
+        if not self.slots:
+            return [self.parts[0] for _ in contexts]
+        parts = self.parts.copy()
+        return [self._fill(parts, context) for context in contexts]
+
+
+class EmailTemplate:
+    def __init__(self, name: str, subject: CompiledTemplate, text: CompiledTemplate, html: Optional[CompiledTemplate]):
+        self.name = name
+        self.subject = subject
+        self.text = text
+        self.html = html
+
+    def render(self, context: Dict) -> Dict[str, Optional[str]]:
+        return {
+            "subject": self.subject.render(context),
+            "text": self.text.render(context),
+            "html": self.html.render(context) if self.html else None
+        }
+
+    def render_batch(self, contexts: List[Dict]) -> List[Dict[str, Optional[str]]]:
+        subjects = self.subject.render_many(contexts)
+        texts = self.text.render_many(contexts)
+        htmls = self.html.render_many(contexts) if self.html else [None] * len(contexts)
+        return [
+            {"subject": subject, "text": text, "html": html}
+            for subject, text, html in zip(subjects, texts, htmls)
+        ]
+
+
+def load_email_template(directory: str, name: str) -> EmailTemplate:
+    with open(os.path.join(directory, f"{name}.txt"), encoding="utf-8") as text_file:
+        subject_line, _, text_source = text_file.read().partition("\n")
+    if not subject_line.startswith(SUBJECT_PREFIX):
+        raise ValueError(f"Email template {name!r} must start with a '{SUBJECT_PREFIX}' line.")
+
+    html = None
+    html_path = os.path.join(directory, f"{name}.html")
+    if os.path.exists(html_path):
+        with open(html_path, encoding="utf-8") as html_file:
+            html = CompiledTemplate(name, html_file.read().strip(), html=True)
+
+    text = CompiledTemplate(name, text_source.strip())
+    if html is not None and html.fields != text.fields:
+        raise ValueError(f"The text and HTML variants of email template {name!r} use different fields.")
+    return EmailTemplate(name, CompiledTemplate(name, subject_line[len(SUBJECT_PREFIX):].strip()), text, html)
+
+
+def load_email_templates(directory: str) -> Dict[str, EmailTemplate]:
+    return {
+        filename[:-len(".txt")]: load_email_template(directory, filename[:-len(".txt")])
+        for filename in sorted(os.listdir(directory))
+        if filename.endswith(".txt")
+    }
+
+
+def get_email_template(name: str) -> EmailTemplate:
+    try:
+        return email_templates[name]
+    except KeyError:
+        raise ValueError(f"Unknown email template {name!r}.") from None
+
+
+def render_email(name: str, context: Dict) -> Dict[str, Optional[str]]:
+    return get_email_template(name).render(context)
+
+
+def render_batch(name: str, contexts: List[Dict]) -> List[Dict[str, Optional[str]]]:
+    return get_email_template(name).render_batch(contexts)
+
+
+# Loaded and compiled once, when the first route module imports this one at startup
+email_templates: Dict[str, EmailTemplate] = load_email_templates(current_app.config['EMAIL_TEMPLATES_DIR'])
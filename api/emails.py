@@ -1,70 +1,126 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import resend
-from pydantic import ValidationError
+from resend.exceptions import ResendError
 from flask import current_app
-from models import EmailRequest, EmailWithAttachmentRequest
+from typing import Dict, List, Union
 import logging
 
+# Transports deliver outbox messages. send delivers one message and returns the provider's id for it,
+# raising on failure. send_batch delivers many and returns, in order, the provider id or the error
+# for each message. Routes never call them directly, they queue messages with email_outbox.enqueue_email.
+
+RESEND_BATCH_LIMIT = 100  # Most emails Resend accepts in one batch request
+
 resend.api_key = current_app.config["RESEND_API_KEY"]
 sender_email_account = current_app.config["SENDER_EMAIL_ACCOUNT"]
 
-def send_email_to_user(email_request: EmailRequest) -> bool:
-    try:
-        email_request_validated = EmailRequest.model_validate(email_request)
-
-        params: resend.Emails.SendParams = {
-                "from": sender_email_account,
-                "to": [email_request_validated.email_account],
-                "subject": email_request_validated.subject,
-                "text": email_request_validated.message
-        }
-
-        email_attempt = resend.Emails.send(params)
-        if email_attempt["id"] is None:
-            logging.error("Could not send email.")
-            return False
-        else:
-            return True
-
-    except ValidationError as e:
-         logging.error("ValidationError: %s", e)
-         return False
-
-    except Exception as e:
-         logging.error("Exception: %s", e)
-         return False
-
-def send_email_with_attachment(email_request: EmailWithAttachmentRequest) -> bool:
-    try:
-        email_request_validated = EmailWithAttachmentRequest.model_validate(email_request)
-
-        params: resend.Emails.SendParams = {
-            "from": sender_email_account,
-            "to": [email_request_validated.email_account],
-            "subject": email_request_validated.subject,
-            "text": email_request_validated.message
-        }
-
-        if email_request_validated.attachment_content and email_request_validated.attachment_filename:
-            params["attachments"] = [{
-                "content": email_request_validated.attachment_content,
-                "filename": email_request_validated.attachment_filename
-            }]
-        else:
-            logging.info("No attachments with email.")
-
-        email_attempt = resend.Emails.send(params)
-        if email_attempt["id"] is None:
-            logging.error("Error sending email.")
-            return False
-        logging.info("Successfully sent email with optional attachment!")
-        return True
-    except ValidationError as e:
-         logging.error("ValidationError: %s", e)
-         return False
-
-    except Exception as e:
-         logging.error("Exception: %s", e)
-         return False
 
+class EmailDeliveryError(Exception):
+    pass
+
+
+def build_resend_params(message: Dict) -> resend.Emails.SendParams:
+    params: resend.Emails.SendParams = {
+        "from": sender_email_account,
+        "to": message["to"],
+        "subject": message["subject"],
+        "text": message["text"]
+    }
+    if message.get("html"):
+        params["html"] = message["html"]
+    if message.get("attachments"):
+        params["attachments"] = message["attachments"]
+    return params
+
+
+def send_each(send, messages: List[Dict], concurrency: int) -> List[Union[str, Exception]]:
+    def send_or_error(message: Dict) -> Union[str, Exception]:
+        try:
+            return send(message)
+        except Exception as e:
+            return e
+
+    if len(messages) <= 1 or concurrency <= 1:
+        return [send_or_error(message) for message in messages]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(messages))) as executor:
+        return list(executor.map(send_or_error, messages))
+
+
+class ResendTransport:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+
+    def send(self, message: Dict) -> str:
+        # The outbox id makes retries of a send that timed out after Resend accepted it harmless
+        email_attempt = resend.Emails.send(build_resend_params(message), {"idempotency_key": f"email-outbox/{message['_id']}"})
+        if email_attempt.get("id") is None:
+            raise EmailDeliveryError("Resend did not return an email id.")
+        return email_attempt["id"]
+
+    def _send_chunk(self, messages: List[Dict]) -> List[Union[str, Exception]]:
+        idempotency_key = hashlib.sha256(",".join(str(message["_id"]) for message in messages).encode()).hexdigest()
+        try:
+            response = resend.Batch.send([build_resend_params(message) for message in messages], {"idempotency_key": f"email-outbox-batch/{idempotency_key}"})
+        except ResendError as e:
+            if str(e.code) not in ("400", "422"):
+                return [e] * len(messages)
+            # Resend rejects the whole batch when one message is invalid, send them one by one
+            # so the valid ones still go out and the invalid one gets its own error
+            logging.warning("Resend rejected a batch of %s emails, sending them individually: %s", len(messages), e)
+            return send_each(self.send, messages, self.concurrency)
+        except Exception as e:
+            return [e] * len(messages)
+
+        sent = response.get("data") or []
+        if len(sent) != len(messages):
+            return [EmailDeliveryError("Resend returned an unexpected batch response.")] * len(messages)
+        return [email.get("id") or EmailDeliveryError("Resend did not return an email id.") for email in sent]
+
+    def send_batch(self, messages: List[Dict]) -> List[Union[str, Exception]]:
+        results: List[Union[str, Exception, None]] = [None] * len(messages)
+
+        # The batch endpoint doesn't take attachments, so those are sent individually
+        batchable = [index for index, message in enumerate(messages) if not message.get("attachments")]
+        individual = [index for index, message in enumerate(messages) if message.get("attachments")]
+
+        for start in range(0, len(batchable), RESEND_BATCH_LIMIT):
+            indexes = batchable[start:start + RESEND_BATCH_LIMIT]
+            if len(indexes) == 1:
+                individual.extend(indexes)
+                continue
+            for index, result in zip(indexes, self._send_chunk([messages[index] for index in indexes])):
+                results[index] = result
+
+        for index, result in zip(individual, send_each(self.send, [messages[index] for index in individual], self.concurrency)):
+            results[index] = result
+        return results
+
+
+class StubTransport:
+    # Stands in for Resend in tests and local development
+    def __init__(self):
+        self.sent: List[Dict] = []
+        self.lock = threading.Lock()
+
+    def send(self, message: Dict) -> str:
+        with self.lock:
+            self.sent.append(message)
+            provider_id = f"stub-{len(self.sent)}"
+        logging.info("Stub transport delivered email to %s: %s", ", ".join(message["to"]), message["subject"])
+        return provider_id
+
+    def send_batch(self, messages: List[Dict]) -> List[Union[str, Exception]]:
+        return send_each(self.send, messages, 1)
+
+
+def create_email_transport(name: str, concurrency: int = 1):
+    if name == "resend":
+        return ResendTransport(concurrency)
+    if name == "stub":
+        return StubTransport()
+    raise ValueError(f"Unknown email transport {name!r}, expected 'resend' or 'stub'.")
 
 
+email_transport = create_email_transport(current_app.config['EMAIL_TRANSPORT'], current_app.config['EMAIL_SEND_CONCURRENCY'])
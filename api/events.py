@@ -0,0 +1,205 @@
+import json
+import logging
+import queue
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+from bson.objectid import ObjectId
+from pymongo import CursorType
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import CollectionInvalid
+
+# Change events pushed to browsers with Server-Sent Events. Routes insert each event into the
+# capped events collection, and one publisher thread per process tails it and fans the events
+# out to the connected clients of that process, so every process sees every event in the same
+# order whichever process wrote it. Each client has a bounded queue, and a client that falls
+# EVENTS_CLIENT_QUEUE_SIZE events behind is dropped instead of slowing the others down. The
+# publisher keeps the last EVENTS_REPLAY_SIZE events, so a client that reconnects with the id
+# of the last event it saw gets the ones it missed, or a reset event if they are gone.
+
+CHANNELS = ("scoreboard", "admin")
+
+# Events written by other processes can be inserted a little after the last id a reopened
+# cursor starts from, so it starts this far back and skips the events it already published
+RESUME_OVERLAP_SECONDS = 5
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+def ensure_events_collection(db: Database, config) -> None:
+    name = config['DB_EVENTS_COLLECTION']
+    if name in db.list_collection_names():
+        return
+    try:
+        db.create_collection(name, capped=True, size=config['EVENTS_CAPPED_BYTES'])
+    except CollectionInvalid:
+        # Created by another process in the meantime
+        pass
+
+
+def publish_event(db: Database, config, channel: str, event_type: str, data: Dict) -> None:
+    # Events are a notification, the change they describe is already written, so a failure is
+    # only logged. Capped collections can't be written in a transaction, call this after commit.
+    try:
+        db[config['DB_EVENTS_COLLECTION']].insert_one({
+            "channel": channel,
+            "type": event_type,
+            "data": data,
+            "created_at": datetime.now(),
+        })
+    except Exception as e:
+        logging.error("Failed to publish %s event: %s", event_type, e)
+
+
+def format_event(event: Dict) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {event['data']}\n\n"
+
+
+class Subscriber:
+    def __init__(self, channels: Iterable[str], queue_size: int):
+        self.channels: FrozenSet[str] = frozenset(channels)
+        self.queue: "queue.Queue[Dict]" = queue.Queue(maxsize=queue_size)
+        self.dropped = False
+
+
+class EventBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Set[Subscriber] = set()
+        self._recent: Deque[Dict] = deque()
+        self._recent_ids: Set[str] = set()
+        self._replay_size = 0
+
+    def configure(self, replay_size: int) -> None:
+        with self._lock:
+            self._replay_size = replay_size
+
+    def subscribe(self, channels: Iterable[str], last_event_id: Optional[str], queue_size: int,
+                  max_subscribers: int) -> Tuple[Subscriber, List[Dict], bool]:
+        # Returns the subscriber, the events it missed since last_event_id, and whether those
+        # are no longer known. Taken under the lock, so no event is missed or sent twice.
+        subscriber = Subscriber(channels, queue_size)
+        with self._lock:
+            if len(self._subscribers) >= max_subscribers:
+                raise TooManySubscribers()
+            missed: List[Dict] = []
+            reset = False
+            if last_event_id:
+                if last_event_id in self._recent_ids:
+                    recent = list(self._recent)
+                    position = next(i for i, event in enumerate(recent) if event["id"] == last_event_id)
+                    missed = [event for event in recent[position + 1:] if event["channel"] in subscriber.channels]
+                else:
+                    reset = True
+            self._subscribers.add(subscriber)
+        return subscriber, missed, reset
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event: Dict) -> bool:
+        with self._lock:
+            if event["id"] in self._recent_ids:
+                return False
+            self._recent.append(event)
+            self._recent_ids.add(event["id"])
+            while len(self._recent) > self._replay_size:
+                self._recent_ids.discard(self._recent.popleft()["id"])
+
+            for subscriber in list(self._subscribers):
+                if event["channel"] not in subscriber.channels:
+                    continue
+                try:
+                    subscriber.queue.put_nowait(event)
+                except queue.Full:
+                    # The client reconnects and catches up from the replay buffer, if it still can
+                    subscriber.dropped = True
+                    self._subscribers.discard(subscriber)
+        return True
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+
+event_broker = EventBroker()
+
+
+def _to_event(document: Dict) -> Dict:
+    return {
+        "id": str(document["_id"]),
+        "channel": document["channel"],
+        "type": document["type"],
+        "data": json.dumps(document["data"], default=str),
+    }
+
+
+def stream_events(subscriber: Subscriber, missed: List[Dict], reset: bool, heartbeat_seconds: float, retry_ms: int):
+    try:
+        yield f"retry: {retry_ms}\n\n"
+        if reset:
+            # The missed events are gone, the client should fetch the current state again
+            yield "event: reset\ndata: {}\n\n"
+        for event in missed:
+            yield format_event(event)
+        while not subscriber.dropped:
+            try:
+                event = subscriber.queue.get(timeout=heartbeat_seconds)
+            except queue.Empty:
+                # Keeps proxies from closing an idle connection
+                yield ": heartbeat\n\n"
+                continue
+            if subscriber.dropped:
+                break
+            yield format_event(event)
+    finally:
+        event_broker.unsubscribe(subscriber)
+
+
+def _load_recent(collection: Collection, replay_size: int) -> Optional[ObjectId]:
+    documents = list(collection.find().sort("$natural", -1).limit(replay_size))
+    for document in reversed(documents):
+        event_broker.publish(_to_event(document))
+    return documents[0]["_id"] if documents else None
+
+
+def _tail(collection: Collection, last_id: Optional[ObjectId], await_ms: int) -> Optional[ObjectId]:
+    query: Dict = {}
+    if last_id is not None:
+        resume_from = last_id.generation_time - timedelta(seconds=RESUME_OVERLAP_SECONDS)
+        query = {"_id": {"$gt": ObjectId.from_datetime(resume_from)}}
+    cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT).max_await_time_ms(await_ms)
+    while cursor.alive:
+        for document in cursor:
+            event_broker.publish(_to_event(document))
+            last_id = document["_id"]
+    return last_id
+
+
+def start_event_publisher(app) -> None:
+    event_broker.configure(app.config['EVENTS_REPLAY_SIZE'])
+    poll_interval = app.config['EVENTS_POLL_INTERVAL_SECONDS']
+
+    def run() -> None:
+        stop = threading.Event()
+        collection = app.client[app.config['DB_NAME']][app.config['DB_EVENTS_COLLECTION']]
+        last_id = None
+        loaded = False
+        while True:
+            try:
+                if not loaded:
+                    last_id = _load_recent(collection, app.config['EVENTS_REPLAY_SIZE'])
+                    loaded = True
+                last_id = _tail(collection, last_id, int(poll_interval * 1000))
+            except Exception as e:
+                logging.error("Event publisher failed: %s", e)
+            # The cursor dies when the collection is empty or the capped collection wrapped
+            # past it, wait before opening a new one
+            stop.wait(poll_interval)
+
+    threading.Thread(target=run, name="event-publisher", daemon=True).start()
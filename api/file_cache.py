@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import tempfile
+from typing import Dict, Optional, Tuple
+from flask import current_app
+
+# Read-through cache of GridFS attachments on local disk. Hits are served straight from
+# disk with sendfile, so a hot file is only reassembled from fs.chunks once per host.
+# Entries are a data file named after the file id plus a small JSON sidecar with the
+# response headers. The modification time of the data file records its last use, and
+# the least recently used entries are evicted once the total size exceeds the limit.
+# The directory is shared by every worker on the host, so eviction and invalidation
+# only rely on the filesystem.
+
+METADATA_SUFFIX = ".json"
+TEMP_PREFIX = ".tmp-"
+
+
+class AttachmentDiskCache:
+    def __init__(self, directory: str, max_bytes: int, max_file_bytes: int):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _data_path(self, file_id) -> str:
+        return os.path.join(self.directory, str(file_id))
+
+    def get(self, file_id) -> Optional[Tuple[str, Dict]]:
+        data_path = self._data_path(file_id)
+        try:
+            with open(data_path + METADATA_SUFFIX) as metadata_file:
+                metadata = json.load(metadata_file)
+            # Touch the entry so it counts as recently used
+            os.utime(data_path)
+            return data_path, metadata
+        except (OSError, ValueError):
+            return None
+
+    def put(self, file_id, file, metadata: Dict) -> Optional[str]:
+        if file.length > self.max_file_bytes:
+            return None
+
+        data_path = self._data_path(file_id)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                while True:
+                    block = file.read(file.chunk_size)
+                    if not block:
+                        break
+                    temp_file.write(block)
+            # The data file is moved into place before its metadata, so an entry is
+            # only visible once it is complete
+            os.replace(temp_path, data_path)
+            with open(data_path + METADATA_SUFFIX, "w") as metadata_file:
+                json.dump(metadata, metadata_file)
+        except OSError as e:
+            logging.error("Failed to cache attachment %s: %s", file_id, e)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+
+        self._evict()
+        return data_path
+
+    def invalidate(self, file_id) -> None:
+        data_path = self._data_path(file_id)
+        for path in (data_path + METADATA_SUFFIX, data_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self) -> None:
+        entries = []
+        total_size = 0
+        with os.scandir(self.directory) as scanned:
+            for entry in scanned:
+                if entry.name.startswith(TEMP_PREFIX) or entry.name.endswith(METADATA_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+                total_size += stat.st_size
+
+        if total_size <= self.max_bytes:
+            return
+
+        for _, size, name in sorted(entries):
+            self.invalidate(name)
+            total_size -= size
+            if total_size <= self.max_bytes:
+                return
+
+
+attachment_cache: Optional[AttachmentDiskCache] = None
+if current_app.config['ATTACHMENT_CACHE_DIR']:
+    attachment_cache = AttachmentDiskCache(
+        current_app.config['ATTACHMENT_CACHE_DIR'],
+        current_app.config['ATTACHMENT_CACHE_MAX_BYTES'],
+        current_app.config['ATTACHMENT_CACHE_MAX_FILE_BYTES']
+    )
@@ -0,0 +1,201 @@
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Set
+from bson.objectid import ObjectId
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+
+# Writes to attachment storage and to the document that owns a file are not atomic, so files can be left
+# behind (an upload whose insert failed, a team deleted with its students' forms) and documents
+# can point at files that no longer exist. The sweeper finds both, removes orphaned files that
+# are older than a grace period in batches, clears dangling optional references, and reports
+# what it reclaimed. The grace period of a deduplicated file runs from the last time an upload
+# took a reference to it in file_refs, since a new upload of old content reuses the old file
+# before the document pointing at it is written.
+
+GC_LEASE_ID = "file_gc"
+
+# (collection config key, field, whether the field may be cleared when its file is missing)
+FILE_REFERENCES = [
+    ("DB_CHALLENGES_COLLECTION", "challenge_file_attachment_id", True),
+    ("DB_COMPETITION_COLLECTION", "liability_release_form_file_id", False),
+    ("DB_STUDENT_INFO_COLLECTION", "liability_form_id", True),
+    ("DB_UPLOAD_SESSIONS_COLLECTION", "file_id", False),
+    ("DB_REPORT_JOBS_COLLECTION", "artifact_file_ids", False),
+    ("DB_ANALYTICS_EXPORTS_COLLECTION", "file_ids", False),
+]
+
+
+def _batches(items: List, batch_size: int) -> Iterable[List]:
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def _referenced_ids(document: Dict, field: str) -> List[ObjectId]:
+    # Reference fields hold a single file id or a list of them
+    value = document.get(field)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _collect_referenced_file_ids(db: Database, config) -> Set[ObjectId]:
+    referenced: Set[ObjectId] = set()
+    for collection_key, field, _ in FILE_REFERENCES:
+        for document in db[config[collection_key]].find({field: {"$ne": None}}, {field: 1}):
+            referenced.update(_referenced_ids(document, field))
+    return referenced
+
+
+def _recently_referenced(cutoff: datetime) -> Dict:
+    # References registered before last_referenced_at was recorded fall back to created_at
+    return {"$or": [
+        {"last_referenced_at": {"$gte": cutoff}},
+        {"last_referenced_at": {"$exists": False}, "created_at": {"$gte": cutoff}},
+    ]}
+
+
+def _recently_referenced_file_ids(db: Database, config, cutoff: datetime, file_ids: List[ObjectId]) -> Set[ObjectId]:
+    return {
+        file_ref["file_id"]
+        for file_ref in db[config['DB_FILE_REFS_COLLECTION']].find(
+            {"file_id": {"$in": file_ids}, **_recently_referenced(cutoff)},
+            {"file_id": 1}
+        )
+    }
+
+
+def _delete_files(db: Database, config, storage, file_ids: List[ObjectId], cutoff: datetime) -> List[ObjectId]:
+    # Re-checks the references right before deleting, an upload may have reused a file since
+    # it was listed. Returns the ids that were deleted.
+    file_refs_collection = db[config['DB_FILE_REFS_COLLECTION']]
+    file_ids = [file_id for file_id in file_ids if file_id not in _recently_referenced_file_ids(db, config, cutoff, file_ids)]
+    if not file_ids:
+        return []
+    file_refs_collection.delete_many({"file_id": {"$in": file_ids}, "$nor": [_recently_referenced(cutoff)]})
+    # References taken between the check and the delete survive it, and so do their files
+    retained = {file_ref["file_id"] for file_ref in file_refs_collection.find({"file_id": {"$in": file_ids}}, {"file_id": 1})}
+    file_ids = [file_id for file_id in file_ids if file_id not in retained]
+    storage.delete_many(file_ids)
+    return file_ids
+
+
+def _expire_upload_sessions(db: Database, config, cutoff: datetime, dry_run: bool) -> int:
+    # Resumable uploads that were never completed, or completed but never attached.
+    # Attached uploads are removed when they are claimed.
+    sessions_collection = db[config['DB_UPLOAD_SESSIONS_COLLECTION']]
+    expired_ids = [
+        document["_id"]
+        for document in sessions_collection.find(
+            {"created_at": {"$lt": cutoff}},
+            {"_id": 1}
+        )
+    ]
+    if expired_ids and not dry_run:
+        db[config['DB_UPLOAD_CHUNKS_COLLECTION']].delete_many({"upload_id": {"$in": expired_ids}})
+        sessions_collection.delete_many({"_id": {"$in": expired_ids}})
+    return len(expired_ids)
+
+
+def sweep_files(db: Database, config, grace_period: timedelta, batch_size: int = 500, dry_run: bool = False) -> Dict:
+    # file_cache and storage read the app config when they are imported, so only import them once an app context exists
+    from file_cache import attachment_cache
+    from storage import attachment_storage
+
+    cutoff = datetime.now() - grace_period
+    # Stored upload dates are naive UTC datetimes
+    upload_cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - grace_period
+    expired_uploads = _expire_upload_sessions(db, config, cutoff, dry_run)
+    referenced = _collect_referenced_file_ids(db, config)
+
+    candidates: Dict[ObjectId, int] = {}
+    existing_ids: Set[ObjectId] = set()
+    for stored_file in attachment_storage.list_files():
+        existing_ids.add(stored_file["_id"])
+        if stored_file["_id"] not in referenced and stored_file["upload_date"] < upload_cutoff:
+            candidates[stored_file["_id"]] = stored_file["length"]
+
+    orphaned_ids: List[ObjectId] = []
+    for batch in _batches(list(candidates), batch_size):
+        recent = _recently_referenced_file_ids(db, config, cutoff, batch)
+        orphaned_ids.extend(file_id for file_id in batch if file_id not in recent)
+
+    if not dry_run:
+        deleted_ids: List[ObjectId] = []
+        for batch in _batches(orphaned_ids, batch_size):
+            deleted = _delete_files(db, config, attachment_storage, batch, cutoff)
+            deleted_ids.extend(deleted)
+            if attachment_cache is not None:
+                for file_id in deleted:
+                    attachment_cache.invalidate(file_id)
+        orphaned_ids = deleted_ids
+    reclaimed_bytes = sum(candidates[file_id] for file_id in orphaned_ids)
+
+    dangling_references: Dict[str, int] = {}
+    for collection_key, field, can_clear in FILE_REFERENCES:
+        collection = db[config[collection_key]]
+        dangling_ids = [
+            document["_id"]
+            for document in collection.find({field: {"$ne": None}}, {field: 1})
+            if any(
+                file_id not in existing_ids
+                # Skip files created after the storage listing started
+                and file_id.generation_time.replace(tzinfo=None) < upload_cutoff
+                for file_id in _referenced_ids(document, field)
+            )
+        ]
+        dangling_references[f"{config[collection_key]}.{field}"] = len(dangling_ids)
+        for document_id in dangling_ids:
+            logging.warning("%s %s references missing file in %s", config[collection_key], document_id, field)
+        if can_clear and not dry_run:
+            for batch in _batches(dangling_ids, batch_size):
+                collection.update_many({"_id": {"$in": batch}}, {"$set": {field: None}})
+
+    report = {
+        "dry_run": dry_run,
+        "orphaned_files": len(orphaned_ids),
+        "reclaimed_bytes": reclaimed_bytes,
+        "expired_uploads": expired_uploads,
+        "dangling_references": dangling_references,
+    }
+    logging.info("File sweep finished: %s", report)
+    return report
+
+
+def _acquire_lease(db: Database, config, duration: timedelta) -> bool:
+    # Only one worker across the deployment sweeps at a time
+    now = datetime.now()
+    try:
+        db[config['DB_JOB_LEASES_COLLECTION']].update_one(
+            {"_id": GC_LEASE_ID, "locked_until": {"$lt": now}},
+            {"$set": {"locked_until": now + duration}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def start_file_gc_scheduler(app) -> None:
+    interval = app.config['FILE_GC_INTERVAL_SECONDS']
+    if interval <= 0:
+        return
+
+    def run() -> None:
+        stop = threading.Event()
+        while not stop.wait(interval):
+            try:
+                with app.app_context():
+                    db = app.client[app.config['DB_NAME']]
+                    if _acquire_lease(db, app.config, timedelta(seconds=interval)):
+                        sweep_files(
+                            db,
+                            app.config,
+                            timedelta(seconds=app.config['FILE_GC_GRACE_PERIOD_SECONDS']),
+                            app.config['FILE_GC_BATCH_SIZE']
+                        )
+            except Exception as e:
+                logging.error("File sweep failed: %s", e)
+
+    threading.Thread(target=run, name="file-gc", daemon=True).start()
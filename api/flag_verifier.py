@@ -0,0 +1,89 @@
+import hashlib
+import hmac
+import logging
+import threading
+import unicodedata
+from typing import Dict, FrozenSet, Iterable, NamedTuple, Optional
+from pymongo.collection import Collection
+
+# Flag submissions are checked against an in-memory map from challenge id to the sha256 digest of
+# the challenge's normalized flag, so a submission never reads the challenge document. The map is
+# loaded when the challenges blueprint is imported, updated by the challenge routes of this process,
+# and reloaded every FLAG_VERIFIER_REFRESH_SECONDS to pick up challenges written by other processes.
+# Unknown challenge ids never trigger a reload, so submissions can't be used to force one.
+
+flag_projection = {"flag": 1, "is_flag_case_sensitive": 1, "division": 1, "points": 1}
+
+
+def normalize_flag(flag: str, case_sensitive: bool) -> str:
+    flag = unicodedata.normalize("NFC", flag.strip())
+    return flag if case_sensitive else flag.casefold()
+
+
+def flag_digest(flag: str, case_sensitive: bool) -> bytes:
+    return hashlib.sha256(normalize_flag(flag, case_sensitive).encode("utf-8")).digest()
+
+
+class FlagEntry(NamedTuple):
+    digest: bytes
+    case_sensitive: bool
+    divisions: FrozenSet[int]
+    # Awarded for solving the challenge, so scoring doesn't read the challenge either
+    points: int
+
+    def matches(self, submitted_flag: str) -> bool:
+        return hmac.compare_digest(self.digest, flag_digest(submitted_flag, self.case_sensitive))
+
+
+class FlagVerifier:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flags: Dict[str, FlagEntry] = {}
+
+    @staticmethod
+    def _entry(document: Dict) -> FlagEntry:
+        case_sensitive = document["is_flag_case_sensitive"]
+        return FlagEntry(flag_digest(document["flag"], case_sensitive), case_sensitive, frozenset(document["division"]), document["points"])
+
+    def load(self, collection: Collection) -> int:
+        flags = {str(document["_id"]): self._entry(document) for document in collection.find({}, flag_projection)}
+        with self._lock:
+            # Swapped in whole, so checks never see a half-built map
+            self._flags = flags
+        return len(flags)
+
+    def upsert(self, document: Dict) -> None:
+        entry = self._entry(document)
+        with self._lock:
+            self._flags[str(document["_id"])] = entry
+
+    def remove(self, challenge_id) -> None:
+        with self._lock:
+            self._flags.pop(str(challenge_id), None)
+
+    def get(self, challenge_id: str, divisions: Iterable[int]) -> Optional[FlagEntry]:
+        # None when there is no such challenge in any of the given divisions
+        entry = self._flags.get(challenge_id)
+        if entry is None or entry.divisions.isdisjoint(divisions):
+            return None
+        return entry
+
+
+flag_verifier = FlagVerifier()
+
+
+def start_flag_verifier_refresh(app) -> None:
+    interval = app.config['FLAG_VERIFIER_REFRESH_SECONDS']
+    if interval <= 0:
+        return
+
+    def run() -> None:
+        stop = threading.Event()
+        collection = app.client[app.config['DB_NAME']][app.config['DB_CHALLENGES_COLLECTION']]
+        while not stop.wait(interval):
+            try:
+                flag_verifier.load(collection)
+            except Exception as e:
+                logging.error("Failed to reload challenge flags: %s", e)
+
+    threading.Thread(target=run, name="flag-verifier-refresh", daemon=True).start()
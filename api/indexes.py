@@ -0,0 +1,71 @@
+import logging
+from pymongo import ASCENDING, DESCENDING
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+# (collection config key, keys, index options)
+INDEXES = [
+    # Multikey index: one entry per division a challenge belongs to
+    ("DB_CHALLENGES_COLLECTION", [("division", ASCENDING), ("_id", ASCENDING)], {}),
+    ("DB_UPLOAD_CHUNKS_COLLECTION", [("upload_id", ASCENDING), ("index", ASCENDING)], {"unique": True}),
+    ("DB_FILE_REFS_COLLECTION", "file_id", {"unique": True}),
+    ("DB_COMPETITION_COLLECTION", [("is_active", ASCENDING), ("created_at", DESCENDING)], {}),
+    # Listings and reports read one competition, so competition_id leads these indexes
+    ("DB_TEAMS_COLLECTION", [("competition_id", ASCENDING), ("teacher_id", ASCENDING)], {}),
+    ("DB_TEAMS_COLLECTION", [("competition_id", ASCENDING), ("is_virtual", ASCENDING)], {}),
+    ("DB_STUDENT_INFO_COLLECTION", [("competition_id", ASCENDING), ("is_verified", ASCENDING)], {}),
+    # Used by the $lookup stages that build reports
+    ("DB_STUDENT_INFO_COLLECTION", "team_id", {}),
+    ("DB_STUDENT_ACCOUNTS_COLLECTION", "student_info_id", {}),
+    ("DB_EMAIL_OUTBOX_COLLECTION", [("status", ASCENDING), ("next_attempt_at", ASCENDING)], {}),
+    ("DB_EMAIL_OUTBOX_COLLECTION", "claim_id", {"sparse": True}),
+    ("DB_EMAIL_OUTBOX_COLLECTION", "completed_at", {"expireAfterSeconds": "EMAIL_OUTBOX_RETENTION_SECONDS"}),
+    ("DB_TEAM_ROSTER_COLLECTION", [("competition_id", ASCENDING), ("teacher_id", ASCENDING)], {}),
+    ("DB_TEAM_ROSTER_COLLECTION", [("competition_id", ASCENDING), ("is_virtual", ASCENDING)], {}),
+    ("DB_TEAM_ROSTER_COLLECTION", "students.id", {}),
+    # Only one queued or running job per report, finished jobs no longer have the active field
+    ("DB_REPORT_JOBS_COLLECTION", "dedupe_key", {"unique": True, "partialFilterExpression": {"active": True}}),
+    ("DB_REPORT_JOBS_COLLECTION", [("status", ASCENDING), ("created_at", ASCENDING)], {}),
+    ("DB_REPORT_JOBS_COLLECTION", "expires_at", {"expireAfterSeconds": 0}),
+    ("DB_ANALYTICS_EXPORTS_COLLECTION", "created_at", {}),
+    ("DB_ANALYTICS_EXPORTS_COLLECTION", "expires_at", {"expireAfterSeconds": 0}),
+    ("DB_TEAM_ACCOUNTS_COLLECTION", "team_username", {"unique": True}),
+    # A team solves each challenge once, wrong submissions are all kept
+    ("DB_SUBMISSIONS_COLLECTION", [("team_id", ASCENDING), ("challenge_id", ASCENDING)], {"unique": True, "partialFilterExpression": {"correct": True}}),
+    ("DB_SUBMISSIONS_COLLECTION", "team_id", {}),
+    ("DB_SUBMISSIONS_COLLECTION", [("competition_id", ASCENDING), ("submitted_at", ASCENDING)], {}),
+    ("DB_HINT_UNLOCKS_COLLECTION", [("team_id", ASCENDING), ("challenge_id", ASCENDING), ("hint_index", ASCENDING)], {"unique": True}),
+    ("DB_HINT_UNLOCKS_COLLECTION", "competition_id", {}),
+    # Loading a competition's scores, and the changes other processes sync
+    ("DB_SCORES_COLLECTION", [("competition_id", ASCENDING), ("updated_at", ASCENDING)], {}),
+    # Tombstones of archived scores only need to outlive every process's next sync
+    ("DB_SCORES_COLLECTION", "archived_at", {"expireAfterSeconds": 24 * 60 * 60}),
+]
+
+# (collection config key, index name) of indexes that were replaced and are dropped where they still exist
+DROPPED_INDEXES = [
+    # Replaced by the (competition_id, ...) indexes
+    ("DB_TEAM_ROSTER_COLLECTION", "teacher_id_1"),
+    ("DB_TEAM_ROSTER_COLLECTION", "is_virtual_1"),
+]
+
+
+def ensure_indexes(db: Database, config) -> None:
+    # Each index is created on its own, so one that fails (a unique index over existing
+    # duplicates, an index that changed options) doesn't keep the others from being created
+    for collection_key, keys, options in INDEXES:
+        options = dict(options)
+        if isinstance(options.get("expireAfterSeconds"), str):
+            # TTLs that are configurable name their config key
+            options["expireAfterSeconds"] = config[options["expireAfterSeconds"]]
+        try:
+            db[config[collection_key]].create_index(keys, **options)
+        except OperationFailure as e:
+            logging.error("Failed to create index %s on %s: %s", keys, config[collection_key], e)
+
+    for collection_key, name in DROPPED_INDEXES:
+        try:
+            db[config[collection_key]].drop_index(name)
+        except OperationFailure:
+            # Already dropped, or never created
+            pass
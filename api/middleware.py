@@ -5,6 +5,7 @@ import jwt
 from jwt.exceptions import ExpiredSignatureError, InvalidTokenError
 from models import UserRole
 from tokens import generate_access_token
+from signed_urls import verify_file_signature
 
 secret_key = os.getenv("SECRET_KEY")
 auth_algorithm = os.getenv("AUTH_ALGORITHM")
@@ -13,6 +14,7 @@ public_paths = [
     "/",
     "/testdb",
     "/auth/login",
+    "/auth/team/login",
     "/accounts/teachers/verify",
     "/accounts/crimson_defense/create",
     "/accounts/teachers/create",
@@ -22,12 +24,13 @@ public_paths = [
 ]
 
 protected_paths = {
-    "/auth/logout": ["admin", "crimson_defense", "teacher"],
+    "/auth/logout": ["admin", "crimson_defense", "teacher", "team"],
     "/accounts/admin/create": ["admin"],
     "/challenges/create": ["crimson_defense", "admin"],
     "/competitions/create": ["admin"],
     "/competitions/<string:competition_id>": ["admin"],
-    "/challenges/get": ["admin","crimson_defense"],
+    "/challenges/get": ["admin", "crimson_defense", "teacher", "team"],
+    "/challenges/details": ["admin", "crimson_defense", "teacher", "team"],
     "/competitions/get/current": ["teacher"],
     "/competitions/get": ["admin"],
     "/challenges/<string:challenge_id>" : ["admin", "crimson_defense"],
@@ -37,9 +40,21 @@ protected_paths = {
     "/teams/<string:team_id>": ["admin", "teacher"],
     "/reports/teams/info/create": ["admin"],
     "/teachers/upload-signed-liability-release-form": ["teacher"],
+    "/teachers/upload-signed-liability-release-forms": ["teacher"],
     "/admin/get-students-to-be-verified": ["admin"],
     "/admin/verify-student/<string:student_id>": ["admin"],
+    "/admin/verify-students": ["admin"],
     "/reports/students/create": ["admin"],
+    "/reports/jobs/*": ["admin"],
+    "/reports/teams/info/csv": ["admin"],
+    "/reports/students/csv": ["admin"],
+    "/reports/students/practice/csv": ["admin"],
+    "/reports/analytics/exports": ["admin"],
+    "/uploads/*": ["admin", "crimson_defense"],
+    "/archive/challenges": ["admin", "crimson_defense"],
+    "/archive/competitions/*": ["admin"],
+    "/archive/files/*": ["admin", "crimson_defense"],
+    "/events/admin": ["admin"],
 }
 
 def path_matches(pattern, path):
@@ -60,6 +75,10 @@ class Middleware:
             if any(path_matches(path, request.path) for path in public_paths) or request.method == "OPTIONS":
                 return self.app(environ, start_response)
 
+            # Signed download URLs carry their own authorization, no cookie needed
+            if path_matches("/files/*", request.path) and verify_file_signature(request.path.rsplit("/", 1)[-1], request.args):
+                return self.app(environ, start_response)
+
             access_token = request.cookies.get("access_token")
             refresh_token = request.cookies.get("refresh_token")
 
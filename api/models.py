@@ -45,11 +45,16 @@ class UserRole(str, Enum):
     admin = "admin"
     crimsonDefense = "crimson_defense"
     teacher = "teacher"
+    team = "team"
 
 class LoginRequest(BaseModel):
     email: str
     password: str
 
+class TeamLoginRequest(BaseModel):
+    team_username: str
+    team_password: str
+
 class CreateCrimsonDefenseRequest(BaseModel):
     email: str
 
@@ -82,11 +87,13 @@ class EmailRequest(BaseModel):
     email_account: str
     subject: str
     message: str
+    html: Optional[str] = None
 
 class EmailWithAttachmentRequest(BaseModel):
     email_account: str
     subject: str
     message: str
+    html: Optional[str] = None
     attachment_content: Optional[str] = None
     attachment_filename: Optional[str] = None
 
@@ -144,8 +151,21 @@ class ForgotPasswordRequest(BaseModel):
 class CreateTeamsReportRequest(BaseModel):
     is_virtual: bool
     email: Optional[str] = None
+    send_email: bool = True
 
 class CreateStudentAccountsReportRequest(BaseModel):
     email: Optional[str] = None
     is_verified: Optional[bool] = True
+    send_email: bool = True
+
+class CreateUploadRequest(BaseModel):
+    filename: str
+    total_size: int
+    content_type: Optional[str] = None
+
 
+class VerifyStudentsRequest(BaseModel):
+    student_ids: List[str]
+
+class SubmitFlagRequest(BaseModel):
+    flag: str
@@ -0,0 +1,180 @@
+import csv
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional
+from flask import Response
+from pymongo.command_cursor import CommandCursor
+from pymongo.cursor import Cursor
+from pymongo.database import Database
+
+# Report rows come straight from cursors over team_roster, or an aggregation that joins each
+# student with their account, so no report holds more than a cursor batch of rows in memory.
+# Reports cover one competition, the filters match the (competition_id, ...) indexes.
+# Rows can be written to a file for report jobs or streamed to the client as CSV.
+
+CSV_CHUNK_CHARS = 64 * 1024  # Rows are sent in chunks of about this size after the header
+CURSOR_BATCH_SIZE = 500
+
+TEAMS_INFO_HEADERS = [
+    "Instructor Information",
+    "Division",
+    "School Name",
+    "Name",
+    "Email",
+    "Contact Number",
+    "Shirt Size",
+    "Student 1 Name",
+    "Student 1 Shirt Size",
+    "Student 1 Email",
+    "Student 2 Name",
+    "Student 2 Shirt Size",
+    "Student 2 Email",
+    "Student 3 Name",
+    "Student 3 Shirt Size",
+    "Student 3 Email",
+    "Student 4 Name",
+    "Student 4 Shirt Size",
+    "Student 4 Email"
+]
+STUDENT_ACCOUNTS_HEADERS = ["name", "email", "password"]
+PRACTICE_ACCOUNTS_HEADERS = ["username", "password"]
+
+
+class _RowBuffer:
+    # csv.writer only needs write(), collecting into a list avoids a StringIO per chunk
+    def __init__(self):
+        self.parts: List[str] = []
+        self.size = 0
+
+    def write(self, value: str) -> None:
+        self.parts.append(value)
+        self.size += len(value)
+
+    def drain(self) -> str:
+        chunk = "".join(self.parts)
+        self.parts.clear()
+        self.size = 0
+        return chunk
+
+
+def iter_csv_chunks(headers: List[str], rows: Iterable[List]) -> Iterator[str]:
+    buffer = _RowBuffer()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    # The header goes out before the first query result, so the download starts right away
+    yield buffer.drain()
+    try:
+        for row in rows:
+            writer.writerow(row)
+            if buffer.size >= CSV_CHUNK_CHARS:
+                yield buffer.drain()
+    except Exception as e:
+        # The status line is already sent, all that can be done is to cut the download short
+        logging.error("Failed to stream report rows: %s", e)
+        raise
+    if buffer.size:
+        yield buffer.drain()
+
+
+def stream_csv_response(filename: str, headers: List[str], rows: Iterable[List]) -> Response:
+    response = Response(iter_csv_chunks(headers, rows), mimetype="text/csv")
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    # Reports contain passwords and contact details
+    response.cache_control.no_store = True
+    # Stop nginx from buffering the whole report before passing it on
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def teams_info_filter(competition_id: Optional[str], is_virtual: bool) -> Dict:
+    return {"competition_id": competition_id, "is_virtual": is_virtual}
+
+
+def teams_info_cursor(db: Database, config, competition_id: Optional[str], is_virtual: bool) -> Cursor:
+    # team_roster already embeds each team's teacher and first students
+    return db[config['DB_TEAM_ROSTER_COLLECTION']].find(
+        teams_info_filter(competition_id, is_virtual),
+        {"name": 1, "division": 1, "teacher": 1, "students": {"$slice": 4}}
+    ).batch_size(CURSOR_BATCH_SIZE)
+
+
+def get_teams_info_row(team: Dict) -> List:
+    teacher = team["teacher"]
+    row = [
+        f"{teacher['first_name']} {teacher['last_name']}",
+        ", ".join(str(d) for d in team["division"]),
+        teacher["school_name"],
+        team["name"],
+        teacher["email"],
+        teacher["contact_number"],
+        teacher["shirt_size"]
+    ]
+
+    # Add student information (up to 4 students)
+    for i in range(4):
+        if i < len(team["students"]):
+            student = team["students"][i]
+            row.extend([
+                f"{student['first_name']} {student['last_name']}",
+                student["shirt_size"],
+                student.get("email", "")
+            ])
+        else:
+            row.extend(["", "", ""])
+    return row
+
+
+def iter_teams_info_rows(db: Database, config, competition_id: Optional[str], is_virtual: bool) -> Iterator[List]:
+    for team in teams_info_cursor(db, config, competition_id, is_virtual):
+        if not team["teacher"]:
+            logging.error(f"Teacher not found for team {team['_id']}")
+            continue
+        yield get_teams_info_row(team)
+
+
+def student_accounts_filter(competition_id: Optional[str], is_verified: bool) -> Dict:
+    return {"competition_id": competition_id, "is_verified": is_verified}
+
+
+def student_accounts_cursor(db: Database, config, competition_id: Optional[str], is_verified: bool) -> CommandCursor:
+    # Students without an account are left out
+    return db[config['DB_STUDENT_INFO_COLLECTION']].aggregate([
+        {"$match": student_accounts_filter(competition_id, is_verified)},
+        {"$lookup": {
+            "from": config['DB_STUDENT_ACCOUNTS_COLLECTION'],
+            "localField": "_id",
+            "foreignField": "student_info_id",
+            "as": "accounts"
+        }},
+        {"$match": {"accounts.0": {"$exists": True}}},
+        {"$project": {
+            "first_name": 1,
+            "last_name": 1,
+            "email": 1,
+            "account": {"$arrayElemAt": ["$accounts", 0]}
+        }},
+    ], batchSize=CURSOR_BATCH_SIZE)
+
+
+def get_student_accounts_row(student: Dict) -> List:
+    return [
+        f"{student['first_name']} {student['last_name']}",
+        student["email"],
+        student["account"]["competition_password"]
+    ]
+
+
+def get_practice_accounts_row(student: Dict) -> List:
+    return [
+        student["account"]["practice_username"],
+        student["account"]["practice_password"]
+    ]
+
+
+def iter_student_accounts_rows(db: Database, config, competition_id: Optional[str], is_verified: bool) -> Iterator[List]:
+    for student in student_accounts_cursor(db, config, competition_id, is_verified):
+        yield get_student_accounts_row(student)
+
+
+def iter_practice_accounts_rows(db: Database, config, competition_id: Optional[str], is_verified: bool) -> Iterator[List]:
+    for student in student_accounts_cursor(db, config, competition_id, is_verified):
+        yield get_practice_accounts_row(student)
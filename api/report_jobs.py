@@ -0,0 +1,359 @@
+import base64
+import csv
+import hashlib
+import io
+import json
+import logging
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+from bson.objectid import ObjectId
+from flask import current_app, request
+from pymongo import ReturnDocument
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+from werkzeug.datastructures import FileStorage
+from attachments import release_attachment, store_upload
+from email_outbox import enqueue_email, run_in_transaction
+from email_templates import render_batch
+from models import EmailRequest, EmailWithAttachmentRequest
+from report_csv import (
+    PRACTICE_ACCOUNTS_HEADERS, STUDENT_ACCOUNTS_HEADERS, TEAMS_INFO_HEADERS, get_practice_accounts_row,
+    get_student_accounts_row, iter_teams_info_rows, student_accounts_cursor, student_accounts_filter, teams_info_filter
+)
+from signed_urls import signed_file_url
+
+# Reports are generated by worker threads instead of the request that asks for them. A request
+# inserts a job into the report_jobs collection and returns its id. Jobs for the same report that
+# are queued or running share one document: a unique index on dedupe_key only covers active jobs,
+# so a second identical request finds the first job and adds its email address to it. Workers
+# claim a job with a lease, record progress while they write the CSVs to temporary files, store
+# them as attachments and queue the emails, if anyone asked for one, in the same transaction that
+# marks the job as succeeded. Reports larger than REPORT_EMAIL_ATTACHMENT_MAX_BYTES are emailed as
+# a signed download link instead, outbox documents and email providers can't hold them.
+
+REPORT_SPOOL_BYTES = 8 * 1024 * 1024
+
+ProgressCallback = Callable[[int, int], None]
+# (filename, report name used in the email, CSV file)
+ReportArtifact = Tuple[str, str, BinaryIO]
+
+
+class ReportError(Exception):
+    # A report that can't be generated from the current data, shown to the admin as the job's error
+    pass
+
+
+def _new_report_file() -> io.TextIOWrapper:
+    # Reports are written to disk once they outgrow memory, then stored from there
+    return io.TextIOWrapper(tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_BYTES), encoding="utf-8", newline="")
+
+
+def _finish_report_file(text_file: io.TextIOWrapper) -> BinaryIO:
+    text_file.flush()
+    file = text_file.detach()
+    file.seek(0)
+    return file
+
+
+def build_teams_info_report(db: Database, config, params: Dict, progress: ProgressCallback) -> List[ReportArtifact]:
+    report_is_for_virtual_teams = params["is_virtual"]
+    # Jobs queued before reports were scoped have no competition
+    competition_id = params.get("competition_id")
+    report_type = "Virtual" if report_is_for_virtual_teams else "In-Person"
+
+    total = db[config['DB_TEAM_ROSTER_COLLECTION']].count_documents(teams_info_filter(competition_id, report_is_for_virtual_teams))
+    if not total:
+        raise ReportError(f"Did not find any {report_type} teams in the database")
+
+    text_file = _new_report_file()
+    writer = csv.writer(text_file)
+    writer.writerow(TEAMS_INFO_HEADERS)
+    rows = 0
+    for rows, row in enumerate(iter_teams_info_rows(db, config, competition_id, report_is_for_virtual_teams), start=1):
+        writer.writerow(row)
+        progress(rows, total)
+    progress(total, total)
+
+    if not rows:
+        raise ReportError("No valid team data could be processed for the report.")
+
+    return [(f"{report_type}_teams_report.csv", f"{report_type} Teams Report", _finish_report_file(text_file))]
+
+
+def build_student_accounts_report(db: Database, config, params: Dict, progress: ProgressCallback) -> List[ReportArtifact]:
+    student_verification_type = params["is_verified"]
+    competition_id = params.get("competition_id")
+
+    total = db[config['DB_STUDENT_INFO_COLLECTION']].count_documents(student_accounts_filter(competition_id, student_verification_type))
+    if not total:
+        raise ReportError("Could not find students of requested verification status")
+
+    text_file = _new_report_file()
+    practice_text_file = _new_report_file()
+    writer = csv.writer(text_file)
+    practice_writer = csv.writer(practice_text_file)
+    writer.writerow(STUDENT_ACCOUNTS_HEADERS)
+    practice_writer.writerow(PRACTICE_ACCOUNTS_HEADERS)
+
+    # Both files are written from one pass over the students
+    rows = 0
+    for rows, student in enumerate(student_accounts_cursor(db, config, competition_id, student_verification_type), start=1):
+        writer.writerow(get_student_accounts_row(student))
+        practice_writer.writerow(get_practice_accounts_row(student))
+        progress(rows, total)
+    progress(total, total)
+
+    if not rows:
+        raise ReportError("No valid student accounts could be processed for the report.")
+
+    report_type = "Verified" if student_verification_type else "Unverified"
+    return [
+        (f"{report_type}_student_accounts_report.csv", f"{report_type} Student Accounts Report", _finish_report_file(text_file)),
+        ("practice_student_accounts_report.csv", "Practice Accounts Report", _finish_report_file(practice_text_file)),
+    ]
+
+
+REPORT_BUILDERS: Dict[str, Callable[[Database, object, Dict, ProgressCallback], List[ReportArtifact]]] = {
+    "teams_info": build_teams_info_report,
+    "student_accounts": build_student_accounts_report,
+}
+
+
+def get_dedupe_key(kind: str, params: Dict) -> str:
+    return hashlib.sha256(json.dumps({"kind": kind, "params": params}, sort_keys=True).encode()).hexdigest()
+
+
+def submit_report_job(db: Database, kind: str, params: Dict, email_account: Optional[str],
+                      requested_by: Optional[str]) -> Tuple[ObjectId, bool]:
+    # Returns the job id and whether an identical active job was reused
+    jobs_collection = db[current_app.config['DB_REPORT_JOBS_COLLECTION']]
+    dedupe_key = get_dedupe_key(kind, params)
+    email_accounts = [email_account] if email_account else []
+
+    while True:
+        now = datetime.now()
+        try:
+            inserted_id = jobs_collection.insert_one({
+                "kind": kind,
+                "params": params,
+                "dedupe_key": dedupe_key,
+                "active": True,
+                "status": "queued",
+                "progress": {"done": 0, "total": None},
+                "email_accounts": email_accounts,
+                "requested_by": requested_by,
+                # Emailed download links point back at the API the job was requested from
+                "download_base_url": request.host_url,
+                "artifacts": [],
+                "artifact_file_ids": [],
+                "error": None,
+                "attempts": 0,
+                "locked_until": None,
+                "created_at": now,
+                "started_at": None,
+                "finished_at": None,
+                "expires_at": None,
+            }).inserted_id
+            return inserted_id, False
+        except DuplicateKeyError:
+            pass
+
+        active_job_filter = {"dedupe_key": dedupe_key, "active": True}
+        if email_accounts:
+            existing_job = jobs_collection.find_one_and_update(active_job_filter, {"$addToSet": {"email_accounts": {"$each": email_accounts}}})
+        else:
+            existing_job = jobs_collection.find_one(active_job_filter, {"_id": 1})
+        if existing_job is not None:
+            return existing_job["_id"], True
+        # The job finished between the insert and the lookup, so queue a new one
+
+
+def claim_report_job(db: Database, config) -> Optional[Dict]:
+    now = datetime.now()
+    return db[config['DB_REPORT_JOBS_COLLECTION']].find_one_and_update(
+        {
+            "$or": [
+                {"status": "queued"},
+                # The worker that claimed it stopped before finishing
+                {"status": "running", "locked_until": {"$lt": now}},
+            ]
+        },
+        {
+            "$set": {
+                "status": "running",
+                "started_at": now,
+                "locked_until": now + timedelta(seconds=config['REPORT_JOB_LEASE_SECONDS'])
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def _finish_job(jobs_collection, job: Dict, update: Dict, session=None) -> Optional[Dict]:
+    now = datetime.now()
+    update.update({
+        "finished_at": now,
+        "locked_until": None,
+        "expires_at": now + timedelta(seconds=current_app.config['REPORT_JOB_RETENTION_SECONDS'])
+    })
+    # Clearing active lets identical requests queue a fresh job from here on. Returns None if
+    # the lease ran out and another worker finished the job first.
+    return jobs_collection.find_one_and_update(
+        {"_id": job["_id"], "status": "running"},
+        {"$set": update, "$unset": {"active": ""}},
+        session=session,
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def run_report_job(db: Database, config, job: Dict) -> None:
+    jobs_collection = db[config['DB_REPORT_JOBS_COLLECTION']]
+    last_progress_at = 0.0
+
+    def progress(done: int, total: int) -> None:
+        # Written at most once a second, renewing the lease each time
+        nonlocal last_progress_at
+        if done < total and time.monotonic() - last_progress_at < 1:
+            return
+        last_progress_at = time.monotonic()
+        jobs_collection.update_one(
+            {"_id": job["_id"], "status": "running"},
+            {"$set": {
+                "progress": {"done": done, "total": total},
+                "locked_until": datetime.now() + timedelta(seconds=config['REPORT_JOB_LEASE_SECONDS'])
+            }}
+        )
+
+    if job["attempts"] > config['REPORT_JOB_MAX_ATTEMPTS']:
+        _finish_job(jobs_collection, job, {"status": "failed", "error": "The report job was interrupted too many times."})
+        return
+
+    try:
+        artifacts = REPORT_BUILDERS[job["kind"]](db, config, job["params"], progress)
+    except ReportError as e:
+        _finish_job(jobs_collection, job, {"status": "failed", "error": str(e)})
+        return
+    except Exception as e:
+        logging.error("Report job %s failed: %s", job["_id"], e)
+        _finish_job(jobs_collection, job, {"status": "failed", "error": "Internal Server Error. Check server logs for details."})
+        return
+
+    stored_artifacts: List[Dict] = []
+    try:
+        for filename, _, file in artifacts:
+            stored_artifacts.append({
+                "file_id": store_upload(db, FileStorage(stream=file, filename=filename, content_type="text/csv"), None),
+                "filename": filename,
+            })
+
+        # The job only shows as succeeded together with the emails that deliver it
+        def complete(session) -> Optional[Dict]:
+            finished_job = _finish_job(jobs_collection, job, {
+                "status": "succeeded",
+                "artifacts": stored_artifacts,
+                "artifact_file_ids": [artifact["file_id"] for artifact in stored_artifacts],
+            }, session=session)
+            if finished_job is None or not finished_job["email_accounts"]:
+                return finished_job
+            emails = _get_emails(config, finished_job, artifacts, stored_artifacts)
+            # Includes addresses added by requests that were deduplicated onto this job while it ran
+            for email_account in finished_job["email_accounts"]:
+                for email in emails:
+                    enqueue_email(db, email.model_copy(update={"email_account": email_account}), session=session)
+            return finished_job
+
+        if run_in_transaction(current_app.client, complete) is None:
+            # Another worker finished the job after this one's lease ran out
+            _release_artifacts(db, stored_artifacts)
+    except Exception as e:
+        logging.error("Report job %s failed while storing or emailing its files: %s", job["_id"], e)
+        # Without transaction support the job may already show as succeeded with these files
+        if _finish_job(jobs_collection, job, {"status": "failed", "error": "Internal Server Error. Check server logs for details."}) is not None:
+            _release_artifacts(db, stored_artifacts)
+    finally:
+        for _, _, file in artifacts:
+            file.close()
+
+
+def _release_artifacts(db: Database, stored_artifacts: List[Dict]) -> None:
+    for artifact in stored_artifacts:
+        try:
+            release_attachment(db, artifact["file_id"])
+        except Exception as e:
+            logging.error("Failed to release report file %s: %s", artifact["file_id"], e)
+
+
+def _get_emails(config, job: Dict, artifacts: List[ReportArtifact],
+                stored_artifacts: List[Dict]) -> List[Union[EmailRequest, EmailWithAttachmentRequest]]:
+    # One email per artifact, addressed when they are queued. Small reports are attached, larger
+    # ones are linked, the link lasts as long as the job keeps its files.
+    attached: List[Tuple[str, str, BinaryIO]] = []
+    linked: List[Tuple[str, str, ObjectId]] = []
+    for (filename, report_name, file), stored_artifact in zip(artifacts, stored_artifacts):
+        file.seek(0, io.SEEK_END)
+        if file.tell() > config['REPORT_EMAIL_ATTACHMENT_MAX_BYTES'] and job.get("download_base_url"):
+            linked.append((filename, report_name, stored_artifact["file_id"]))
+        else:
+            attached.append((filename, report_name, file))
+
+    emails: List[Union[EmailRequest, EmailWithAttachmentRequest]] = []
+    rendered = render_batch("report", [{"report_name": report_name} for _, report_name, _ in attached])
+    for (filename, _, file), email in zip(attached, rendered):
+        file.seek(0)
+        emails.append(EmailWithAttachmentRequest(
+            email_account="",
+            subject=email["subject"],
+            message=email["text"],
+            html=email["html"],
+            attachment_content=base64.b64encode(file.read()).decode(),
+            attachment_filename=filename
+        ))
+
+    if linked:
+        # Workers have no request to build external URLs from, so use the one that queued the job
+        with current_app.test_request_context(base_url=job["download_base_url"]):
+            contexts = [
+                {
+                    "report_name": report_name,
+                    "download_url": signed_file_url(file_id, sensitive=True, ttl=config['REPORT_JOB_RETENTION_SECONDS']),
+                }
+                for _, report_name, file_id in linked
+            ]
+        for email in render_batch("report_link", contexts):
+            emails.append(EmailRequest(email_account="", subject=email["subject"], message=email["text"], html=email["html"]))
+    return emails
+
+
+def run_pending_report_jobs(db: Database, config) -> int:
+    completed = 0
+    while True:
+        job = claim_report_job(db, config)
+        if job is None:
+            return completed
+        run_report_job(db, config, job)
+        completed += 1
+
+
+def start_report_workers(app) -> None:
+    threads = app.config['REPORT_WORKER_THREADS']
+    if threads <= 0:
+        return
+
+    def run() -> None:
+        stop = threading.Event()
+        with app.app_context():
+            db = app.client[app.config['DB_NAME']]
+            while True:
+                try:
+                    run_pending_report_jobs(db, app.config)
+                except Exception as e:
+                    logging.error("Report worker failed: %s", e)
+                stop.wait(app.config['REPORT_POLL_INTERVAL_SECONDS'])
+
+    for index in range(threads):
+        threading.Thread(target=run, name=f"report-worker-{index}", daemon=True).start()
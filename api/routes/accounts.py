@@ -8,7 +8,9 @@ from models import CreateAdminRequest, CreateCrimsonDefenseRequest, CreateTeache
 import http_status_codes as status
 from bson.objectid import ObjectId
 from passwords import generate_password, bcrypt_hash_password, bcrypt_verify_password
-from emails import send_email_to_user
+from email_outbox import enqueue_email, run_in_transaction
+from email_templates import render_email
+from competition_scope import get_active_competition_id
 
 #TODO: Remove routes being public and Modify to work with middleware once it is complete
 
@@ -50,57 +52,51 @@ def create_teacher_account() -> Tuple[Response, int]:
         # Log the unsalted password for testing purposes
         logging.info(f"Generated unsalted password for testing: {password}")
 
+        email = render_email("account_created", {
+            "name": f"{teacher_first_name} {teacher_last_name}",
+            "email": teacher_email,
+            "password": password
+        })
         email_request = EmailRequest(
                 email_account=teacher_email,
-                subject="UA CTF Account Details",
-                message=f"""
-        Dear {teacher_first_name} {teacher_last_name},
-
-        Your account has been successfully created. Here are your login credentials:
-
-        Email: {teacher_email}
-        Password: {password}
-
-        Best regards,
-        The Team
-                """.strip()
+                subject=email["subject"],
+                message=email["text"],
+                html=email["html"]
             )
 
-        email_attempt_successful = send_email_to_user(email_request)
-        if not email_attempt_successful:
-            logging.error(f"Failed to send welcome email to {teacher_email}")
-            return jsonify({"error": "Could not send email to the teacher"}), status.INTERNAL_SERVER_ERROR
-
         teacher_account_dict = {
-            "competition_id": None,  # Assuming the competition ID is not provided in this route
+            # The competition the teacher signed up for, their teams are tagged separately each year
+            "competition_id": get_active_competition_id(client[db_name], current_app.config),
             "email": teacher_email,
             "password": hashed_password,  # Store the salted and hashed password
             "role": "teacher",
         }
 
-        # Insert the account into the Accounts collection and get the new account's ID
-        account_id = client[db_name][db_accounts_collection].insert_one(teacher_account_dict).inserted_id
-
-        if account_id is None:
-            return jsonify({"content": "Could not find teacher in the database."}), status.NOT_FOUND
-
-        # Prepare teacher info dictionary
-        teacher_info_dict = {
-            "account_id": account_id,
-            "first_name": teacher_first_name,
-            "last_name": teacher_last_name,
-            "email": teacher_email,
-            "created_at": create_teacher_dict['created_at'],
-            "school_name": create_teacher_dict["school_name"],
-            "school_address": create_teacher_dict["school_address"],
-            "school_website": create_teacher_dict["school_website"],
-            "contact_number": create_teacher_dict["contact_number"],
-            "shirt_size": create_teacher_dict["shirt_size"],
-        }
-
-        # Insert the teacher info into the TeacherInfo collection
-        client[db_name][db_teacher_info_collection].insert_one(teacher_info_dict)
-
+        # The account, its info and the welcome email are committed together
+        def create_teacher(session) -> ObjectId:
+            # Insert the account into the Accounts collection and get the new account's ID
+            account_id = client[db_name][db_accounts_collection].insert_one(teacher_account_dict, session=session).inserted_id
+
+            # Prepare teacher info dictionary
+            teacher_info_dict = {
+                "account_id": account_id,
+                "first_name": teacher_first_name,
+                "last_name": teacher_last_name,
+                "email": teacher_email,
+                "created_at": create_teacher_dict['created_at'],
+                "school_name": create_teacher_dict["school_name"],
+                "school_address": create_teacher_dict["school_address"],
+                "school_website": create_teacher_dict["school_website"],
+                "contact_number": create_teacher_dict["contact_number"],
+                "shirt_size": create_teacher_dict["shirt_size"],
+            }
+
+            # Insert the teacher info into the TeacherInfo collection
+            client[db_name][db_teacher_info_collection].insert_one(teacher_info_dict, session=session)
+            enqueue_email(client[db_name], email_request, session=session)
+            return account_id
+
+        account_id = run_in_transaction(client, create_teacher)
 
         # Return success response
         return jsonify({
@@ -188,31 +184,27 @@ def create_crimson_defense_account() -> Tuple[Response, int]:
             "role": "crimson_defense",
         }
 
-        # Insert the account into the Accounts collection and get the new account's ID
-        response = client[db_name][db_accounts_collection].insert_one(crimson_defense_account_dict)
-
-        if response.inserted_id is None:
-            return jsonify({"error": "Registration failed"}), status.INTERNAL_SERVER_ERROR
-
+        email = render_email("account_created", {
+            "name": "Crimson Defense Member",
+            "email": crimson_defense_email,
+            "password": password
+        })
         email_request = EmailRequest(
             email_account=crimson_defense_email,
-            subject="UA CTF Account Details",
-            message=f"""
-Dear Crimson Defense Member,
+            subject=email["subject"],
+            message=email["text"],
+            html=email["html"]
+        )
 
-Your account has been successfully created. Here are your login credentials:
-Email: {crimson_defense_email}
-Password: {password}
+        # Insert the account into the Accounts collection and queue its welcome email together
+        def create_crimson_defense(session) -> ObjectId:
+            inserted_id = client[db_name][db_accounts_collection].insert_one(crimson_defense_account_dict, session=session).inserted_id
+            enqueue_email(client[db_name], email_request, session=session)
+            return inserted_id
 
-Best regards,
-The Team
-            """.strip()
-        )
+        if run_in_transaction(client, create_crimson_defense) is None:
+            return jsonify({"error": "Registration failed"}), status.INTERNAL_SERVER_ERROR
 
-        email_attempt_successful = send_email_to_user(email_request)
-        if not email_attempt_successful:
-            logging.error(f"Failed to send welcome email to {crimson_defense_email}")
-            return jsonify({"error": "Could not send email to the Crimson Defense member"}), status.INTERNAL_SERVER_ERROR
         # Return success response
         return jsonify({
             "content": "Created account successfully!",
@@ -259,32 +251,26 @@ def create_admin_account() -> Tuple[Response, int]:
             "role": "admin",
         }
 
-        # Insert the account into the Accounts collection and get the new account's ID
-        response = client[db_name][db_accounts_collection].insert_one(admin_dict)
-
-        if response.inserted_id is None:
-            return jsonify({"error": "Registration failed"}), status.INTERNAL_SERVER_ERROR
-
+        email = render_email("account_created", {
+            "name": "Administrator",
+            "email": admin_email,
+            "password": password
+        })
         email_request = EmailRequest(
             email_account=admin_email,
-            subject="UA CTF Account Details",
-            message=f"""
-Dear Administrator,
-
-Your account has been successfully created. Here are your login credentials:
-Email: {admin_email}
-Password: {password}
-
-
-Best regards,
-The Team
-            """.strip()
+            subject=email["subject"],
+            message=email["text"],
+            html=email["html"]
         )
 
-        email_attempt_successful = send_email_to_user(email_request)
-        if not email_attempt_successful:
-            logging.error(f"Failed to send welcome email to {admin_email}")
-            return jsonify({"error": "Could not send email to the administrator"}), status.INTERNAL_SERVER_ERROR
+        # Insert the account into the Accounts collection and queue its welcome email together
+        def create_admin(session) -> ObjectId:
+            inserted_id = client[db_name][db_accounts_collection].insert_one(admin_dict, session=session).inserted_id
+            enqueue_email(client[db_name], email_request, session=session)
+            return inserted_id
+
+        if run_in_transaction(client, create_admin) is None:
+            return jsonify({"error": "Registration failed"}), status.INTERNAL_SERVER_ERROR
 
         # Return success response
         return jsonify({
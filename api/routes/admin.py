@@ -6,7 +6,11 @@ from datetime import date, datetime
 from pydantic import ValidationError
 from bson.objectid import ObjectId
 import logging
-from models import GetAllTeachersResponse, StudentInfoResponse, TeacherInfo
+from signed_urls import signed_file_url
+from models import VerifyStudentsRequest
+from team_roster import update_roster_students
+from competition_scope import NoActiveCompetition, get_requested_competition_id
+from events import publish_event
 
 admin_blueprint = Blueprint("admin", __name__)
 
@@ -22,9 +26,10 @@ def get_students_to_be_verified() -> Tuple[Response, int]:
     try:
         db = client[db_name]
         student_collection = db[db_students_collection]
+        competition_id = get_requested_competition_id(db, current_app.config)
         students = []
 
-        for document in student_collection.find({"is_verified": False, "liability_form_id": {"$exists": True, "$ne": None }}):
+        for document in student_collection.find({"competition_id": competition_id, "is_verified": False, "liability_form_id": {"$ne": None}}):
             print(document)
             student = {
                 "id": str(document["_id"]),
@@ -33,16 +38,16 @@ def get_students_to_be_verified() -> Tuple[Response, int]:
                 "last_name": document["last_name"],
                 "email": document["email"],
                 "shirt_size": document["shirt_size"],
-                "signed_liability_release_form": url_for('files.download_file', file_id=document["liability_form_id"], _external=True),
+                "signed_liability_release_form": signed_file_url(document["liability_form_id"], sensitive=True),
                 "is_verified": document["is_verified"]
             }
-
-            validated_student: StudentInfoResponse = StudentInfoResponse.model_validate(student)
-            student_dict = validated_student.model_dump()
-            students.append(student_dict)
+            students.append(student)
 
         return jsonify({"content": "Successfully fetched students.", "students": students}), status.OK
 
+    except NoActiveCompetition:
+        return jsonify({"content": "Successfully fetched students.", "students": []}), status.OK
+
     except WriteError as e:
           logging.error("WriteError: %s", e)
           return jsonify({'error': 'An error occurred while reading from the database.'}), status.INTERNAL_SERVER_ERROR
@@ -76,8 +81,10 @@ def verify_student(student_id) -> Tuple[Response, int]:
                 {"_id": ObjectId(student["_id"])},
                 {"$set": {"is_verified": True}}
             )
+            update_roster_students(db, current_app.config, {student["_id"]: {"is_verified": True}})
 
             if update_attempt.modified_count == 1:
+                publish_event(db, current_app.config, "admin", "students_verified", {"student_ids": [student_id]})
                 return jsonify({"content": "Successfully uploaded signed form!"}), status.OK
             else:
                 return jsonify({"warning": "No changes were made!"}), status.OK
@@ -100,4 +107,91 @@ def verify_student(student_id) -> Tuple[Response, int]:
 
     
 
-    
\ No newline at end of file
+    
+
+
+@admin_blueprint.route('/admin/verify-students', methods=["POST"])
+def verify_students() -> Tuple[Response, int]:
+    try:
+        db = client[db_name]
+        student_collection = db[db_students_collection]
+
+        verify_students_request: VerifyStudentsRequest = VerifyStudentsRequest.model_validate_json(request.data)
+        student_ids = list(dict.fromkeys(verify_students_request.student_ids))
+
+        invalid_ids = [student_id for student_id in student_ids if not ObjectId.is_valid(student_id)]
+        if invalid_ids:
+            return jsonify({"error": "Invalid student ids.", "student_ids": invalid_ids}), status.BAD_REQUEST
+
+        verified_ids = []
+        already_verified_ids = []
+        missing_form_ids = []
+        found_ids = set()
+        for document in student_collection.find(
+            {"_id": {"$in": [ObjectId(student_id) for student_id in student_ids]}},
+            {"is_verified": 1, "liability_form_id": 1}
+        ):
+            found_ids.add(str(document["_id"]))
+            if document.get("liability_form_id") is None:
+                missing_form_ids.append(str(document["_id"]))
+            elif document.get("is_verified") == True:
+                already_verified_ids.append(str(document["_id"]))
+            else:
+                verified_ids.append(str(document["_id"]))
+        not_found_ids = [student_id for student_id in student_ids if student_id not in found_ids]
+
+        if verified_ids:
+            # The form precondition is part of the filter, so a student whose form is
+            # removed after the read above is never verified
+            update_attempt = student_collection.update_many(
+                {
+                    "_id": {"$in": [ObjectId(student_id) for student_id in verified_ids]},
+                    "is_verified": {"$ne": True},
+                    "liability_form_id": {"$exists": True, "$ne": None}
+                },
+                {"$set": {"is_verified": True}}
+            )
+
+            if update_attempt.modified_count != len(verified_ids):
+                # Some students changed in between, report where they ended up
+                candidate_ids = verified_ids
+                verified_ids = []
+                found_ids = set()
+                for document in student_collection.find(
+                    {"_id": {"$in": [ObjectId(student_id) for student_id in candidate_ids]}},
+                    {"is_verified": 1, "liability_form_id": 1}
+                ):
+                    found_ids.add(str(document["_id"]))
+                    if document.get("liability_form_id") is None:
+                        missing_form_ids.append(str(document["_id"]))
+                    else:
+                        verified_ids.append(str(document["_id"]))
+                not_found_ids += [student_id for student_id in candidate_ids if student_id not in found_ids]
+
+            update_roster_students(db, current_app.config, {ObjectId(student_id): {"is_verified": True} for student_id in verified_ids})
+            if verified_ids:
+                publish_event(db, current_app.config, "admin", "students_verified", {"student_ids": verified_ids})
+
+        return jsonify({
+            "content": f"Verified {len(verified_ids)} students.",
+            "verified": verified_ids,
+            "already_verified": already_verified_ids,
+            "missing_form": missing_form_ids,
+            "not_found": not_found_ids,
+        }), status.OK
+
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), status.BAD_REQUEST
+
+    except WriteError as e:
+          logging.error("WriteError: %s", e)
+          return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+
+    return jsonify({"content": "Error verifying students."}), status.INTERNAL_SERVER_ERROR
@@ -0,0 +1,131 @@
+from flask import Blueprint, jsonify, Response, request, current_app, url_for
+from typing import Dict, List, Tuple
+import http_status_codes as status
+from pymongo.errors import OperationFailure
+from datetime import datetime
+from bson.objectid import ObjectId
+import logging
+from archive import get_archive_db, get_archive_storage
+from storage import FileNotFound
+from routes.files import accepts_stored_encoding, get_file_metadata, stream_decompressed_file, stream_stored_file
+
+# Read-only access to archived competitions and challenges. Nothing here writes, restoring
+# goes through the restore commands.
+
+archive_blueprint = Blueprint("archive", __name__)
+
+client = current_app.client
+archive_db = get_archive_db(client, current_app.config)
+archive_storage = get_archive_storage(archive_db)
+
+db_teams_collection: str = current_app.config['DB_TEAMS_COLLECTION']
+db_students_collection: str = current_app.config['DB_STUDENT_INFO_COLLECTION']
+db_challenges_collection: str = current_app.config['DB_CHALLENGES_COLLECTION']
+
+
+def archived_file_url(file_id) -> str:
+    return url_for("archive.download_archived_file", file_id=str(file_id))
+
+
+@archive_blueprint.route('/archive/competitions/<string:competition_id>/teams', methods=["GET"])
+def get_archived_teams(competition_id: str) -> Tuple[Response, int]:
+    try:
+        teams = list(archive_db[db_teams_collection].find({"competition_id": competition_id}))
+        students_by_team: Dict[ObjectId, List[Dict]] = {team["_id"]: [] for team in teams}
+        for student in archive_db[db_students_collection].find({"team_id": {"$in": list(students_by_team)}}).sort("_id", 1):
+            students_by_team[student["team_id"]].append({
+                "id": str(student["_id"]),
+                "student_account_id": student["student_account_id"],
+                "first_name": student["first_name"],
+                "last_name": student["last_name"],
+                "email": student.get("email"),
+                "shirt_size": student["shirt_size"],
+                "signed_liability_release_form": archived_file_url(student["liability_form_id"]) if student.get("liability_form_id") else None,
+                "is_verified": student["is_verified"],
+            })
+
+        return jsonify({
+            "content": "Successfully fetched archived teams.",
+            "teams": [
+                {
+                    "id": str(team["_id"]),
+                    "teacher_id": team["teacher_id"],
+                    "competition_id": team["competition_id"],
+                    "name": team["name"],
+                    "division": team["division"],
+                    "is_virtual": team["is_virtual"],
+                    "students": students_by_team[team["_id"]],
+                }
+                for team in teams
+            ]
+        }), status.OK
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error getting archived teams."}), status.INTERNAL_SERVER_ERROR
+
+
+@archive_blueprint.route('/archive/challenges', methods=["GET"])
+def get_archived_challenges() -> Tuple[Response, int]:
+    try:
+        if not request.args.get("year", "").isdigit():
+            return jsonify({"error": "year parameter is required."}), status.BAD_REQUEST
+        year = int(request.args["year"])
+
+        query: Dict = {"created_at": {"$gte": datetime(year, 1, 1), "$lt": datetime(year + 1, 1, 1)}}
+        if 'division' in request.args:
+            if not request.args['division'].isdigit():
+                return jsonify({'error': 'Division parameter provided in request was not an int.'}), status.BAD_REQUEST
+            query["division"] = int(request.args['division'])
+
+        challenges = [
+            {
+                "challenge_id": str(document["_id"]),
+                "challenge_name": document["challenge_name"],
+                "challenge_category": document["challenge_category"],
+                "points": document["points"],
+                "challenge_description": document["challenge_description"],
+                "division": document["division"],
+                "challenge_file_attachment": archived_file_url(document["challenge_file_attachment_id"]) if document.get("challenge_file_attachment_id") else None,
+            }
+            for document in archive_db[db_challenges_collection].find(query).sort("_id", 1)
+        ]
+        return jsonify({"content": "Successfully fetched archived challenges.", "challenges": challenges}), status.OK
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error getting archived challenges."}), status.INTERNAL_SERVER_ERROR
+
+
+@archive_blueprint.route('/archive/files/<file_id>', methods=["GET"])
+def download_archived_file(file_id: str):
+    try:
+        if not ObjectId.is_valid(file_id):
+            return jsonify({"error": "File not found"}), status.NOT_FOUND
+
+        # Archived files are rarely read, so they are streamed without the disk cache
+        file = archive_storage.open(ObjectId(file_id))
+        metadata = get_file_metadata(file)
+        if not accepts_stored_encoding(metadata):
+            response = stream_decompressed_file(file, metadata)
+        else:
+            response = stream_stored_file(file, metadata)
+        if metadata.get("encoding"):
+            response.vary.add("Accept-Encoding")
+        response.cache_control.private = True
+        return response
+
+    except FileNotFound:
+        return jsonify({"error": "File not found"}), status.NOT_FOUND
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error getting archived file."}), status.INTERNAL_SERVER_ERROR
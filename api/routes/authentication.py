@@ -1,3 +1,4 @@
+import hmac
 import logging
 import os
 from tokens import generate_tokens
@@ -5,9 +6,10 @@ from flask import Blueprint, Response, current_app, request, jsonify
 from pydantic import ValidationError
 from typing import Dict, Tuple
 import http_status_codes as status
-from emails import send_email_to_user
+from email_outbox import enqueue_email, run_in_transaction
+from email_templates import render_email
 from bson.objectid import ObjectId
-from models import LoginRequest, EmailRequest, ForgotPasswordRequest
+from models import LoginRequest, TeamLoginRequest, EmailRequest, ForgotPasswordRequest
 from pymongo.errors import WriteError, OperationFailure
 from passwords import generate_password, bcrypt_hash_password, bcrypt_verify_password
 from middleware import is_token_valid, decode_token
@@ -20,6 +22,7 @@ client = current_app.client
 uri = current_app.uri
 db_name = current_app.config['DB_NAME']
 db_accounts_collection = current_app.config['DB_ACCOUNTS_COLLECTION']
+db_team_accounts_collection = current_app.config['DB_TEAM_ACCOUNTS_COLLECTION']
 
 @auth_blueprint.route('/auth/login', methods=['POST'])
 def login() -> Tuple[Response, int]:
@@ -67,6 +70,48 @@ def login() -> Tuple[Response, int]:
 
     return jsonify({"error": "Error logging in the user."}), status.INTERNAL_SERVER_ERROR
 
+@auth_blueprint.route('/auth/team/login', methods=['POST'])
+def team_login() -> Tuple[Response, int]:
+    try:
+        team_login_request: TeamLoginRequest = TeamLoginRequest.model_validate_json(request.data)
+
+        db = client[db_name]
+        team_account = db[db_team_accounts_collection].find_one({"team_username": team_login_request.team_username})
+
+        # Team passwords are generated and handed out to the team, they are stored as issued
+        if not team_account or not hmac.compare_digest(team_login_request.team_password.encode(), team_account['team_password'].encode()):
+            return jsonify({"error": "Invalid team username or password"}), status.UNAUTHORIZED
+
+        # Team tokens carry the team's id, which flag submissions are recorded against
+        try:
+            access_token, refresh_token = generate_tokens(str(team_account['team_id']), "team")
+        except Exception as e:
+            logging.error("Error generating tokens: %s", e)
+            return jsonify({"error": "Error generating tokens"}), status.INTERNAL_SERVER_ERROR
+
+        response = jsonify({
+            "message": "Logged in successfully",
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "role": "team"
+        })
+        response.set_cookie("access_token", value=access_token, httponly=True, domain='localhost', samesite='None', path='/', secure=True)
+        response.set_cookie("refresh_token", value=refresh_token, httponly=True, domain='localhost', samesite='None', path='/', secure=True)
+
+        return response, status.OK
+    except ValidationError as e:
+        logging.error("ValidationError: %s", e)
+        return jsonify({"error": "Invalid input data"}), status.BAD_REQUEST
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+
+    return jsonify({"error": "Error logging in the team."}), status.INTERNAL_SERVER_ERROR
+
 @auth_blueprint.route('/auth/role', methods=['GET'])
 def get_role()-> Tuple[Response, int]:
     if request.method != "GET":
@@ -102,37 +147,32 @@ def forgot_password() -> Tuple[Response, int]:
         logging.info(f"Generated unsalted password for testing: {new_password}")
 
         new_hashed_password = bcrypt_hash_password(new_password)
-        change_password_attempt = db[db_accounts_collection].update_one(
-                {"_id": ObjectId(existing_user["_id"])},
-                {"$set":{"password": new_hashed_password}}
-                )
-
-        if change_password_attempt.modified_count!=1:
-            logging.error("MongoDB error while setting new generated password")
-            return jsonify({"content": "If this user exists, we have sent you a password reset email."}), status.OK
-
 
+        email = render_email("password_reset", {"email": email_account, "password": new_password})
         email_request = EmailRequest(
                 email_account=email_account,
-                subject="UA CTF Password Reset",
-                message=f"""
-        Dear User,
-
-        Your password has been reset as requested. Here are your new login credentials:
-
-        Email: {email_account}
-        Password: {new_password}
-
-        Best regards,
-        The Team
-                """.strip()
+                subject=email["subject"],
+                message=email["text"],
+                html=email["html"]
             )
 
-        email_attempt_successful = send_email_to_user(email_request)
-        if not email_attempt_successful:
-            logging.error(f"Failed to send welcome email to {email_account}")
+        # The new password only takes effect together with the email that delivers it
+        def reset_password(session) -> bool:
+            change_password_attempt = db[db_accounts_collection].update_one(
+                    {"_id": ObjectId(existing_user["_id"])},
+                    {"$set":{"password": new_hashed_password}},
+                    session=session
+                    )
+            if change_password_attempt.modified_count!=1:
+                return False
+            enqueue_email(db, email_request, session=session)
+            return True
+
+        if not run_in_transaction(client, reset_password):
+            logging.error("MongoDB error while setting new generated password")
             return jsonify({"content": "If this user exists, we have sent you a password reset email."}), status.OK
-        logging.info("Successfully reset password and sent to the user!")
+
+        logging.info("Successfully reset password and queued the email to the user!")
         return jsonify({"content": "If this user exists, we have sent you a password reset email."}), status.OK
 
     except ValidationError as e:
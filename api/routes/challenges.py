@@ -2,14 +2,22 @@ from os import stat
 from flask import Blueprint, json, jsonify, Response, request, current_app, url_for
 from typing import Dict, Optional, Tuple
 import http_status_codes as status
-from pymongo.errors import WriteError, OperationFailure
+from pymongo.errors import WriteError, OperationFailure, DuplicateKeyError
 from datetime import datetime
 from pydantic import ValidationError
 from bson.objectid import ObjectId
 import logging
-from models import CreateChallengeRequest, ListChallengeResponse, GetChallengeResponse
-import gridfs
+from models import CreateChallengeRequest, SubmitFlagRequest
+from singleflight import coalesce
+from challenge_index import challenge_index
 from io import BytesIO
+from werkzeug.exceptions import RequestEntityTooLarge
+from attachments import limit_request_body, store_upload, release_attachment, claim_completed_upload, UploadTooLarge, UploadNotFound
+from signed_urls import signed_file_url
+from flag_verifier import flag_verifier
+from middleware import decode_token
+from email_outbox import run_in_transaction
+from scoreboard import add_points, publish_score, scoreboard
 
 challenges_blueprint = Blueprint("challenges", __name__)
 
@@ -17,28 +25,54 @@ client = current_app.client
 uri = current_app.uri
 db_name = current_app.config['DB_NAME']
 db_challenges_collection = current_app.config['DB_CHALLENGES_COLLECTION']
+db_teams_collection = current_app.config['DB_TEAMS_COLLECTION']
+db_submissions_collection = current_app.config['DB_SUBMISSIONS_COLLECTION']
+db_hint_unlocks_collection = current_app.config['DB_HINT_UNLOCKS_COLLECTION']
+db_scores_collection = current_app.config['DB_SCORES_COLLECTION']
+
+# Submissions are checked against flags held in memory, never the challenge documents
+try:
+    flag_verifier.load(client[db_name][db_challenges_collection])
+except Exception as e:
+    logging.error("Failed to load challenge flags: %s", e)
+
+# Stored challenges are validated on write, so list reads only project the fields they return
+list_challenges_projection = {
+    "challenge_name": 1,
+    "challenge_category": 1,
+    "points": 1,
+    "challenge_description": 1,
+    "division": 1,
+}
 
 
 @challenges_blueprint.route('/challenges/create', methods=["POST"])
 def create_challenge() -> Tuple[Response, int]:
     try:
+        max_file_size = current_app.config['CHALLENGE_FILE_MAX_BYTES']
+        limit_request_body(max_file_size)
+
         create_challenge_request: CreateChallengeRequest = CreateChallengeRequest.model_validate_json(request.form.get('challenge'))
         create_challenge_dict: Dict = create_challenge_request.model_dump()
         create_challenge_dict['created_at'] = datetime.now()
         db = client[db_name]
         collection = db[db_challenges_collection]
         challenge_file_attachment_id = None
-        fs = gridfs.GridFS(db)
        
         # save file if present
         if 'challenge_file_attachment' in request.files:
             file = request.files['challenge_file_attachment']
-            challenge_file_attachment_id = fs.put(file, filename=file.filename)
+            challenge_file_attachment_id = store_upload(db, file, max_file_size)
+        elif request.form.get('challenge_file_upload_id'):
+            # large files uploaded through the resumable upload API
+            challenge_file_attachment_id = claim_completed_upload(db, request.form.get('challenge_file_upload_id'))
 
         create_challenge_dict['challenge_file_attachment_id'] = challenge_file_attachment_id
         response = collection.insert_one(create_challenge_dict)
 
         if response.inserted_id is not None:
+            challenge_index.upsert(create_challenge_dict)
+            flag_verifier.upsert(create_challenge_dict)
             return jsonify({
                 "content" : "Created Challenge Successfully!",
                 "challenge_id": str(response.inserted_id)
@@ -49,6 +83,12 @@ def create_challenge() -> Tuple[Response, int]:
     except ValidationError as e:
         return jsonify({'error': str(e)}), status.BAD_REQUEST
 
+    except (RequestEntityTooLarge, UploadTooLarge):
+        return jsonify({'error': 'Uploaded file is too large.'}), status.PAYLOAD_TOO_LARGE
+
+    except UploadNotFound:
+        return jsonify({'error': 'Could not find a completed upload with that challenge_file_upload_id'}), status.BAD_REQUEST
+
     except WriteError as e:
           logging.error("WriteError: %s", e)
           return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
@@ -64,21 +104,52 @@ def create_challenge() -> Tuple[Response, int]:
 
 @challenges_blueprint.route('/challenges/get')
 def get_challenges() -> Tuple[Response, int]:
+    # Teams only list the divisions they compete in. This is checked before coalescing,
+    # which shares responses between callers with the same role
+    if get_token_role() == "team":
+        try:
+            team = get_submitting_team(client[db_name])
+        except Exception as e:
+            logging.error("Encountered exception: %s", e)
+            return jsonify({"error": "Error fetching challenges."}), status.INTERNAL_SERVER_ERROR
+        if team is None:
+            return jsonify({"error": "Team not found."}), status.FORBIDDEN
+        if 'division' not in request.args:
+            return jsonify({"error": "Teams must pass their division."}), status.BAD_REQUEST
+        if not request.args['division'].isdigit() or int(request.args['division']) not in team["division"]:
+            return jsonify({"error": "Teams can only list challenges in their own divisions."}), status.FORBIDDEN
+
+    return list_challenges()
+
+
+@coalesce()
+def list_challenges() -> Tuple[Response, int]:
     try:
 
         db = client[db_name]
         collection = db[db_challenges_collection]
 
         year: Optional[int] = None
+        division: Optional[int] = None
 
         if 'year' in request.args:
             year = int(request.args['year'])
 
+        if 'division' in request.args:
+            if not request.args['division'].isdigit():
+                return jsonify({'error': 'Division parameter provided in request was not an int.'}), status.BAD_REQUEST
+            division = int(request.args['division'])
+
         challenges = []
 
+        if division is not None:
+            # Served from the per-division index so teams only fetch their slice
+            challenges = challenge_index.get(collection, division, year)
+            return jsonify({"content": "Successfully fetched challenges.", "challenges": challenges}), status.OK
+
         if year is None:
             logging.info("Client did not provide year parameter for getting the challenge.")
-            for document in collection.find():
+            for document in collection.find({}, list_challenges_projection):
                 challenge = {
                         "challenge_name": document["challenge_name"],
                         "challenge_category": document["challenge_category"],
@@ -87,9 +158,7 @@ def get_challenges() -> Tuple[Response, int]:
                         "challenge_id": str(document["_id"]),
                         "division": document["division"]
                     }
-                validated_challenge: ListChallengeResponse = ListChallengeResponse.model_validate(challenge)
-                challenge_dict = validated_challenge.model_dump()
-                challenges.append(challenge_dict)
+                challenges.append(challenge)
 
             return jsonify({"content": "Successfully fetched challenges.", "challenges": challenges}), status.OK
 
@@ -105,7 +174,7 @@ def get_challenges() -> Tuple[Response, int]:
                 }
             }
 
-            for document in collection.find(query):
+            for document in collection.find(query, list_challenges_projection):
                 challenge = {
                         "challenge_name": document["challenge_name"],
                         "challenge_category": document["challenge_category"],
@@ -114,9 +183,7 @@ def get_challenges() -> Tuple[Response, int]:
                         "challenge_id": str(document["_id"]),
                         "division": document["division"],
                     }
-                validated_challenge: ListChallengeResponse = ListChallengeResponse.model_validate(challenge)
-                challenge_dict = validated_challenge.model_dump()
-                challenges.append(challenge_dict)
+                challenges.append(challenge)
 
             return jsonify({"content": "Successfully fetched challenges.", "challenges": challenges}), status.OK
 
@@ -138,9 +205,15 @@ def get_challenges() -> Tuple[Response, int]:
         return jsonify({"content": "Error getting challenges."}), status.INTERNAL_SERVER_ERROR
 
 
+def get_token_role() -> Optional[str]:
+    token = decode_token(request.cookies.get("access_token"))
+    return token.get("role") if token else None
+
+
 @challenges_blueprint.route('/challenges/details')
 def get_challenge_details():
     try:
+        role = get_token_role()
 
         db = client[db_name]
         collection = db[db_challenges_collection]
@@ -152,14 +225,22 @@ def get_challenge_details():
         if challenge_id is None:
             return jsonify({"error": "challenge_id parameter is required."}), status.BAD_REQUEST
 
-        document = collection.find_one({"_id": ObjectId(challenge_id)})
+        query = {"_id": ObjectId(challenge_id)}
+        if role == "team":
+            # Teams only see challenges in the divisions they compete in
+            team = get_submitting_team(db)
+            if team is None:
+                return jsonify({"error": "Team not found."}), status.FORBIDDEN
+            query["division"] = {"$in": team["division"]}
+
+        document = collection.find_one(query)
 
         if document is None:
             return jsonify({"error":"Could not find any challenge with that challenge_id"}), status.BAD_REQUEST
 
         challenge_file_attachment = None
         if "challenge_file_attachment_id" in document and document["challenge_file_attachment_id"] != None:
-            challenge_file_attachment = url_for('files.download_file', file_id=document["challenge_file_attachment_id"], _external=True)
+            challenge_file_attachment = signed_file_url(document["challenge_file_attachment_id"])
 
         challenge = {
             "challenge_name": document["challenge_name"],
@@ -174,11 +255,13 @@ def get_challenge_details():
             "hints": document.get("hints", None),
             "challenge_file_attachment": challenge_file_attachment,
         }
-
-        validated_challenge: GetChallengeResponse = GetChallengeResponse.model_validate(challenge)
-        challenge_dict = validated_challenge.model_dump()
-
-        return jsonify({"content": "Successfully fetched challenge details.", "challenge": challenge_dict}), status.OK
+        if role == "team":
+            # Teams never see the answer, and hints are only shown once they are unlocked
+            del challenge["flag"]
+            del challenge["solution_explanation"]
+            if challenge["hints"] is not None:
+                challenge["hints"] = [{"point_cost": hint["point_cost"]} for hint in challenge["hints"]]
+        return jsonify({"content": "Successfully fetched challenge details.", "challenge": challenge}), status.OK
 
     except ValueError as e:
         logging.error("ValueError: %s", e)
@@ -199,9 +282,15 @@ def get_challenge_details():
 @challenges_blueprint.route('/challenges/<string:challenge_id>', methods=["PUT","DELETE"])
 def update_or_delete_challenge(challenge_id: str) -> Tuple[Response, int]:
     try:
+        # The middleware doesn't match paths with parameters, so the role is checked here
+        if get_token_role() not in ("admin", "crimson_defense"):
+            return jsonify({"error": "Only admins and Crimson Defense can change challenges."}), status.FORBIDDEN
+
+        max_file_size = current_app.config['CHALLENGE_FILE_MAX_BYTES']
+        limit_request_body(max_file_size)
+
         db = client[db_name]
         collection = db[db_challenges_collection]
-        fs = gridfs.GridFS(db)
         challenge = collection.find_one({"_id": ObjectId(challenge_id)})
         if challenge is None:
             return jsonify({"error":"Could not find any challenge with that challenge_id"}), status.BAD_REQUEST
@@ -209,9 +298,11 @@ def update_or_delete_challenge(challenge_id: str) -> Tuple[Response, int]:
         if request.method == "DELETE":
             # if the challenge has a file, delete the file
             if "challenge_file_attachment_id" in challenge and challenge["challenge_file_attachment_id"] != None:
-                fs.delete(challenge["challenge_file_attachment_id"])
+                release_attachment(db, challenge["challenge_file_attachment_id"])
 
             delete_attempt = collection.delete_one({"_id": ObjectId(challenge_id)})
+            challenge_index.remove(challenge_id)
+            flag_verifier.remove(challenge_id)
 
             if delete_attempt.deleted_count == 1:
                 return jsonify({"content": "Deleted challenge successfully!"}), status.OK
@@ -223,22 +314,31 @@ def update_or_delete_challenge(challenge_id: str) -> Tuple[Response, int]:
             update_challenge_request: CreateChallengeRequest = CreateChallengeRequest.model_validate_json(request.form.get('challenge'))
             update_data: Dict = update_challenge_request.model_dump()
             
+            old_challenge_file_attachment_id = challenge.get("challenge_file_attachment_id", None)
+
             # delete challenge file
             if request.form.get("delete_old_challenge_file") == "true":
-                if "challenge_file_attachment_id" in challenge and challenge["challenge_file_attachment_id"] != None:
-                    fs.delete(challenge["challenge_file_attachment_id"])
-                    update_data['challenge_file_attachment_id'] = None
+                update_data['challenge_file_attachment_id'] = None
 
             # update challenge file if new file is present
             if 'challenge_file_attachment' in request.files:
                 file = request.files['challenge_file_attachment']
-                new_challenge_file_attachment_id = fs.put(file, filename=file.filename)
+                new_challenge_file_attachment_id = store_upload(db, file, max_file_size)
                 update_data['challenge_file_attachment_id'] = new_challenge_file_attachment_id
+            elif request.form.get('challenge_file_upload_id'):
+                new_challenge_file_attachment_id = claim_completed_upload(db, request.form.get('challenge_file_upload_id'))
+                update_data['challenge_file_attachment_id'] = new_challenge_file_attachment_id
+
+            # the old file is released once it has been deleted or replaced
+            if 'challenge_file_attachment_id' in update_data and old_challenge_file_attachment_id != None:
+                release_attachment(db, old_challenge_file_attachment_id)
 
             update_attempt = collection.update_one(
                     {"_id": ObjectId(challenge_id)},
                     {"$set": update_data}
                     )
+            challenge_index.upsert({**challenge, **update_data})
+            flag_verifier.upsert({**challenge, **update_data})
 
             if update_attempt.modified_count == 1:
                 return jsonify({"content": "Successfully updated challenge!"}), status.OK
@@ -250,6 +350,12 @@ def update_or_delete_challenge(challenge_id: str) -> Tuple[Response, int]:
     except ValidationError as e:
         return jsonify({"error": str(e)}), status.BAD_REQUEST
 
+    except (RequestEntityTooLarge, UploadTooLarge):
+        return jsonify({'error': 'Uploaded file is too large.'}), status.PAYLOAD_TOO_LARGE
+
+    except UploadNotFound:
+        return jsonify({'error': 'Could not find a completed upload with that challenge_file_upload_id'}), status.BAD_REQUEST
+
     except WriteError as e:
         logging.error("WriteError: %s", e)
         return jsonify({'error': 'An error occurred while reading from the database.'}), status.INTERNAL_SERVER_ERROR
@@ -261,3 +367,131 @@ def update_or_delete_challenge(challenge_id: str) -> Tuple[Response, int]:
     except Exception as e:
         logging.error("Encountered exception: %s", e)
         return jsonify({"error": "Error updating or deleting challenge"}), status.INTERNAL_SERVER_ERROR
+
+
+def get_submitting_team(db) -> Optional[Dict]:
+    # Flags are submitted and hints unlocked by teams logged in with their team account
+    token = decode_token(request.cookies.get("access_token"))
+    if not token or token.get("role") != "team":
+        return None
+    return db[db_teams_collection].find_one({"_id": ObjectId(token["userId"])}, {"name": 1, "division": 1, "competition_id": 1})
+
+
+@challenges_blueprint.route('/challenges/<string:challenge_id>/submit', methods=["POST"])
+def submit_flag(challenge_id: str) -> Tuple[Response, int]:
+    try:
+        db = client[db_name]
+        team = get_submitting_team(db)
+        if team is None:
+            return jsonify({"error": "Only teams can submit flags."}), status.FORBIDDEN
+
+        submit_flag_request: SubmitFlagRequest = SubmitFlagRequest.model_validate_json(request.data)
+
+        if not ObjectId.is_valid(challenge_id):
+            return jsonify({"error": "Could not find any challenge with that challenge_id"}), status.NOT_FOUND
+        flag = flag_verifier.get(challenge_id, team["division"])
+        if flag is None:
+            return jsonify({"error": "Could not find any challenge with that challenge_id"}), status.NOT_FOUND
+
+        correct = flag.matches(submit_flag_request.flag)
+        submitted_at = datetime.now()
+        # The points are recorded with the solve, so scores can be rebuilt from the submissions
+        submission = {
+            "team_id": team["_id"],
+            "challenge_id": ObjectId(challenge_id),
+            "competition_id": team.get("competition_id"),
+            "correct": correct,
+            "points": flag.points if correct else 0,
+            "submitted_at": submitted_at,
+        }
+
+        def record_submission(session) -> Optional[Dict]:
+            db[db_submissions_collection].insert_one(submission, session=session)
+            if correct:
+                return add_points(db[db_scores_collection], team, flag.points, submitted_at, session=session)
+            return None
+
+        already_solved = False
+        try:
+            if correct:
+                score = run_in_transaction(client, record_submission)
+                scoreboard.apply(score)
+                publish_score(db, current_app.config, score)
+            else:
+                record_submission(None)
+        except DuplicateKeyError:
+            # Only correct submissions are unique per team and challenge
+            already_solved = True
+
+        return jsonify({"correct": correct, "already_solved": already_solved}), status.OK
+
+    except ValidationError as e:
+        return jsonify({"error": str(e)}), status.BAD_REQUEST
+
+    except WriteError as e:
+        logging.error("WriteError: %s", e)
+        return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error submitting flag."}), status.INTERNAL_SERVER_ERROR
+
+
+@challenges_blueprint.route('/challenges/<string:challenge_id>/hints/<int:hint_index>/unlock', methods=["POST"])
+def unlock_hint(challenge_id: str, hint_index: int) -> Tuple[Response, int]:
+    try:
+        db = client[db_name]
+        team = get_submitting_team(db)
+        if team is None:
+            return jsonify({"error": "Only teams can unlock hints."}), status.FORBIDDEN
+
+        challenge = None
+        if ObjectId.is_valid(challenge_id):
+            challenge = db[db_challenges_collection].find_one({"_id": ObjectId(challenge_id), "division": {"$in": team["division"]}}, {"hints": 1})
+        if challenge is None:
+            return jsonify({"error": "Could not find any challenge with that challenge_id"}), status.NOT_FOUND
+
+        hints = challenge.get("hints") or []
+        if hint_index >= len(hints):
+            return jsonify({"error": "Could not find a hint with that index"}), status.NOT_FOUND
+        hint = hints[hint_index]
+
+        unlock = {
+            "team_id": team["_id"],
+            "challenge_id": challenge["_id"],
+            "hint_index": hint_index,
+            "competition_id": team.get("competition_id"),
+            "point_cost": hint["point_cost"],
+            "unlocked_at": datetime.now(),
+        }
+
+        def record_unlock(session) -> Dict:
+            db[db_hint_unlocks_collection].insert_one(unlock, session=session)
+            return add_points(db[db_scores_collection], team, -hint["point_cost"], session=session)
+
+        already_unlocked = False
+        try:
+            score = run_in_transaction(client, record_unlock)
+            scoreboard.apply(score)
+            publish_score(db, current_app.config, score)
+        except DuplicateKeyError:
+            # Each hint is only paid for once
+            already_unlocked = True
+
+        return jsonify({"hint": hint["hint"], "point_cost": hint["point_cost"], "already_unlocked": already_unlocked}), status.OK
+
+    except WriteError as e:
+        logging.error("WriteError: %s", e)
+        return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error unlocking hint."}), status.INTERNAL_SERVER_ERROR
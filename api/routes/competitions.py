@@ -6,8 +6,12 @@ from datetime import date, datetime
 from pydantic import ValidationError
 from bson.objectid import ObjectId
 import logging
-import gridfs
-from models import CreateCompetitionRequest, GetCompetitionResponse
+from werkzeug.exceptions import RequestEntityTooLarge
+from attachments import limit_request_body, store_upload, release_attachment, UploadTooLarge
+from models import CreateCompetitionRequest
+from singleflight import coalesce
+from signed_urls import signed_file_url
+from competition_scope import clear_active_competition_cache
 
 competitions_blueprint = Blueprint("competitions", __name__)
 
@@ -20,6 +24,9 @@ db_competitions_collection = current_app.config['DB_COMPETITION_COLLECTION']
 @competitions_blueprint.route('/competitions/create', methods=["POST"])
 def create_competition() -> Tuple[Response, int]:
     try:
+        max_file_size = current_app.config['LIABILITY_FORM_MAX_BYTES']
+        limit_request_body(max_file_size)
+
         create_competition_request: CreateCompetitionRequest = CreateCompetitionRequest.model_validate_json(request.form.get('competition'))
 
         create_competition_dict: Dict = create_competition_request.model_dump()
@@ -27,18 +34,18 @@ def create_competition() -> Tuple[Response, int]:
         db = client[db_name]
         collection = db[db_competitions_collection]
         liability_release_form_file_id = None
-        fs = gridfs.GridFS(db)
         
         # save file if present
         if 'liability_release_form_file' in request.files:
             file = request.files['liability_release_form_file']
-            liability_release_form_file_id = fs.put(file, filename=file.filename)
+            liability_release_form_file_id = store_upload(db, file, max_file_size)
         else:
             return jsonify({"error": "Cannot create competition without liability release form"}), status.BAD_REQUEST
 
         create_competition_dict['liability_release_form_file_id'] = liability_release_form_file_id
 
         response = collection.insert_one(create_competition_dict)
+        clear_active_competition_cache()
 
         if response.inserted_id is not None:
             return jsonify({
@@ -51,6 +58,9 @@ def create_competition() -> Tuple[Response, int]:
     except ValidationError as e:
         return jsonify({'error': str(e)}), status.BAD_REQUEST
 
+    except (RequestEntityTooLarge, UploadTooLarge):
+        return jsonify({'error': 'Uploaded file is too large.'}), status.PAYLOAD_TOO_LARGE
+
     except WriteError as e:
           logging.error("WriteError: %s", e)
           return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
@@ -64,6 +74,7 @@ def create_competition() -> Tuple[Response, int]:
         return jsonify({"error": "Error creating competition."}), status.INTERNAL_SERVER_ERROR
 
 @competitions_blueprint.route('/competitions/get')
+@coalesce()
 def get_competitions() -> Tuple[Response, int]:
     try:
         db = client[db_name]
@@ -75,14 +86,11 @@ def get_competitions() -> Tuple[Response, int]:
                 competition = {
                     "competition_id": str(document["_id"]),
                     "competition_name": document["competition_name"],
-                    "created_at": document["created_at"],
                     "registration_deadline": document["registration_deadline"],
                     "is_active": document["is_active"],
-                    "liability_release_form": url_for('files.download_file', file_id=document["liability_release_form_file_id"], _external=True),
+                    "liability_release_form": signed_file_url(document["liability_release_form_file_id"]),
                 }
-                validated_competition: GetCompetitionResponse = GetCompetitionResponse.model_validate(competition)
-                competition_dict = validated_competition.model_dump()
-                competitions.append(competition_dict)
+                competitions.append(competition)
         return jsonify({"content": "Successfully fetched competitions.", "competitions": competitions}), status.OK
 
     except WriteError as e:
@@ -113,13 +121,10 @@ def get_current_competitions() -> Tuple[Response, int]:
                 competition = {
                     "competition_id": str(document["_id"]),
                     "competition_name": document["competition_name"],
-                    "created_at": document["created_at"],
                     "registration_deadline": document["registration_deadline"],
                     "is_active": document["is_active"]
                 }
-                validated_competition: GetCompetitionResponse = GetCompetitionResponse.model_validate(competition)
-                competition_dict = validated_competition.model_dump()
-                competitions.append(competition_dict)
+                competitions.append(competition)
 
         return jsonify({"content": "Successfully fetched competitions.", "competitions": competitions}), status.OK
 
@@ -157,16 +162,11 @@ def get_competition_details():
         competition = {
             "competition_id": str(document["_id"]),
             "competition_name": document["competition_name"],
-            "created_at": document["created_at"],
             "registration_deadline": document["registration_deadline"],
             "is_active": document["is_active"],
-            "liability_release_form": url_for('files.download_file', file_id=document["liability_release_form_file_id"], _external=True),
+            "liability_release_form": signed_file_url(document["liability_release_form_file_id"]),
         }
-
-        validated_competition: GetCompetitionResponse = GetCompetitionResponse.model_validate(competition)
-        competition_dict = validated_competition.model_dump()
-
-        return jsonify({"content": "Successfully fetched competition details.", "competition": competition_dict}), status.OK
+        return jsonify({"content": "Successfully fetched competition details.", "competition": competition}), status.OK
 
     except ValueError as e:
         logging.error("ValueError: %s", e)
@@ -188,20 +188,23 @@ def get_competition_details():
 @competitions_blueprint.route('/competitions/<string:competition_id>', methods=["PUT", "DELETE"])
 def update_or_delete_competition(competition_id) -> Tuple[Response, int]:
     try:
+        max_file_size = current_app.config['LIABILITY_FORM_MAX_BYTES']
+        limit_request_body(max_file_size)
+
         if not ObjectId.is_valid(competition_id):
             return jsonify({"error": "Invalid competition ID"}), 400
         
         db = client[db_name]
         collection = db[db_competitions_collection]
-        fs = gridfs.GridFS(db)
         competition = collection.find_one({"_id": ObjectId(competition_id)})
         if competition is None:
             return jsonify({"error":"Could not find any competition with that competition_id"}), status.BAD_REQUEST
 
         if request.method == "DELETE":
             # delete liability release form
-            fs.delete(competition["liability_release_form_file_id"])
+            release_attachment(db, competition["liability_release_form_file_id"])
             delete_attempt = collection.delete_one({"_id": ObjectId(competition_id)})
+            clear_active_competition_cache()
 
             if delete_attempt.deleted_count == 1:
                 return jsonify({"content": "Deleted competition successfully!"}), status.OK
@@ -217,10 +220,10 @@ def update_or_delete_competition(competition_id) -> Tuple[Response, int]:
             if request.form.get("delete_old_liability_release_form") == "true":
                 if 'liability_release_form_file' in request.files:
                     # delete old liability release form
-                    fs.delete(competition["liability_release_form_file_id"])
+                    release_attachment(db, competition["liability_release_form_file_id"])
 
                     file = request.files['liability_release_form_file']
-                    liability_release_form_file_id = fs.put(file, filename=file.filename)
+                    liability_release_form_file_id = store_upload(db, file, max_file_size)
                     update_competition_data['liability_release_form_file_id'] = liability_release_form_file_id
                 else:
                     return jsonify({"error": "Cannot have competition without liability release form"}), status.BAD_REQUEST
@@ -230,6 +233,7 @@ def update_or_delete_competition(competition_id) -> Tuple[Response, int]:
                     {"_id": ObjectId(competition_id)},
                     {"$set": update_competition_data}
                     )
+            clear_active_competition_cache()
 
             if update_attempt.matched_count == 1:
                 return jsonify({
@@ -243,6 +247,9 @@ def update_or_delete_competition(competition_id) -> Tuple[Response, int]:
     except ValidationError as e:
         return jsonify({'error': str(e)}), status.BAD_REQUEST
 
+    except (RequestEntityTooLarge, UploadTooLarge):
+        return jsonify({'error': 'Uploaded file is too large.'}), status.PAYLOAD_TOO_LARGE
+
     except WriteError as e:
         logging.error("WriteError: %s", e)
         return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
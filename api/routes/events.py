@@ -0,0 +1,38 @@
+from flask import Blueprint, jsonify, Response, request, current_app
+from typing import List
+import http_status_codes as status
+from events import TooManySubscribers, event_broker, stream_events
+
+# Server-Sent Events streams, see events.py. Each open stream holds a worker thread.
+
+events_blueprint = Blueprint("events", __name__)
+
+client_queue_size: int = current_app.config['EVENTS_CLIENT_QUEUE_SIZE']
+max_clients: int = current_app.config['EVENTS_MAX_CLIENTS']
+heartbeat_seconds: float = current_app.config['EVENTS_HEARTBEAT_SECONDS']
+retry_ms: int = current_app.config['EVENTS_RETRY_MS']
+
+
+def open_event_stream(channels: List[str]):
+    # Browsers send Last-Event-ID when they reconnect, other clients can pass last_event_id
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        subscriber, missed, reset = event_broker.subscribe(channels, last_event_id, client_queue_size, max_clients)
+    except TooManySubscribers:
+        return jsonify({"error": "Too many open event streams, try again later."}), status.SERVICE_UNAVAILABLE
+
+    response = Response(stream_events(subscriber, missed, reset, heartbeat_seconds, retry_ms), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Stops nginx from buffering the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@events_blueprint.route('/events/scoreboard', methods=["GET"])
+def scoreboard_events():
+    return open_event_stream(["scoreboard"])
+
+
+@events_blueprint.route('/events/admin', methods=["GET"])
+def admin_events():
+    return open_event_stream(["admin"])
@@ -1,28 +1,172 @@
-
-from io import BytesIO
+import mimetypes
+import zlib
+from datetime import datetime, timezone
 from bson.objectid import ObjectId
-from flask import Blueprint, current_app, jsonify, send_file
-import gridfs
-import gridfs.errors
+from flask import Blueprint, current_app, jsonify, request, send_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import wrap_file
+from signed_urls import CACHE_PUBLIC, get_request_role, get_signature_max_age, verify_file_signature
+from file_cache import attachment_cache
+from storage import attachment_storage, FileNotFound
+from attachments import COPY_BUFFER_SIZE
 
 files_blueprint = Blueprint("files", __name__)
-db_name = current_app.config['DB_NAME']
-client = current_app.client
-db = client[db_name]
-fs = gridfs.GridFS(db)
+
+# Roles that can download any file by id with just their cookie
+UNSIGNED_DOWNLOAD_ROLES = ("admin", "crimson_defense")
+
+def get_upload_timestamp(file) -> float:
+    # Stored upload dates are naive UTC datetimes
+    return file.upload_date.replace(tzinfo=timezone.utc).timestamp()
+
+def get_file_etag(file) -> str:
+    # Files uploaded by older drivers have an md5, newer ones only have an upload date
+    md5 = getattr(file, "md5", None)
+    if md5:
+        return md5
+    return f"{file._id}-{int(get_upload_timestamp(file) * 1000)}"
+
+def get_file_metadata(file) -> dict:
+    stored_metadata = file.metadata or {}
+    return {
+        "filename": file.filename,
+        "mimetype": mimetypes.guess_type(file.filename or "")[0] or "application/octet-stream",
+        "etag": get_file_etag(file),
+        "upload_date": get_upload_timestamp(file),
+        # Set for compressed files, the length is then the length of the original content
+        "encoding": stored_metadata.get("encoding"),
+        "length": stored_metadata.get("length", file.length),
+    }
+
+def get_representation_etag(metadata: dict) -> str:
+    # The compressed and decompressed responses are different representations of the file
+    if metadata.get("encoding"):
+        return f"{metadata['etag']}-{metadata['encoding']}"
+    return metadata["etag"]
+
+def accepts_stored_encoding(metadata: dict) -> bool:
+    return not metadata.get("encoding") or request.accept_encodings[metadata["encoding"]] > 0
+
+def send_cached_file(path: str, metadata: dict):
+    # send_file uses the server's file wrapper (sendfile) or X-Sendfile when USE_X_SENDFILE is set,
+    # and handles conditional and Range requests against the file on disk
+    response = send_file(
+        path,
+        mimetype=metadata["mimetype"],
+        download_name=metadata["filename"],
+        conditional=True,
+        etag=get_representation_etag(metadata),
+        last_modified=datetime.fromtimestamp(metadata["upload_date"], timezone.utc)
+    )
+    if metadata.get("encoding"):
+        response.content_encoding = metadata["encoding"]
+    return response
+
+def decompress_blocks(file, buffer_size: int):
+    decompressor = zlib.decompressobj(wbits=31)
+    try:
+        while True:
+            block = file.read(buffer_size)
+            if not block:
+                break
+            data = decompressor.decompress(block)
+            if data:
+                yield data
+        yield decompressor.flush()
+    finally:
+        file.close()
+
+def stream_decompressed_file(file, metadata: dict):
+    # For clients that don't accept the stored encoding. The decompressed bytes can't be seeked,
+    # so Range requests are answered with the whole file.
+    response = current_app.response_class(
+        decompress_blocks(file, getattr(file, "chunk_size", COPY_BUFFER_SIZE)),
+        mimetype=metadata["mimetype"],
+        direct_passthrough=True
+    )
+    response.content_length = metadata["length"]
+    response.last_modified = datetime.fromtimestamp(metadata["upload_date"], timezone.utc)
+    response.set_etag(metadata["etag"])
+    if metadata["filename"]:
+        response.headers.set("Content-Disposition", "inline", filename=metadata["filename"])
+    return response.make_conditional(request)
+
+def stream_stored_file(file, metadata: dict):
+    response = current_app.response_class(
+        wrap_file(request.environ, file, buffer_size=file.chunk_size),
+        mimetype=metadata["mimetype"],
+        direct_passthrough=True
+    )
+    response.content_length = file.length
+    response.last_modified = file.upload_date
+    response.set_etag(get_representation_etag(metadata))
+    if metadata.get("encoding"):
+        response.content_encoding = metadata["encoding"]
+    if metadata["filename"]:
+        response.headers.set("Content-Disposition", "inline", filename=metadata["filename"])
+
+    # Handles If-None-Match / If-Modified-Since and Range / If-Range requests,
+    # seeking the stored file so only the requested bytes are read
+    return response.make_conditional(request, accept_ranges=True, complete_length=file.length)
 
 @files_blueprint.route('/files/<file_id>', methods=['GET'])
 def download_file(file_id):
     try:
-        # Retrieve the file from GridFS
-        print(file_id)
-        file = fs.get(ObjectId(file_id))
-        return send_file(
-            BytesIO(file.read()), 
-            download_name=file.filename, 
-            mimetype=file.content_type
-        )
-    except gridfs.errors.NoFile:
+        # The id is also used as a path in the disk cache
+        if not ObjectId.is_valid(file_id):
+            return jsonify({"error": "File not found"}), 404
+
+        # Everyone else gets files through the signed URLs the other routes hand out
+        signed = verify_file_signature(file_id, request.args)
+        if not signed and get_request_role() not in UNSIGNED_DOWNLOAD_ROLES:
+            return jsonify({"error": "A signed download link is required."}), 403
+
+        file = None
+        cached = attachment_cache.get(file_id) if attachment_cache is not None else None
+        if cached is not None:
+            file_path, metadata = cached
+        else:
+            # Retrieve the file from storage, caching it on disk when it isn't already local and fits
+            file = attachment_storage.open(ObjectId(file_id))
+            metadata = get_file_metadata(file)
+            file_path = attachment_storage.local_path(file._id)
+            if file_path is None and attachment_cache is not None:
+                file_path = attachment_cache.put(file_id, file, metadata)
+
+        if file_path is not None and file is not None:
+            # Serve from disk from here on
+            file.close()
+            file = None
+        elif file is not None:
+            file.seek(0)
+
+        if not accepts_stored_encoding(metadata):
+            response = stream_decompressed_file(file if file is not None else open(file_path, "rb"), metadata)
+        elif file_path is not None:
+            response = send_cached_file(file_path, metadata)
+        else:
+            response = stream_stored_file(file, metadata)
+
+        if metadata.get("encoding"):
+            response.vary.add("Accept-Encoding")
+
+        # A signed URL is its own authorization, so a cache or proxy can serve it until it expires,
+        # unless it was signed for a file that must not be stored outside the browser
+        if signed and request.args["cache"] == CACHE_PUBLIC:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = get_signature_max_age(request.args)
+        elif signed:
+            response.cache_control.private = True
+            response.cache_control.no_store = True
+        else:
+            response.cache_control.private = True
+
+        return response
+    except RequestedRangeNotSatisfiable:
+        # Let Flask build the 416 response with its Content-Range header
+        raise
+    except FileNotFound:
         return jsonify({"error": "File not found"}), 404
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
@@ -1,4 +1,4 @@
-from flask import Blueprint, json, jsonify, Response, request, current_app
+from flask import Blueprint, json, jsonify, Response, request, current_app, url_for
 from typing import Dict, Optional, Tuple
 import http_status_codes as status
 from pymongo.errors import WriteError, OperationFailure
@@ -7,12 +7,15 @@ from pydantic import ValidationError
 from bson.objectid import ObjectId
 from models import CreateTeamsReportRequest, CreateStudentAccountsReportRequest
 import logging
-from emails import EmailWithAttachmentRequest, send_email_with_attachment
+from report_jobs import submit_report_job
+from signed_urls import signed_file_url
+from competition_scope import NoActiveCompetition, get_requested_competition_id
+from report_csv import (
+    PRACTICE_ACCOUNTS_HEADERS, STUDENT_ACCOUNTS_HEADERS, TEAMS_INFO_HEADERS, iter_practice_accounts_rows,
+    iter_student_accounts_rows, iter_teams_info_rows, stream_csv_response
+)
 import jwt
-import io
-import csv
 import os
-import base64
 
 
 reports_blueprint = Blueprint("reports", __name__)
@@ -29,141 +32,64 @@ db_students_collection: str = current_app.config['DB_STUDENT_INFO_COLLECTION']
 db_teachers_collection: str = current_app.config['DB_TEACHER_INFO_COLLECTION']
 db_student_accounts_collection: str = current_app.config['DB_STUDENT_ACCOUNTS_COLLECTION']
 db_team_accounts_collection: str = current_app.config["DB_TEAM_ACCOUNTS_COLLECTION"]
+db_report_jobs_collection: str = current_app.config['DB_REPORT_JOBS_COLLECTION']
+db_analytics_exports_collection: str = current_app.config['DB_ANALYTICS_EXPORTS_COLLECTION']
+
+NO_COMPETITION_ERROR = "There is no active competition. Pass competition_id to report on an earlier one."
+
+
+def get_admin_id() -> Optional[str]:
+    token = request.cookies.get("access_token")
+    if not token:
+        logging.error("Unable to get token from cookies")
+        return None
+    decoded_token = jwt.decode(token, secret_key, algorithms=[auth_algorithm])
+    if not decoded_token:
+        logging.error("Unable to decode token")
+        return None
+    return decoded_token["userId"]
+
+
+def queue_report(kind: str, params: Dict, email_account: Optional[str], send_email: bool) -> Tuple[Response, int]:
+    admin_id = get_admin_id()
+    if admin_id is None:
+        return jsonify({"error": "Internal Server Error. Check Server Logs"}), status.INTERNAL_SERVER_ERROR
+
+    # The admin can pass an email address for the report to be sent to
+    # If an email is not part of the request, it is sent to the admins email_account
+    # With send_email set to false the report is only available from the job's download links
+    db = client[db_name]
+    if not send_email:
+        email_account = None
+    elif email_account == None:
+        admin_info = db[db_accounts_collection].find_one({"_id": ObjectId(admin_id)})
+        if admin_info is None:
+            return jsonify({"error": "Error getting admin info from server. Alternatively, try providing your email address directly."}), status.INTERNAL_SERVER_ERROR
+        email_account = admin_info["email"]
+
+    job_id, deduplicated = submit_report_job(db, kind, params, email_account, admin_id)
+    return jsonify({
+        "content": "An identical report is already being generated." if deduplicated else "Report queued.",
+        "job_id": str(job_id),
+        "status_url": url_for("reports.get_report_job", job_id=str(job_id))
+    }), status.ACCEPTED
+
 
 @reports_blueprint.route('/reports/teams/info/create', methods=["POST"])
 def create_teams_info_report() -> Tuple[Response, int]:
     try:
         create_teams_report_request: CreateTeamsReportRequest = CreateTeamsReportRequest.model_validate_json(request.data)
         create_teams_report_dict: Dict = create_teams_report_request.model_dump()
-        report_is_for_virtual_teams = create_teams_report_dict["is_virtual"]
-        if report_is_for_virtual_teams:
-            report_type = "Virtual"
-        else:
-            report_type = "In-Person"
-        db = client[db_name]
-        team_collection = db[db_teams_collection]
-        student_collection = db[db_students_collection]
-        accounts_collecion = db[db_accounts_collection]
-        teachers_collection = db[db_teachers_collection]
-        # The admin can pass an email address for the report to be sent to
-        # If an email is not part of the request, it is sent to the admins email_account
-        email_account = create_teams_report_dict["email"]
-        if email_account== None:
-            token = request.cookies.get("access_token")
-            if token:
-                decoded_token = jwt.decode(token, secret_key, algorithms=[auth_algorithm])
-            else:
-                logging.error("Unable to get token from cookies")
-                return jsonify({"error": "Internal Server Error. Check Server Logs"}), status.INTERNAL_SERVER_ERROR
-            if not decoded_token:
-                logging.error("Unable to decode token")
-                return jsonify({"error": "Internal Server Error. Check Server Logs"}), status.INTERNAL_SERVER_ERROR
-
-            admin_id = decoded_token["userId"]
-            admin_info = accounts_collecion.find_one({"_id": ObjectId(admin_id)})
-            if admin_info is None:
-                return jsonify({"error": "Error getting admin info from server. Alternatively, try providing your email address directly."}), status.INTERNAL_SERVER_ERROR
-            email_account = admin_info["email"]
-
-        teams_of_type = list(team_collection.find({"is_virtual": report_is_for_virtual_teams}))
-        if not teams_of_type:
-            return jsonify({"error": f"Did not find any {report_type} teams in the database"}), status.INTERNAL_SERVER_ERROR
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-
-        headers = [
-            "Instructor Information",
-            "Division",
-            "School Name",
-            "Name",
-            "Email",
-            "Contact Number",
-            "Shirt Size",
-            "Student 1 Name",
-            "Student 1 Shirt Size",
-            "Student 1 Email",
-            "Student 2 Name",
-            "Student 2 Shirt Size",
-            "Student 2 Email",
-            "Student 3 Name",
-            "Student 3 Shirt Size",
-            "Student 3 Email",
-            "Student 4 Name",
-            "Student 4 Shirt Size",
-            "Student 4 Email"
-        ]
-        writer.writerow(headers)
-
-        # Process each team
-        for team in teams_of_type:
-            # Get teacher info
-            teacher = teachers_collection.find_one({"_id": ObjectId(team["teacher_id"])})
-            if not teacher:
-                logging.error(f"Teacher not found for team {team['_id']}")
-                continue
-            team_id = team.get("_id")
-            team_id = ObjectId(team_id)
-
-            # Get students for this team
-            students = students = list(student_collection.find({"team_id":ObjectId(team["_id"])}).limit(4))
-            
-            # Prepare row data
-            row = [
-                f"{teacher['first_name']} {teacher['last_name']}",
-                ", ".join(str(d) for d in team["division"]),
-                teacher["school_name"],
-                team["name"],
-                teacher["email"],
-                teacher["contact_number"],
-                teacher["shirt_size"]
-            ]
-            
-            # Add student information (up to 4 students)
-            for i in range(4):
-                if i < len(students):
-                    student = students[i]
-                    row.extend([
-                        f"{student['first_name']} {student['last_name']}",
-                        student["shirt_size"],
-                        student.get("email", "")
-                    ])
-                else:
-                    row.extend(["", "", ""])
-
-            writer.writerow(row)
-        
-        # Resetting buffer
-        output.seek(0)
-        content = output.getvalue()
-        # Making sure its not just the header row or empty
-        if content.count('\n') <= 1:
-            return jsonify({'error': 'No valid team data could be processed for the report.'}), status.NOT_FOUND
-
-        email_request = EmailWithAttachmentRequest(
-            email_account=email_account,
-            subject=f"{report_type} Teams Report",
-            message=f"""
-Dear Admin,
-
-Attached is the {report_type} teams report you requested.
-
-Best regards,
-The Team
-            """.strip(),
-            attachment_content=base64.b64encode(content.encode()).decode(),
-            attachment_filename=f"{report_type}_teams_report.csv"
-        )
-        
-        email_sent = send_email_with_attachment(email_request)
-        if not email_sent:
-            logging.error(f"Failed to send report email to {email_account}")
-            return jsonify({'error': 'Failed to send email with report'}), status.INTERNAL_SERVER_ERROR
-           
-        return jsonify({"content": "Report generated and sent successfully!"}), status.OK
+        params = {
+            "competition_id": get_requested_competition_id(client[db_name], current_app.config),
+            "is_virtual": create_teams_report_dict["is_virtual"]
+        }
+        return queue_report("teams_info", params, create_teams_report_dict["email"], create_teams_report_dict["send_email"])
 
     except ValidationError as e:
          return jsonify({'error': str(e)}), status.BAD_REQUEST
+    except NoActiveCompetition:
+        return jsonify({'error': NO_COMPETITION_ERROR}), status.BAD_REQUEST
     except OperationFailure as e:
         logging.error("OperationFailure: %s", e)
         return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
@@ -178,137 +104,164 @@ def create_student_accounts_report() -> Tuple[Response, int]:
     try:
         create_student_accounts_report_request: CreateStudentAccountsReportRequest = CreateStudentAccountsReportRequest.model_validate_json(request.data)
         create_student_accounts_report_dict: Dict = create_student_accounts_report_request.model_dump()
-
-        db = client[db_name]
-        student_accounts_collection = db[db_student_accounts_collection]
-        student_info_collection = db[db_students_collection]
-        accounts_collecion = db[db_accounts_collection]
-
-        admin_email = create_student_accounts_report_dict["email"]
-        if admin_email == None:
-            token = request.cookies.get("access_token")
-            if token:
-                decoded_token = jwt.decode(token, secret_key, algorithms=[auth_algorithm])
-            else:
-                logging.error("Unable to get token from cookies")
-                return jsonify({"error": "Internal Server Error. Check Server Logs"}), status.INTERNAL_SERVER_ERROR
-            if not decoded_token:
-                logging.error("Unable to decode token")
-                return jsonify({"error": "Internal Server Error. Check Server Logs"}), status.INTERNAL_SERVER_ERROR
-
-            admin_id = decoded_token["userId"]
-            admin_info = accounts_collecion.find_one({"_id": ObjectId(admin_id)})
-            if admin_info is None:
-                return jsonify({"error": "Error getting admin info from server. Alternatively, try providing your email address directly."}), status.INTERNAL_SERVER_ERROR
-            admin_email = admin_info["email"]
-
-        student_verification_type = create_student_accounts_report_dict["is_verified"]
-        students_of_requested_type = list(student_info_collection.find({"is_verified": student_verification_type}))
-        if not students_of_requested_type:
-            return jsonify({"error": "Could not find students of requested verification status"}), status.INTERNAL_SERVER_ERROR
-
-        output = io.StringIO()
-        writer = csv.writer(output)
-
-        practice_output = io.StringIO()
-        practice_writer = csv.writer(practice_output)
-
-        headers = [
-            "name",
-            "email",
-            "password",
-        ]
-
-        practice_headers = [
-            "username",
-            "password"
-        ]
-
-        writer.writerow(headers)
-        practice_writer.writerow(practice_headers)
-
-        for student in students_of_requested_type:
-            student_id = student.get("_id")
-            student_email = student["email"]
-            student_account = student_accounts_collection.find_one({"student_info_id": ObjectId(student_id)})
-            if not student_account:
-                continue
-            password = student_account["competition_password"]
-            practice_username = student_account["practice_username"]
-            practice_password = student_account["practice_password"]
-
-            row = [
-                f"{student['first_name']} {student['last_name']}",
-                student_email,
-                password
-            ]
-
-            practice_row = [
-                practice_username,
-                practice_password
-            ]
-
-            writer.writerow(row)
-            practice_writer.writerow(practice_row)
-
-        output.seek(0)
-        content = output.getvalue()
-
-        practice_output.seek(0)
-        practice_content = practice_output.getvalue()
-
-        if content.count('\n') <= 1:
-            return jsonify({'error': 'No valid student accounts could be processed for the report.'}), status.NOT_FOUND
-
-        if practice_content.count('\n') <= 1:
-            return jsonify({'error': 'No valid practice accounts for the requested students could be processed for the report.'}), status.NOT_FOUND
-
-        if student_verification_type:
-            report_type = "Verified"
-        else:
-            report_type = "Unverified"
-
-        email_request = EmailWithAttachmentRequest(
-            email_account=admin_email,
-            subject=f"{report_type} Student Accounts Report",
-            message=f"""
-Dear Admin,
-Attached is the {report_type} Student Accounts Report you requested.
-Best regards,
-The Team
-            """.strip(),
-            attachment_content=base64.b64encode(content.encode()).decode(),
-            attachment_filename=f"{report_type}_student_accounts_report.csv"
-        )
-
-        email_sent = send_email_with_attachment(email_request)
-        if not email_sent:
-            logging.error(f"Failed to send report email to {admin_email}")
-            return jsonify({'error': 'Failed to send email with report'}), status.INTERNAL_SERVER_ERROR
-
-        practice_email_request = EmailWithAttachmentRequest(
-            email_account=admin_email,
-            subject=f"Practice Accounts Report",
-            message=f"""
-Dear Admin,
-Attached is the Practice Accounts Report you requested.
-Best regards,
-The Team
-            """.strip(),
-            attachment_content=base64.b64encode(practice_content.encode()).decode(),
-            attachment_filename=f"practice_student_accounts_report.csv"
-        )
-
-        practice_email_sent = send_email_with_attachment(practice_email_request)
-        if not practice_email_sent:
-            logging.error(f"Failed to send practice accounts report email to {admin_email}")
-            return jsonify({'error': 'Failed to send email with report'}), status.INTERNAL_SERVER_ERROR
-
-
-        return jsonify({"content":"Successfully generated and sent the student accounts report"}), status.OK
+        params = {
+            "competition_id": get_requested_competition_id(client[db_name], current_app.config),
+            "is_verified": create_student_accounts_report_dict["is_verified"]
+        }
+        return queue_report("student_accounts", params, create_student_accounts_report_dict["email"], create_student_accounts_report_dict["send_email"])
 
     except ValidationError as e:
          return jsonify({'error': str(e)}), status.BAD_REQUEST
+    except NoActiveCompetition:
+        return jsonify({'error': NO_COMPETITION_ERROR}), status.BAD_REQUEST
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({'error': "Internal Server Error. Check server logs for details."}), status.INTERNAL_SERVER_ERROR
+
+
+def get_bool_arg(name: str, default: bool) -> Optional[bool]:
+    value = request.args.get(name)
+    if value is None:
+        return default
+    if value.lower() in ("true", "1"):
+        return True
+    if value.lower() in ("false", "0"):
+        return False
+    return None
+
+
+# Streaming downloads. Rows are written as the cursor returns them, so nothing is emailed
+# and the report never has to fit in memory.
+@reports_blueprint.route('/reports/teams/info/csv', methods=["GET"])
+def download_teams_info_report() -> Tuple[Response, int]:
+    try:
+        report_is_for_virtual_teams = get_bool_arg("is_virtual", False)
+        if report_is_for_virtual_teams is None:
+            return jsonify({"error": "is_virtual must be true or false"}), status.BAD_REQUEST
+
+        report_type = "Virtual" if report_is_for_virtual_teams else "In-Person"
+        competition_id = get_requested_competition_id(client[db_name], current_app.config)
+        rows = iter_teams_info_rows(client[db_name], current_app.config, competition_id, report_is_for_virtual_teams)
+        return stream_csv_response(f"{report_type}_teams_report.csv", TEAMS_INFO_HEADERS, rows), status.OK
+
+    except NoActiveCompetition:
+        return jsonify({'error': NO_COMPETITION_ERROR}), status.BAD_REQUEST
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({'error': "Internal Server Error. Check server logs for details."}), status.INTERNAL_SERVER_ERROR
+
+
+@reports_blueprint.route('/reports/students/csv', methods=["GET"])
+def download_student_accounts_report() -> Tuple[Response, int]:
+    try:
+        student_verification_type = get_bool_arg("is_verified", True)
+        if student_verification_type is None:
+            return jsonify({"error": "is_verified must be true or false"}), status.BAD_REQUEST
+
+        report_type = "Verified" if student_verification_type else "Unverified"
+        competition_id = get_requested_competition_id(client[db_name], current_app.config)
+        rows = iter_student_accounts_rows(client[db_name], current_app.config, competition_id, student_verification_type)
+        return stream_csv_response(f"{report_type}_student_accounts_report.csv", STUDENT_ACCOUNTS_HEADERS, rows), status.OK
+
+    except NoActiveCompetition:
+        return jsonify({'error': NO_COMPETITION_ERROR}), status.BAD_REQUEST
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({'error': "Internal Server Error. Check server logs for details."}), status.INTERNAL_SERVER_ERROR
+
+
+@reports_blueprint.route('/reports/students/practice/csv', methods=["GET"])
+def download_practice_accounts_report() -> Tuple[Response, int]:
+    try:
+        student_verification_type = get_bool_arg("is_verified", True)
+        if student_verification_type is None:
+            return jsonify({"error": "is_verified must be true or false"}), status.BAD_REQUEST
+
+        competition_id = get_requested_competition_id(client[db_name], current_app.config)
+        rows = iter_practice_accounts_rows(client[db_name], current_app.config, competition_id, student_verification_type)
+        return stream_csv_response("practice_student_accounts_report.csv", PRACTICE_ACCOUNTS_HEADERS, rows), status.OK
+
+    except NoActiveCompetition:
+        return jsonify({'error': NO_COMPETITION_ERROR}), status.BAD_REQUEST
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({'error': "Internal Server Error. Check server logs for details."}), status.INTERNAL_SERVER_ERROR
+
+
+@reports_blueprint.route('/reports/jobs/<job_id>', methods=["GET"])
+def get_report_job(job_id: str) -> Tuple[Response, int]:
+    try:
+        if not ObjectId.is_valid(job_id):
+            return jsonify({"error": "Report job not found"}), status.NOT_FOUND
+
+        job = client[db_name][db_report_jobs_collection].find_one({"_id": ObjectId(job_id)})
+        if job is None:
+            return jsonify({"error": "Report job not found"}), status.NOT_FOUND
+
+        progress = job["progress"]
+        return jsonify({
+            "job_id": str(job["_id"]),
+            "kind": job["kind"],
+            "params": job["params"],
+            "status": job["status"],
+            "progress": {
+                "done": progress["done"],
+                "total": progress["total"],
+                "percent": round(100 * progress["done"] / progress["total"]) if progress["total"] else None
+            },
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+            # Links are signed for admins, so they work without the cookie until they expire
+            "downloads": [
+                {"filename": artifact["filename"], "url": signed_file_url(artifact["file_id"], sensitive=True)}
+                for artifact in job["artifacts"]
+            ],
+        }), status.OK
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({'error': "Internal Server Error. Check server logs for details."}), status.INTERNAL_SERVER_ERROR
+
+
+@reports_blueprint.route('/reports/analytics/exports', methods=["GET"])
+def get_analytics_exports() -> Tuple[Response, int]:
+    try:
+        # Parquet exports made with flask export-analytics, newest first
+        exports = client[db_name][db_analytics_exports_collection].find().sort("created_at", -1).limit(10)
+        return jsonify([
+            {
+                "export_id": str(export["_id"]),
+                "created_at": export["created_at"],
+                "expires_at": export["expires_at"],
+                "files": [
+                    {
+                        "dataset": file["dataset"],
+                        "competition_id": file["competition_id"],
+                        "year": file["year"],
+                        "path": file["path"],
+                        "rows": file["rows"],
+                        "bytes": file["bytes"],
+                        "url": signed_file_url(file["file_id"], sensitive=True)
+                    }
+                    for file in export["files"]
+                ],
+            }
+            for export in exports
+        ]), status.OK
+
     except OperationFailure as e:
         logging.error("OperationFailure: %s", e)
         return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
@@ -0,0 +1,74 @@
+from flask import Blueprint, jsonify, Response, request, current_app
+from typing import Tuple
+import http_status_codes as status
+from pymongo.errors import OperationFailure
+import logging
+from competition_scope import NoActiveCompetition, get_requested_competition_id
+from scoreboard import scoreboard
+
+# Served from the in-memory scoreboard, see scoreboard.py
+
+scoreboard_blueprint = Blueprint("scoreboard", __name__)
+
+client = current_app.client
+db_name = current_app.config['DB_NAME']
+db_scores_collection = current_app.config['DB_SCORES_COLLECTION']
+page_max_size: int = current_app.config['SCOREBOARD_PAGE_MAX_SIZE']
+
+
+@scoreboard_blueprint.route('/scoreboard', methods=["GET"])
+def get_scoreboard() -> Tuple[Response, int]:
+    try:
+        for parameter in ("division", "offset", "limit"):
+            if parameter in request.args and not request.args[parameter].isdigit():
+                return jsonify({"error": f"{parameter} parameter provided in request was not an int."}), status.BAD_REQUEST
+        if 'division' not in request.args:
+            return jsonify({"error": "division parameter is required."}), status.BAD_REQUEST
+
+        division = int(request.args['division'])
+        offset = int(request.args.get('offset', 0))
+        limit = min(int(request.args.get('limit', page_max_size)), page_max_size)
+
+        db = client[db_name]
+        competition_id = get_requested_competition_id(db, current_app.config)
+        total, teams = scoreboard.page(db[db_scores_collection], competition_id, division, offset, limit)
+        return jsonify({
+            "content": "Successfully fetched scoreboard.",
+            "competition_id": competition_id,
+            "division": division,
+            "total": total,
+            "teams": teams,
+        }), status.OK
+
+    except NoActiveCompetition:
+        return jsonify({"error": "There is no active competition."}), status.BAD_REQUEST
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error getting scoreboard."}), status.INTERNAL_SERVER_ERROR
+
+
+@scoreboard_blueprint.route('/scoreboard/teams/<string:team_id>', methods=["GET"])
+def get_team_score(team_id: str) -> Tuple[Response, int]:
+    try:
+        db = client[db_name]
+        competition_id = get_requested_competition_id(db, current_app.config)
+        team = scoreboard.team_ranks(db[db_scores_collection], competition_id, team_id)
+        if team is None:
+            return jsonify({"error": "This team has no score yet."}), status.NOT_FOUND
+        return jsonify({"content": "Successfully fetched team score.", "team": team}), status.OK
+
+    except NoActiveCompetition:
+        return jsonify({"error": "There is no active competition."}), status.BAD_REQUEST
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error getting team score."}), status.INTERNAL_SERVER_ERROR
@@ -1,16 +1,24 @@
 import os
+import mimetypes
+import posixpath
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint, jsonify, Response, request, current_app, url_for
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import jwt
 import http_status_codes as status
+from pymongo import UpdateOne
 from pymongo.errors import WriteError, OperationFailure
 from datetime import date, datetime
 from pydantic import ValidationError
 from bson.objectid import ObjectId
 import logging
-import gridfs
-from models import GetAllTeachersResponse, TeacherInfo
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
+from attachments import limit_request_body, store_upload, release_attachment, UploadTooLarge
+from team_roster import update_roster_students
+from events import publish_event
 
 teachers_blueprint = Blueprint("teachers", __name__)
 secret_key = os.getenv("SECRET_KEY")
@@ -43,10 +51,7 @@ def get_teams() -> Tuple[Response, int]:
                     "school_address": document["school_address"],
                     "school_website": document["school_website"],
                 }
-
-                validated_teacher: TeacherInfo = TeacherInfo.model_validate(teacher)
-                teacher_dict = validated_teacher.model_dump()
-                teachers.append(teacher_dict)
+                teachers.append(teacher)
 
         return jsonify({"content": "Successfully fetched teachers.", "teachers": teachers}), status.OK
 
@@ -67,10 +72,12 @@ def get_teams() -> Tuple[Response, int]:
 @teachers_blueprint.route('/teachers/upload-signed-liability-release-form', methods=["POST"])
 def upload_signed_liability_release_form() -> Tuple[Response, int]:
     try:
+        max_file_size = current_app.config['LIABILITY_FORM_MAX_BYTES']
+        limit_request_body(max_file_size)
+
         db = client[db_name]
         team_collection = db[db_teams_collection]
         student_collection = db[db_students_collection]
-        fs = gridfs.GridFS(db)
 
 
         # check that liability form exists
@@ -100,13 +107,13 @@ def upload_signed_liability_release_form() -> Tuple[Response, int]:
         if team["teacher_id"] != teacher_id:
             return jsonify({"error":"Invalid request"}), status.BAD_REQUEST
 
+        # upload new signed form before removing the old one, in case the upload is rejected
+        file = request.files['signed_liability_release_form']
+        new_liability_form_id = store_upload(db, file, max_file_size)
+
         if "liability_form_id" in student and student["liability_form_id"] != None:
             # delete old form
-            fs.delete(student["liability_form_id"])
-
-        # upload new signed form
-        file = request.files['signed_liability_release_form']
-        new_liability_form_id = fs.put(file, filename=file.filename)
+            release_attachment(db, student["liability_form_id"])
 
         update_data = {
             "liability_form_id": new_liability_form_id
@@ -120,10 +127,15 @@ def upload_signed_liability_release_form() -> Tuple[Response, int]:
             {"_id": ObjectId(student["_id"])},
             {"$set": update_data}
             )
+        update_roster_students(db, current_app.config, {student["_id"]: update_data})
+        publish_event(db, current_app.config, "admin", "students_awaiting_verification", {"student_ids": [str(student["_id"])]})
 
         if update_attempt.modified_count == 1:
             return jsonify({"content": "Successfully uploaded signed form!"}), status.OK
-        
+
+    except (RequestEntityTooLarge, UploadTooLarge):
+        return jsonify({'error': 'Uploaded file is too large.'}), status.PAYLOAD_TOO_LARGE
+
     except WriteError as e:
           logging.error("WriteError: %s", e)
           return jsonify({'error': 'An error occurred while reading from the database.'}), status.INTERNAL_SERVER_ERROR
@@ -135,4 +147,142 @@ def upload_signed_liability_release_form() -> Tuple[Response, int]:
     except Exception as e:
         logging.error("Encountered exception: %s", e)
 
-    return jsonify({"content": "Error uploading signed liability release form"}), status.INTERNAL_SERVER_ERROR
\ No newline at end of file
+    return jsonify({"content": "Error uploading signed liability release form"}), status.INTERNAL_SERVER_ERROR
+
+
+def get_zipped_liability_forms(archive: zipfile.ZipFile) -> List[Tuple[str, FileStorage]]:
+    # Each form in the archive is named after its student, e.g. 65f1c0ffee0123456789abcd.pdf
+    forms = []
+    for entry in archive.infolist():
+        filename = posixpath.basename(entry.filename)
+        if entry.is_dir() or entry.filename.startswith("__MACOSX/") or filename.startswith("."):
+            continue
+        student_id = posixpath.splitext(filename)[0]
+        file = FileStorage(
+            stream=archive.open(entry),
+            filename=filename,
+            content_type=mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+        forms.append((student_id, file))
+    return forms
+
+
+@teachers_blueprint.route('/teachers/upload-signed-liability-release-forms', methods=["POST"])
+def upload_signed_liability_release_forms() -> Tuple[Response, int]:
+    # Uploads the forms for many students at once, either as a zip archive in the
+    # signed_liability_release_forms field or as one file field per student id
+    stored_form_ids: List[ObjectId] = []
+    archive: Optional[zipfile.ZipFile] = None
+    db = client[db_name]
+    try:
+        max_file_size = current_app.config['LIABILITY_FORM_MAX_BYTES']
+        limit_request_body(current_app.config['LIABILITY_FORMS_BULK_MAX_BYTES'])
+
+        team_collection = db[db_teams_collection]
+        student_collection = db[db_students_collection]
+
+        token = request.cookies.get("access_token")
+        decoded_token = jwt.decode(token, secret_key, algorithms=[auth_algorithm]) if token else None
+
+        if not decoded_token:
+            return jsonify({'error': "Unauthorized "}), status.UNAUTHORIZED
+        teacher_id = decoded_token["userId"]
+
+        if 'signed_liability_release_forms' in request.files:
+            try:
+                archive = zipfile.ZipFile(request.files['signed_liability_release_forms'].stream)
+            except zipfile.BadZipFile:
+                return jsonify({"error": "signed_liability_release_forms is not a valid zip archive."}), status.BAD_REQUEST
+            forms = get_zipped_liability_forms(archive)
+        else:
+            forms = list(request.files.items(multi=True))
+
+        if len(forms) == 0:
+            return jsonify({"error": "No signed liability release forms attached!"}), status.BAD_REQUEST
+
+        student_ids = [student_id for student_id, _ in forms]
+        invalid_ids = [student_id for student_id in student_ids if not ObjectId.is_valid(student_id)]
+        if invalid_ids:
+            return jsonify({"error": "Invalid student ids.", "student_ids": invalid_ids}), status.BAD_REQUEST
+        if len(set(student_ids)) != len(student_ids):
+            return jsonify({"error": "Each student can only have one form per upload."}), status.BAD_REQUEST
+
+        students = {
+            str(student["_id"]): student
+            for student in student_collection.find(
+                {"_id": {"$in": [ObjectId(student_id) for student_id in student_ids]}},
+                {"team_id": 1, "liability_form_id": 1}
+            )
+        }
+        missing_ids = [student_id for student_id in student_ids if student_id not in students]
+        if missing_ids:
+            return jsonify({"error": "Could not find students with those ids.", "student_ids": missing_ids}), status.BAD_REQUEST
+
+        # Authorize every student with a single query over the teacher's teams
+        team_ids = {ObjectId(student["team_id"]) for student in students.values()}
+        owned_team_ids = {
+            str(team["_id"])
+            for team in team_collection.find({"_id": {"$in": list(team_ids)}, "teacher_id": teacher_id}, {"_id": 1})
+        }
+        if any(str(student["team_id"]) not in owned_team_ids for student in students.values()):
+            return jsonify({"error": "Invalid request"}), status.BAD_REQUEST
+
+        # GridFS writes are network bound, so store the forms in parallel
+        app = current_app._get_current_object()
+
+        def store_form(file: FileStorage) -> ObjectId:
+            with app.app_context():
+                form_id = store_upload(db, file, max_file_size)
+                stored_form_ids.append(form_id)
+                return form_id
+
+        with ThreadPoolExecutor(max_workers=current_app.config['LIABILITY_FORMS_UPLOAD_WORKERS']) as executor:
+            form_ids = list(executor.map(store_form, [file for _, file in forms]))
+
+        # Once the students may reference the new forms, a failure leaves them for the file sweeper
+        stored_form_ids.clear()
+
+        # A new form always needs to be verified again
+        student_collection.bulk_write([
+            UpdateOne(
+                {"_id": ObjectId(student_id)},
+                {"$set": {"liability_form_id": form_id, "is_verified": False}}
+            )
+            for student_id, form_id in zip(student_ids, form_ids)
+        ], ordered=False)
+        update_roster_students(db, current_app.config, {
+            ObjectId(student_id): {"liability_form_id": form_id, "is_verified": False}
+            for student_id, form_id in zip(student_ids, form_ids)
+        })
+
+        publish_event(db, current_app.config, "admin", "students_awaiting_verification", {"student_ids": student_ids})
+
+        for student_id in student_ids:
+            old_form_id = students[student_id].get("liability_form_id")
+            if old_form_id is not None:
+                release_attachment(db, old_form_id)
+
+        return jsonify({"content": "Successfully uploaded signed forms!", "student_ids": student_ids}), status.OK
+
+    except (RequestEntityTooLarge, UploadTooLarge):
+        return jsonify({'error': 'Uploaded file is too large.'}), status.PAYLOAD_TOO_LARGE
+
+    except WriteError as e:
+          logging.error("WriteError: %s", e)
+          return jsonify({'error': 'An error occurred while reading from the database.'}), status.INTERNAL_SERVER_ERROR
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+
+    finally:
+        # Drop the forms that were stored before the upload failed
+        for form_id in stored_form_ids:
+            release_attachment(db, form_id)
+        if archive is not None:
+            archive.close()
+
+    return jsonify({"content": "Error uploading signed liability release forms"}), status.INTERNAL_SERVER_ERROR
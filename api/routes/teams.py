@@ -1,18 +1,24 @@
 import token
 from urllib import response
 from flask import Blueprint, jsonify, Response, request, current_app, url_for
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import http_status_codes as status
 from pymongo.errors import WriteError, OperationFailure
 from datetime import date, datetime
 from pydantic import ValidationError
 from bson.objectid import ObjectId
 import logging
-from models import CreateTeamRequest, GetTeamResponse
+from models import CreateTeamRequest
+from singleflight import coalesce
+from attachments import release_attachment
 from usernames import generate_username
 from passwords import generate_password
 import jwt
 import os
+from signed_urls import signed_file_url
+from team_roster import delete_team_roster, refresh_team_roster
+from scoreboard import publish_score, refresh_team_score, scoreboard
+from competition_scope import NoActiveCompetition, get_requested_competition_id, require_active_competition_id
 
 teams_blueprint = Blueprint("teams", __name__)
 secret_key = os.getenv("SECRET_KEY")
@@ -26,6 +32,14 @@ db_teams_collection = current_app.config['DB_TEAMS_COLLECTION']
 db_students_collection = current_app.config['DB_STUDENT_INFO_COLLECTION']
 db_student_accounts_collection: str = current_app.config['DB_STUDENT_ACCOUNTS_COLLECTION']
 db_team_accounts_collection: str = current_app.config["DB_TEAM_ACCOUNTS_COLLECTION"]
+db_team_roster_collection: str = current_app.config["DB_TEAM_ROSTER_COLLECTION"]
+
+
+def get_roster_students(roster: Dict, student_collection) -> List[Dict]:
+    # Rosters embed a limited number of students, larger teams are read from student_info
+    if roster["student_count"] <= len(roster["students"]):
+        return [{"_id": student["id"], **student} for student in roster["students"]]
+    return list(student_collection.find({"team_id": roster["_id"]}).sort("_id", 1))
 
 
 @teams_blueprint.route('/teams/create', methods=["POST"])
@@ -54,8 +68,9 @@ def create_competition() -> Tuple[Response, int]:
 
             create_team_dict["teacher_id"] = decoded_token["userId"]
 
-        # TODO: Get current active competition id from the token and add it to the team
-        create_team_dict["competition_id"] = "test_competition_id"
+        # Teams, students and accounts are registered for the active competition
+        competition_id = require_active_competition_id(db, current_app.config)
+        create_team_dict["competition_id"] = competition_id
 
         # Create team in team database collection
         response = team_collection.insert_one(create_team_dict)
@@ -73,6 +88,7 @@ def create_competition() -> Tuple[Response, int]:
                 "team_id": ObjectId(team_id),
                 "team_username": team_username,
                 "team_password": team_password,
+                "competition_id": competition_id,
         }
 
         team_account_response = team_accounts_collection.insert_one(team_account)
@@ -84,6 +100,7 @@ def create_competition() -> Tuple[Response, int]:
 
             student = {
                 "team_id": team_id,
+                "competition_id": competition_id,
                 "student_account_id": "test student account id",
                 "first_name": student["first_name"],
                 "last_name": student["last_name"],
@@ -108,7 +125,8 @@ def create_competition() -> Tuple[Response, int]:
                 "competition_password": student_competition_password,
                 "practice_username": student_practice_username,
                 "practice_password": student_practice_password,
-                "student_info_id": ObjectId(student_response.inserted_id)
+                "student_info_id": ObjectId(student_response.inserted_id),
+                "competition_id": competition_id,
             }
 
 
@@ -117,13 +135,16 @@ def create_competition() -> Tuple[Response, int]:
             if student_accounts_response.inserted_id is None:
                 return jsonify({"error": "Error creating student account."}), status.INTERNAL_SERVER_ERROR
 
-
+        refresh_team_roster(db, current_app.config, team_id)
 
         return jsonify({"content": "Created team Successfully!", "team_id": str(team_id)}), status.CREATED
 
     except ValidationError as e:
         return jsonify({'error': str(e)}), status.BAD_REQUEST
 
+    except NoActiveCompetition:
+        return jsonify({'error': "Teams can't be registered while no competition is active."}), status.BAD_REQUEST
+
     except WriteError as e:
           logging.error("WriteError: %s", e)
           return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
@@ -138,10 +159,11 @@ def create_competition() -> Tuple[Response, int]:
     return jsonify({"error": "Error creating team."}), status.INTERNAL_SERVER_ERROR
 
 @teams_blueprint.route('/teams/get')
+@coalesce(include_user=True)
 def get_teams() -> Tuple[Response, int]:
     try:
         db = client[db_name]
-        team_collection = db[db_teams_collection]
+        roster_collection = db[db_team_roster_collection]
         student_collection = db[db_students_collection]
         teacher_id: Optional[str] = None
 
@@ -158,9 +180,10 @@ def get_teams() -> Tuple[Response, int]:
 
             teacher_id = decoded_token["userId"]
 
+        competition_id = get_requested_competition_id(db, current_app.config)
         teams = []
 
-        for document in team_collection.find({"teacher_id": teacher_id}):
+        for document in roster_collection.find({"competition_id": competition_id, "teacher_id": teacher_id}):
             team = {
                 "id": str(document["_id"]),
                 "teacher_id": document["teacher_id"],
@@ -170,18 +193,17 @@ def get_teams() -> Tuple[Response, int]:
                 "is_virtual": document["is_virtual"]
             }
 
-            students = student_collection.find({"team_id": ObjectId(document["_id"])})
-
             students_list = []
-            for student in students:
+            for student in get_roster_students(document, student_collection):
                 signed_liability_release_form = None
                 if "liability_form_id" in student and student["liability_form_id"] != None:
-                    signed_liability_release_form = url_for('files.download_file', file_id=student["liability_form_id"], _external=True)
+                    signed_liability_release_form = signed_file_url(student["liability_form_id"], sensitive=True)
                 student_info = {
                     "id": str(student["_id"]),
                     "student_account_id": student["student_account_id"],
                     "first_name": student["first_name"],
                     "last_name": student["last_name"],
+                    "email": student.get("email", None),
                     "shirt_size": student["shirt_size"],
                     "signed_liability_release_form": signed_liability_release_form,
                     "is_verified": student["is_verified"],
@@ -190,13 +212,13 @@ def get_teams() -> Tuple[Response, int]:
                 students_list.append(student_info)
 
             team["students"] = students_list
-
-            validated_team: GetTeamResponse = GetTeamResponse.model_validate(team)
-            team_dict = validated_team.model_dump()
-            teams.append(team_dict)
+            teams.append(team)
 
         return jsonify({"content": "Successfully fetched teams.", "teams": teams}), status.OK
 
+    except NoActiveCompetition:
+        return jsonify({"content": "Successfully fetched teams.", "teams": []}), status.OK
+
     except WriteError as e:
         logging.error("WriteError: %s", e)
         return jsonify({'error': 'An error occurred while reading from the database.'}), status.INTERNAL_SERVER_ERROR
@@ -213,7 +235,7 @@ def get_teams() -> Tuple[Response, int]:
 def get_team_details() -> Tuple[Response, int]:
     try:
         db = client[db_name]
-        team_collection = db[db_teams_collection]
+        roster_collection = db[db_team_roster_collection]
         student_collection = db[db_students_collection]
         team_id: Optional[str] = None
 
@@ -223,7 +245,7 @@ def get_team_details() -> Tuple[Response, int]:
         if team_id is None:
             return jsonify({"error": "team_id parameter is required."}), status.BAD_REQUEST
 
-        document = team_collection.find_one({"_id": ObjectId(team_id)})
+        document = roster_collection.find_one({"_id": ObjectId(team_id)})
 
         if document is None:
             return jsonify({"error":"Could not find any team with that team_id"}), status.BAD_REQUEST
@@ -237,8 +259,6 @@ def get_team_details() -> Tuple[Response, int]:
             "is_virtual": document["is_virtual"]
         }
 
-        students = student_collection.find({"team_id": ObjectId(team_id)})
-
         students_list = [{
             "id": str(student["_id"]),
             "student_account_id": student["student_account_id"],
@@ -246,15 +266,12 @@ def get_team_details() -> Tuple[Response, int]:
             "last_name": student["last_name"],
             "email": student["email"] if "email" in student else None,
             "shirt_size": student["shirt_size"],
+            "signed_liability_release_form": None,
             "is_verified": student["is_verified"],
-        } for student in students]
+        } for student in get_roster_students(document, student_collection)]
 
         team["students"] = students_list
-
-        validated_team: GetTeamResponse = GetTeamResponse.model_validate(team)
-        team_dict = validated_team.model_dump()
-
-        return jsonify({"content": "Successfully fetched team details.", "team": team_dict}), status.OK
+        return jsonify({"content": "Successfully fetched team details.", "team": team}), status.OK
 
     except WriteError as e:
         logging.error("WriteError: %s", e)
@@ -282,6 +299,11 @@ def update_team(team_id) -> Tuple[Response, int]:
 
         # Update the students of the team if team_members is provided
         team_members = update_team_dict.pop("team_members")
+        # A team stays in the competition it registered for
+        update_team_dict.pop("competition_id", None)
+        team = team_collection.find_one({"_id": ObjectId(team_id)}, {"competition_id": 1})
+        if team is None:
+            return jsonify({"error": "Could not find any team with that team_id"}), status.BAD_REQUEST
 
         # Get the current team members from the database
         response = student_collection.find({"team_id": ObjectId(team_id)})
@@ -294,6 +316,7 @@ def update_team(team_id) -> Tuple[Response, int]:
                 # If student is not found, insert the student
                 new_student = {
                     "team_id": ObjectId(team_id),
+                    "competition_id": team.get("competition_id"),
                     "student_account_id": "test student account id",
                     "first_name": student["first_name"],
                     "last_name": student["last_name"],
@@ -315,13 +338,20 @@ def update_team(team_id) -> Tuple[Response, int]:
         for student_id in current_team_members_ids:
             if student_id not in [student["id"] for student in team_members]:
                 print(student_id)
-                response = student_collection.delete_one({"_id": ObjectId(student_id)})
+                removed_student = student_collection.find_one_and_delete({"_id": ObjectId(student_id)})
 
-                if response.deleted_count == 0:
+                if removed_student is None:
                     return jsonify({"error": "Error deleting student from collection"}), status.INTERNAL_SERVER_ERROR
 
+                if removed_student.get("liability_form_id") != None:
+                    release_attachment(db, removed_student["liability_form_id"])
+
         # Update the team
         response = team_collection.update_one({"_id": ObjectId(team_id)}, {"$set": update_team_dict})
+        refresh_team_roster(db, current_app.config, ObjectId(team_id))
+        score = refresh_team_score(db, current_app.config, ObjectId(team_id))
+        scoreboard.apply(score)
+        publish_score(db, current_app.config, score)
 
         if response.matched_count > 0:
             return jsonify({"content" : "Update team successfully!"}),status.CREATED
@@ -359,6 +389,15 @@ def delete_team(team_id) -> Tuple[Response, int]:
         if response.deleted_count == 0:
             return jsonify({"error": "Error deleting team from collection"}), status.INTERNAL_SERVER_ERROR
 
+        delete_team_roster(db, current_app.config, ObjectId(team_id))
+        score = refresh_team_score(db, current_app.config, ObjectId(team_id))
+        scoreboard.apply(score)
+        publish_score(db, current_app.config, score)
+
+        # Release the students' signed liability forms
+        for student in student_collection.find({"team_id": ObjectId(team_id), "liability_form_id": {"$ne": None}}, {"liability_form_id": 1}):
+            release_attachment(db, student["liability_form_id"])
+
         # Delete the students of the team
         response = student_collection.delete_many({"team_id": ObjectId(team_id)})
 
@@ -0,0 +1,213 @@
+import math
+from flask import Blueprint, jsonify, Response, request, current_app
+from typing import Dict, Tuple
+import http_status_codes as status
+from pymongo.errors import WriteError, OperationFailure
+from datetime import datetime
+from pydantic import ValidationError
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from werkzeug.exceptions import RequestEntityTooLarge
+import logging
+from models import CreateUploadRequest
+from attachments import store_upload_chunks, UploadTooLarge
+
+# Resumable uploads for large challenge files. The client creates an upload session,
+# PUTs the file in fixed-size chunks (in any order, retrying as needed), checks which
+# chunks are missing after an interruption, and completes the session. Completing
+# streams the staged chunks into attachment storage, and the returned upload_id can then be passed
+# as challenge_file_upload_id when creating or updating a challenge.
+
+uploads_blueprint = Blueprint("uploads", __name__)
+
+client = current_app.client
+uri = current_app.uri
+db_name = current_app.config['DB_NAME']
+db_upload_sessions_collection: str = current_app.config['DB_UPLOAD_SESSIONS_COLLECTION']
+db_upload_chunks_collection: str = current_app.config['DB_UPLOAD_CHUNKS_COLLECTION']
+
+
+def get_expected_chunk_size(upload_session: Dict, index: int) -> int:
+    remaining = upload_session["total_size"] - index * upload_session["chunk_size"]
+    return min(upload_session["chunk_size"], remaining)
+
+
+@uploads_blueprint.route('/uploads/create', methods=["POST"])
+def create_upload() -> Tuple[Response, int]:
+    try:
+        create_upload_request: CreateUploadRequest = CreateUploadRequest.model_validate_json(request.data)
+        create_upload_dict: Dict = create_upload_request.model_dump()
+
+        max_bytes = current_app.config['RESUMABLE_UPLOAD_MAX_BYTES']
+        if create_upload_dict["total_size"] <= 0 or create_upload_dict["total_size"] > max_bytes:
+            return jsonify({"error": f"total_size must be between 1 and {max_bytes} bytes."}), status.PAYLOAD_TOO_LARGE
+
+        chunk_size = current_app.config['RESUMABLE_UPLOAD_CHUNK_BYTES']
+        create_upload_dict["chunk_size"] = chunk_size
+        create_upload_dict["chunk_count"] = math.ceil(create_upload_dict["total_size"] / chunk_size)
+        create_upload_dict["received_chunks"] = []
+        create_upload_dict["status"] = "open"
+        create_upload_dict["file_id"] = None
+        create_upload_dict["created_at"] = datetime.now()
+
+        response = client[db_name][db_upload_sessions_collection].insert_one(create_upload_dict)
+
+        return jsonify({
+            "content": "Created upload successfully!",
+            "upload_id": str(response.inserted_id),
+            "chunk_size": chunk_size,
+            "chunk_count": create_upload_dict["chunk_count"],
+            }), status.CREATED
+
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), status.BAD_REQUEST
+
+    except WriteError as e:
+        logging.error("WriteError: %s", e)
+        return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error creating upload."}), status.INTERNAL_SERVER_ERROR
+
+
+@uploads_blueprint.route('/uploads/<string:upload_id>/chunks/<int:index>', methods=["PUT"])
+def upload_chunk(upload_id: str, index: int) -> Tuple[Response, int]:
+    try:
+        if not ObjectId.is_valid(upload_id):
+            return jsonify({"error": "Invalid upload_id"}), status.BAD_REQUEST
+
+        db = client[db_name]
+        sessions_collection = db[db_upload_sessions_collection]
+        upload_session = sessions_collection.find_one({"_id": ObjectId(upload_id)})
+        if upload_session is None:
+            return jsonify({"error": "Could not find any upload with that upload_id"}), status.NOT_FOUND
+        if upload_session["status"] != "open":
+            return jsonify({"error": "Upload is already completed"}), status.CONFLICT
+        if index < 0 or index >= upload_session["chunk_count"]:
+            return jsonify({"error": "Chunk index is out of range"}), status.BAD_REQUEST
+
+        # Never read more than one chunk of the body
+        expected_size = get_expected_chunk_size(upload_session, index)
+        request.max_content_length = upload_session["chunk_size"]
+        data = request.get_data(cache=False)
+        if len(data) != expected_size:
+            return jsonify({"error": f"Chunk {index} must be exactly {expected_size} bytes."}), status.BAD_REQUEST
+
+        # Re-sending a chunk replaces it, so interrupted chunks can simply be retried
+        db[db_upload_chunks_collection].replace_one(
+            {"upload_id": upload_session["_id"], "index": index},
+            {"upload_id": upload_session["_id"], "index": index, "data": Binary(data)},
+            upsert=True
+        )
+        sessions_collection.update_one(
+            {"_id": upload_session["_id"]},
+            {"$addToSet": {"received_chunks": index}}
+        )
+
+        return jsonify({"content": "Uploaded chunk successfully!", "index": index}), status.OK
+
+    except RequestEntityTooLarge:
+        return jsonify({"error": "Chunk is larger than the upload's chunk size."}), status.PAYLOAD_TOO_LARGE
+
+    except WriteError as e:
+        logging.error("WriteError: %s", e)
+        return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error uploading chunk."}), status.INTERNAL_SERVER_ERROR
+
+
+@uploads_blueprint.route('/uploads/<string:upload_id>', methods=["GET"])
+def get_upload(upload_id: str) -> Tuple[Response, int]:
+    try:
+        if not ObjectId.is_valid(upload_id):
+            return jsonify({"error": "Invalid upload_id"}), status.BAD_REQUEST
+
+        upload_session = client[db_name][db_upload_sessions_collection].find_one({"_id": ObjectId(upload_id)})
+        if upload_session is None:
+            return jsonify({"error": "Could not find any upload with that upload_id"}), status.NOT_FOUND
+
+        received_chunks = set(upload_session["received_chunks"])
+        missing_chunks = [index for index in range(upload_session["chunk_count"]) if index not in received_chunks]
+
+        return jsonify({
+            "content": "Successfully fetched upload.",
+            "upload": {
+                "upload_id": str(upload_session["_id"]),
+                "filename": upload_session["filename"],
+                "total_size": upload_session["total_size"],
+                "chunk_size": upload_session["chunk_size"],
+                "chunk_count": upload_session["chunk_count"],
+                "status": upload_session["status"],
+                "missing_chunks": missing_chunks,
+            }
+            }), status.OK
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error getting upload."}), status.INTERNAL_SERVER_ERROR
+
+
+@uploads_blueprint.route('/uploads/<string:upload_id>/complete', methods=["POST"])
+def complete_upload(upload_id: str) -> Tuple[Response, int]:
+    try:
+        if not ObjectId.is_valid(upload_id):
+            return jsonify({"error": "Invalid upload_id"}), status.BAD_REQUEST
+
+        db = client[db_name]
+        sessions_collection = db[db_upload_sessions_collection]
+
+        # Only one request may assemble the file
+        upload_session = sessions_collection.find_one_and_update(
+            {"_id": ObjectId(upload_id), "status": "open"},
+            {"$set": {"status": "assembling"}}
+        )
+        if upload_session is None:
+            return jsonify({"error": "Could not find any open upload with that upload_id"}), status.NOT_FOUND
+
+        if len(set(upload_session["received_chunks"])) != upload_session["chunk_count"]:
+            sessions_collection.update_one({"_id": upload_session["_id"]}, {"$set": {"status": "open"}})
+            return jsonify({"error": "Upload is missing chunks"}), status.BAD_REQUEST
+
+        try:
+            file_id = store_upload_chunks(db, upload_session)
+        except Exception:
+            sessions_collection.update_one({"_id": upload_session["_id"]}, {"$set": {"status": "open"}})
+            raise
+
+        sessions_collection.update_one(
+            {"_id": upload_session["_id"]},
+            {"$set": {"status": "completed", "file_id": file_id}}
+        )
+        db[db_upload_chunks_collection].delete_many({"upload_id": upload_session["_id"]})
+
+        return jsonify({"content": "Completed upload successfully!", "upload_id": upload_id}), status.OK
+
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), status.PAYLOAD_TOO_LARGE
+
+    except WriteError as e:
+        logging.error("WriteError: %s", e)
+        return jsonify({'error': 'An error occurred while writing to the database.'}), status.INTERNAL_SERVER_ERROR
+
+    except OperationFailure as e:
+        logging.error("OperationFailure: %s", e)
+        return jsonify({'error': 'Database operation failed due to an internal error.'}), status.INTERNAL_SERVER_ERROR
+
+    except Exception as e:
+        logging.error("Encountered exception: %s", e)
+        return jsonify({"error": "Error completing upload."}), status.INTERNAL_SERVER_ERROR
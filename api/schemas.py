@@ -0,0 +1,155 @@
+import logging
+from typing import Dict
+from pymongo.database import Database
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+# Database-side schemas for the collections whose documents are validated with pydantic on write.
+# Once these are installed, read paths can trust stored documents and skip per-field validation.
+
+INT_TYPES = ["int", "long"]
+NULLABLE_STRING = ["string", "null"]
+NULLABLE_OBJECT_ID = ["objectId", "null"]
+
+challenges_schema: Dict = {
+    "bsonType": "object",
+    "required": [
+        "challenge_name",
+        "points",
+        "creator_name",
+        "division",
+        "challenge_description",
+        "flag",
+        "is_flag_case_sensitive",
+        "challenge_category",
+        "verified",
+        "solution_explanation",
+    ],
+    "properties": {
+        "challenge_name": {"bsonType": "string"},
+        "points": {"bsonType": INT_TYPES},
+        "creator_name": {"bsonType": "string"},
+        "division": {"bsonType": "array", "items": {"bsonType": INT_TYPES}},
+        "challenge_description": {"bsonType": "string"},
+        "flag": {"bsonType": "string"},
+        "is_flag_case_sensitive": {"bsonType": "bool"},
+        "challenge_category": {"bsonType": "string"},
+        "verified": {"bsonType": "bool"},
+        "solution_explanation": {"bsonType": "string"},
+        "hints": {
+            "bsonType": ["array", "null"],
+            "items": {
+                "bsonType": "object",
+                "required": ["hint", "point_cost"],
+                "properties": {
+                    "hint": {"bsonType": "string"},
+                    "point_cost": {"bsonType": INT_TYPES},
+                },
+            },
+        },
+        "created_at": {"bsonType": "date"},
+        "challenge_file_attachment_id": {"bsonType": NULLABLE_OBJECT_ID},
+    },
+}
+
+teams_schema: Dict = {
+    "bsonType": "object",
+    "required": ["teacher_id", "competition_id", "name", "division", "is_virtual"],
+    "properties": {
+        "teacher_id": {"bsonType": "string"},
+        "competition_id": {"bsonType": "string"},
+        "name": {"bsonType": "string"},
+        "division": {"bsonType": "array", "items": {"bsonType": INT_TYPES}},
+        "is_virtual": {"bsonType": "bool"},
+    },
+}
+
+student_info_schema: Dict = {
+    "bsonType": "object",
+    "required": ["team_id", "student_account_id", "first_name", "last_name", "shirt_size", "is_verified"],
+    "properties": {
+        "team_id": {"bsonType": "objectId"},
+        "competition_id": {"bsonType": NULLABLE_STRING},
+        "student_account_id": {"bsonType": "string"},
+        "first_name": {"bsonType": "string"},
+        "last_name": {"bsonType": "string"},
+        "shirt_size": {"bsonType": "string"},
+        "email": {"bsonType": NULLABLE_STRING},
+        "liability_form_id": {"bsonType": NULLABLE_OBJECT_ID},
+        "is_verified": {"bsonType": "bool"},
+    },
+}
+
+competitions_schema: Dict = {
+    "bsonType": "object",
+    "required": ["competition_name", "registration_deadline", "is_active", "liability_release_form_file_id"],
+    "properties": {
+        "competition_name": {"bsonType": "string"},
+        "registration_deadline": {"bsonType": "date"},
+        "is_active": {"bsonType": "bool"},
+        "created_at": {"bsonType": "date"},
+        "liability_release_form_file_id": {"bsonType": "objectId"},
+    },
+}
+
+teacher_info_schema: Dict = {
+    "bsonType": "object",
+    "required": [
+        "account_id",
+        "first_name",
+        "last_name",
+        "school_name",
+        "school_address",
+        "school_website",
+        "contact_number",
+        "shirt_size",
+    ],
+    "properties": {
+        "account_id": {"bsonType": "objectId"},
+        "first_name": {"bsonType": "string"},
+        "last_name": {"bsonType": "string"},
+        "email": {"bsonType": "string"},
+        "created_at": {"bsonType": "date"},
+        "school_name": {"bsonType": "string"},
+        "school_address": {"bsonType": "string"},
+        "school_website": {"bsonType": "string"},
+        "contact_number": {"bsonType": "string"},
+        "shirt_size": {"bsonType": "string"},
+    },
+}
+
+
+def get_collection_schemas(config) -> Dict[str, Dict]:
+    return {
+        config["DB_CHALLENGES_COLLECTION"]: challenges_schema,
+        config["DB_TEAMS_COLLECTION"]: teams_schema,
+        config["DB_STUDENT_INFO_COLLECTION"]: student_info_schema,
+        config["DB_COMPETITION_COLLECTION"]: competitions_schema,
+        config["DB_TEACHER_INFO_COLLECTION"]: teacher_info_schema,
+    }
+
+
+def install_schema_validators(db: Database, config) -> None:
+    # "moderate" only validates inserts and updates to documents that already match,
+    # so documents written before the validators existed can still be updated.
+    existing_collections = set(db.list_collection_names())
+
+    for collection_name, schema in get_collection_schemas(config).items():
+        validator = {"$jsonSchema": schema}
+        try:
+            if collection_name in existing_collections:
+                db.command(
+                    "collMod",
+                    collection_name,
+                    validator=validator,
+                    validationLevel="moderate",
+                    validationAction="error",
+                )
+            else:
+                db.create_collection(
+                    collection_name,
+                    validator=validator,
+                    validationLevel="moderate",
+                    validationAction="error",
+                )
+        except (CollectionInvalid, OperationFailure) as e:
+            logging.error("Failed to install schema validator for %s: %s", collection_name, e)
@@ -0,0 +1,262 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Dict, List, Optional, Set, Tuple
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.client_session import ClientSession
+from pymongo.collection import Collection
+from pymongo.database import Database
+from skiplist import IndexableSkipList
+from events import publish_event
+
+# Every team's total is kept in the scores collection, one document per team keyed by the team
+# id. Correct submissions and hint unlocks change it with $inc in the same transaction that
+# records them, so the totals never need to be aggregated from the submissions. Each process
+# mirrors the totals of the competitions it serves into one indexable skiplist per division,
+# ordered by score and then by who reached it first, which answers rank and page queries in
+# O(log n). A process applies its own writes right away and picks up the writes of other
+# processes every SCOREBOARD_SYNC_SECONDS. The submissions and hint_unlocks collections record
+# the points of every event, so rebuild_scores can recompute the totals from them.
+
+# Writers in other processes can commit a little after the updated_at they set, and clocks
+# drift, so each sync reads back this far. Versions make applying a document twice harmless.
+SYNC_OVERLAP_SECONDS = 10
+
+
+def _sort_key(entry: Dict) -> Tuple:
+    last_solve_at = entry.get("last_solve_at")
+    return -entry["score"], last_solve_at.timestamp() if last_solve_at else float("inf"), str(entry["_id"])
+
+
+def _public_entry(entry: Dict) -> Dict:
+    return {
+        "team_id": str(entry["_id"]),
+        "team_name": entry.get("team_name"),
+        "score": entry["score"],
+        "solves": entry.get("solves", 0),
+        "last_solve_at": entry.get("last_solve_at"),
+    }
+
+
+def add_points(collection: Collection, team: Dict, points: int, solved_at: Optional[datetime] = None,
+               session: Optional[ClientSession] = None) -> Dict:
+    # Negative points deduct a hint's cost. Returns the team's score document after the change.
+    update: Dict = {
+        "$inc": {"score": points, "version": 1},
+        "$set": {
+            "competition_id": team.get("competition_id"),
+            "division": team["division"],
+            "team_name": team["name"],
+            "updated_at": datetime.now(),
+        },
+    }
+    if solved_at is not None:
+        update["$inc"]["solves"] = 1
+        update["$max"] = {"last_solve_at": solved_at}
+    return collection.find_one_and_update(
+        {"_id": team["_id"]},
+        update,
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+
+
+def refresh_team_score(db: Database, config, team_id: ObjectId) -> Optional[Dict]:
+    # Keeps the name and divisions on a team's score in step with the team, and takes deleted
+    # teams off the scoreboard
+    team = db[config['DB_TEAMS_COLLECTION']].find_one({"_id": team_id}, {"name": 1, "division": 1})
+    fields = {"team_name": team["name"], "division": team["division"]} if team else {"removed": True}
+    return db[config['DB_SCORES_COLLECTION']].find_one_and_update(
+        {"_id": team_id},
+        {"$set": {**fields, "updated_at": datetime.now()}, "$inc": {"version": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def publish_score(db: Database, config, entry: Optional[Dict]) -> None:
+    # Tells connected scoreboards about a changed or removed team
+    if entry is None:
+        return
+    if entry.get("removed"):
+        publish_event(db, config, "scoreboard", "team_removed", {"competition_id": entry["competition_id"], "team_id": str(entry["_id"])})
+    else:
+        publish_event(db, config, "scoreboard", "score", {"competition_id": entry["competition_id"], "division": entry["division"], **_public_entry(entry)})
+
+
+def publish_score_rebuilt(db: Database, config, competition_id: str) -> None:
+    publish_event(db, config, "scoreboard", "rebuilt", {"competition_id": competition_id})
+
+
+class Scoreboard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (competition id, division) -> sort keys of the teams in it
+        self._boards: Dict[Tuple[str, int], IndexableSkipList] = {}
+        # team id -> the score document the boards were built from
+        self._entries: Dict[str, Dict] = {}
+        self._competitions: Set[str] = set()
+        self._synced_from: Optional[datetime] = None
+
+    def _remove_locked(self, entry: Dict) -> None:
+        key = _sort_key(entry)
+        for division in set(entry["division"]):
+            self._boards[(entry["competition_id"], division)].remove(key)
+
+    def _apply_locked(self, entry: Dict) -> None:
+        team_id = str(entry["_id"])
+        current = self._entries.get(team_id)
+        if current is not None:
+            if current.get("version", 0) > entry.get("version", 0):
+                return
+            self._remove_locked(current)
+            del self._entries[team_id]
+        if entry.get("removed"):
+            return
+        self._entries[team_id] = entry
+        key = _sort_key(entry)
+        for division in set(entry["division"]):
+            self._boards.setdefault((entry["competition_id"], division), IndexableSkipList()).insert(key)
+
+    def _load_locked(self, collection: Collection, competition_id: str) -> None:
+        if competition_id in self._competitions:
+            return
+        if self._synced_from is None:
+            self._synced_from = datetime.now()
+        for entry in collection.find({"competition_id": competition_id, "removed": {"$ne": True}}):
+            self._apply_locked(entry)
+        self._competitions.add(competition_id)
+
+    def apply(self, entry: Optional[Dict]) -> None:
+        # Competitions that were never loaded will read the change from Mongo
+        if entry is None:
+            return
+        with self._lock:
+            if entry.get("competition_id") in self._competitions:
+                self._apply_locked(entry)
+
+    def sync(self, collection: Collection) -> int:
+        with self._lock:
+            competitions = list(self._competitions)
+            synced_from = self._synced_from
+        if not competitions:
+            return 0
+
+        started = datetime.now()
+        entries = list(collection.find({
+            "competition_id": {"$in": competitions},
+            "updated_at": {"$gte": synced_from - timedelta(seconds=SYNC_OVERLAP_SECONDS)},
+        }))
+        with self._lock:
+            for entry in entries:
+                if entry["competition_id"] in self._competitions:
+                    self._apply_locked(entry)
+            self._synced_from = started
+        return len(entries)
+
+    def page(self, collection: Collection, competition_id: str, division: int, offset: int, limit: int) -> Tuple[int, List[Dict]]:
+        # The number of teams in the division, and up to limit of them from the zero-based offset
+        with self._lock:
+            self._load_locked(collection, competition_id)
+            board = self._boards.get((competition_id, division))
+            if board is None:
+                return 0, []
+            keys = list(islice(board.iter_from(offset), limit))
+            return len(board), [{"rank": rank, **_public_entry(self._entries[key[2]])} for rank, key in enumerate(keys, offset + 1)]
+
+    def team_ranks(self, collection: Collection, competition_id: str, team_id: str) -> Optional[Dict]:
+        with self._lock:
+            self._load_locked(collection, competition_id)
+            entry = self._entries.get(team_id)
+            if entry is None or entry["competition_id"] != competition_id:
+                return None
+            key = _sort_key(entry)
+            ranks = {
+                str(division): self._boards[(competition_id, division)].rank(key) + 1
+                for division in set(entry["division"])
+            }
+            return {**_public_entry(entry), "ranks": ranks}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._boards.clear()
+            self._entries.clear()
+            self._competitions.clear()
+            self._synced_from = None
+
+
+scoreboard = Scoreboard()
+
+
+def rebuild_scores(db: Database, config, competition_id: str, batch_size: int = 500) -> Dict:
+    # Recomputes every team's score in the competition from the submissions and hint unlocks
+    # and writes the totals whole, so it can be run at any time
+    totals: Dict[ObjectId, Dict] = {}
+    for solved in db[config['DB_SUBMISSIONS_COLLECTION']].aggregate([
+        {"$match": {"competition_id": competition_id, "correct": True}},
+        {"$group": {"_id": "$team_id", "points": {"$sum": "$points"}, "solves": {"$sum": 1}, "last_solve_at": {"$max": "$submitted_at"}}},
+    ]):
+        totals[solved["_id"]] = {"score": solved["points"], "solves": solved["solves"], "last_solve_at": solved["last_solve_at"]}
+    for unlocked in db[config['DB_HINT_UNLOCKS_COLLECTION']].aggregate([
+        {"$match": {"competition_id": competition_id}},
+        {"$group": {"_id": "$team_id", "point_cost": {"$sum": "$point_cost"}}},
+    ]):
+        total = totals.setdefault(unlocked["_id"], {"score": 0, "solves": 0, "last_solve_at": None})
+        total["score"] -= unlocked["point_cost"]
+
+    scores_collection = db[config['DB_SCORES_COLLECTION']]
+    # Teams that have a score but no events left are reset to zero
+    team_ids = set(totals) | {score["_id"] for score in scores_collection.find({"competition_id": competition_id}, {"_id": 1})}
+    teams = {
+        team["_id"]: team
+        for team in db[config['DB_TEAMS_COLLECTION']].find({"_id": {"$in": list(team_ids)}}, {"name": 1, "division": 1})
+    }
+
+    report = {"competition_id": competition_id, "teams": 0, "removed": 0}
+    now = datetime.now()
+    operations = []
+    for team_id in team_ids:
+        team = teams.get(team_id)
+        if team is None:
+            fields: Dict = {"removed": True}
+            report["removed"] += 1
+        else:
+            fields = {
+                **totals.get(team_id, {"score": 0, "solves": 0, "last_solve_at": None}),
+                "team_name": team["name"],
+                "division": team["division"],
+                "removed": False,
+            }
+            report["teams"] += 1
+        operations.append(UpdateOne(
+            {"_id": team_id},
+            {"$set": {**fields, "competition_id": competition_id, "updated_at": now}, "$inc": {"version": 1}},
+            upsert=True
+        ))
+        if len(operations) >= batch_size:
+            scores_collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        scores_collection.bulk_write(operations, ordered=False)
+
+    logging.info("Rebuilt scoreboard: %s", report)
+    return report
+
+
+def start_scoreboard_sync(app) -> None:
+    interval = app.config['SCOREBOARD_SYNC_SECONDS']
+    if interval <= 0:
+        return
+
+    def run() -> None:
+        stop = threading.Event()
+        collection = app.client[app.config['DB_NAME']][app.config['DB_SCORES_COLLECTION']]
+        while not stop.wait(interval):
+            try:
+                scoreboard.sync(collection)
+            except Exception as e:
+                logging.error("Failed to sync the scoreboard: %s", e)
+
+    threading.Thread(target=run, name="scoreboard-sync", daemon=True).start()
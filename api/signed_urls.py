@@ -0,0 +1,66 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+from typing import Mapping, Optional
+import jwt
+from flask import current_app, request, url_for
+
+secret_key = os.getenv("SECRET_KEY")
+auth_algorithm = os.getenv("AUTH_ALGORITHM")
+
+# Download URLs carry their own authorization: the file id, an expiry and whether shared
+# caches may keep the file are signed with the secret key, so /files/<file_id> can be
+# authorized without a cookie or a database lookup. Who may see a file is decided when
+# the URL is handed out. Files with passwords or personal data, such as reports and
+# liability forms, are signed with cache=private and are never stored by proxies.
+
+CACHE_PUBLIC = "public"
+CACHE_PRIVATE = "private"
+
+def _sign(file_id: str, expires: int, cache: str) -> str:
+    message = f"{file_id}.{expires}.{cache}".encode('utf-8')
+    digest = hmac.new(secret_key.encode('utf-8'), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode('utf-8').rstrip("=")
+
+def get_request_role() -> Optional[str]:
+    token = request.cookies.get("access_token")
+    if not token:
+        return None
+    try:
+        decoded_token = jwt.decode(token, secret_key, algorithms=[auth_algorithm])
+        return decoded_token.get("role")
+    except jwt.InvalidTokenError:
+        return None
+
+def signed_file_url(file_id, sensitive: bool = False, ttl: Optional[int] = None) -> str:
+    cache = CACHE_PRIVATE if sensitive else CACHE_PUBLIC
+    expires = int(time.time()) + (ttl if ttl is not None else current_app.config['SIGNED_URL_TTL_SECONDS'])
+    # Rounded up to the end of its bucket, so a file gets the same URL for the whole
+    # bucket and browsers and proxies can keep serving it from their caches
+    bucket = current_app.config['SIGNED_URL_BUCKET_SECONDS']
+    expires = -(-expires // bucket) * bucket
+    return url_for(
+        'files.download_file',
+        file_id=str(file_id),
+        expires=expires,
+        cache=cache,
+        signature=_sign(str(file_id), expires, cache),
+        _external=True
+    )
+
+def verify_file_signature(file_id: str, args: Mapping[str, str]) -> bool:
+    signature = args.get("signature")
+    expires = args.get("expires")
+    cache = args.get("cache")
+    if not signature or not expires or not expires.isdigit():
+        return False
+    if cache not in (CACHE_PUBLIC, CACHE_PRIVATE):
+        return False
+    if int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _sign(file_id, int(expires), cache))
+
+def get_signature_max_age(args: Mapping[str, str]) -> int:
+    return max(0, int(args.get("expires", 0)) - int(time.time()))
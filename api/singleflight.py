@@ -0,0 +1,86 @@
+import threading
+from functools import wraps
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+from flask import Response, request
+from middleware import decode_token
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    # Runs at most one computation per key at a time. Callers that arrive while a
+    # computation is in flight wait for it and share its result. Nothing is kept
+    # once the computation finishes, so results are never stale.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+flights = SingleFlight()
+
+
+def _request_key(include_user: bool) -> Tuple:
+    token_data = None
+    access_token = request.cookies.get("access_token")
+    if access_token:
+        token_data = decode_token(access_token)
+
+    role = token_data.get("role") if token_data else None
+    user_id = token_data.get("userId") if token_data and include_user else None
+    view_args = tuple(sorted((request.view_args or {}).items()))
+    args = tuple(sorted(request.args.items(multi=True)))
+
+    # The host is part of the key because responses contain external URLs
+    return (request.endpoint, request.host, view_args, args, role, user_id)
+
+
+def coalesce(include_user: bool = False):
+    # Coalesces concurrent identical GET requests onto one execution of the view.
+    # Set include_user when the view reads the caller's id from the access token.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET":
+                return view(*args, **kwargs)
+
+            def run():
+                response, status_code = view(*args, **kwargs)
+                return response.get_data(), response.mimetype, status_code
+
+            body, mimetype, status_code = flights.do(_request_key(include_user), run)
+            return Response(body, mimetype=mimetype), status_code
+
+        return wrapper
+
+    return decorator
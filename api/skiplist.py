@@ -0,0 +1,93 @@
+import random
+from typing import Any, Iterator, List, Optional
+
+# Sorted list of unique keys where insert, remove, rank and access by position are all
+# O(log n) on average. Every link stores its width, the number of positions it skips, so
+# the position of a node is the sum of the widths followed to reach it.
+
+MAX_LEVEL = 32
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key: Any, level: int):
+        self.key = key
+        self.next: List[Optional["_Node"]] = [None] * level
+        self.width: List[int] = [1] * level
+
+
+class IndexableSkipList:
+    def __init__(self):
+        self._head = _Node(None, MAX_LEVEL)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _path(self, key: Any):
+        # The last node before key on every level, and that node's position (head is 0)
+        update: List[_Node] = [self._head] * MAX_LEVEL
+        positions = [0] * MAX_LEVEL
+        node = self._head
+        position = 0
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            update[level] = node
+            positions[level] = position
+        return update, positions
+
+    def insert(self, key: Any) -> None:
+        update, positions = self._path(key)
+        level = 1
+        while level < MAX_LEVEL and random.random() < 0.5:
+            level += 1
+
+        node = _Node(key, level)
+        position = positions[0] + 1
+        for i in range(level):
+            node.next[i] = update[i].next[i]
+            node.width[i] = positions[i] + update[i].width[i] + 1 - position
+            update[i].next[i] = node
+            update[i].width[i] = position - positions[i]
+        for i in range(level, MAX_LEVEL):
+            update[i].width[i] += 1
+        self._size += 1
+
+    def remove(self, key: Any) -> bool:
+        update, _ = self._path(key)
+        node = update[0].next[0]
+        if node is None or node.key != key:
+            return False
+        for i in range(MAX_LEVEL):
+            if update[i].next[i] is node:
+                update[i].width[i] += node.width[i] - 1
+                update[i].next[i] = node.next[i]
+            else:
+                update[i].width[i] -= 1
+        self._size -= 1
+        return True
+
+    def rank(self, key: Any) -> Optional[int]:
+        # Zero-based position of key, None if it isn't in the list
+        update, positions = self._path(key)
+        node = update[0].next[0]
+        if node is None or node.key != key:
+            return None
+        return positions[0]
+
+    def iter_from(self, index: int) -> Iterator[Any]:
+        # Keys from the zero-based index on, in order
+        if index < 0 or index >= self._size:
+            return
+        node = self._head
+        remaining = index + 1
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        while node is not None:
+            yield node.key
+            node = node.next[0]
@@ -0,0 +1,510 @@
+import json
+import logging
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterator, List, Optional
+from bson.objectid import ObjectId
+from flask import current_app
+from pymongo.database import Database
+import gridfs
+import gridfs.errors
+
+# Attachment contents live behind a small storage interface so they can be moved out of the
+# primary database. The interface follows GridFS: new_file returns a writer with write, close,
+# abort and a metadata attribute, and open returns a seekable reader with the file's filename,
+# content_type, length, upload_date (naive UTC) and metadata. Files keep their ObjectId in every
+# backend, so documents that reference a file don't change when files are migrated.
+
+STORAGE_BACKENDS = ["gridfs", "local", "s3"]
+DEFAULT_CHUNK_SIZE = 255 * 1024
+METADATA_SUFFIX = ".json"
+TEMP_PREFIX = ".tmp-"
+
+
+class FileNotFound(Exception):
+    pass
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class StoredFile:
+    def __init__(self, file_id: ObjectId, stream: BinaryIO, attributes: Dict):
+        self._id = file_id
+        self._stream = stream
+        self.filename: Optional[str] = attributes.get("filename")
+        self.content_type: Optional[str] = attributes.get("content_type")
+        self.length: int = attributes["length"]
+        self.upload_date: datetime = attributes["upload_date"]
+        self.metadata: Optional[Dict] = attributes.get("metadata")
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+
+    def read(self, size: int = -1) -> bytes:
+        return self._stream.read(size)
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, position: int, whence: int = os.SEEK_SET) -> int:
+        return self._stream.seek(position, whence)
+
+    def tell(self) -> int:
+        return self._stream.tell()
+
+    def close(self) -> None:
+        self._stream.close()
+
+
+class AttachmentStorage(ABC):
+    @abstractmethod
+    def new_file(self, filename: Optional[str] = None, content_type: Optional[str] = None,
+                 file_id: Optional[ObjectId] = None, upload_date: Optional[datetime] = None):
+        ...
+
+    @abstractmethod
+    def open(self, file_id: ObjectId):
+        ...
+
+    @abstractmethod
+    def exists(self, file_id: ObjectId) -> bool:
+        ...
+
+    @abstractmethod
+    def delete(self, file_id: ObjectId) -> None:
+        ...
+
+    def delete_many(self, file_ids: List[ObjectId]) -> None:
+        for file_id in file_ids:
+            self.delete(file_id)
+
+    @abstractmethod
+    def list_files(self) -> Iterator[Dict]:
+        # Yields {"_id", "length", "upload_date"} for every stored file
+        ...
+
+    def local_path(self, file_id: ObjectId) -> Optional[str]:
+        # Backends that keep files on this host return a path that can be sent with sendfile
+        return None
+
+
+class _GridFSWriter:
+    def __init__(self, db: Database, grid_in, upload_date: Optional[datetime]):
+        self._db = db
+        self._grid_in = grid_in
+        self._upload_date = upload_date
+
+    @property
+    def _id(self) -> ObjectId:
+        return self._grid_in._id
+
+    @property
+    def metadata(self) -> Optional[Dict]:
+        return self._grid_in.metadata
+
+    @metadata.setter
+    def metadata(self, metadata: Dict) -> None:
+        self._grid_in.metadata = metadata
+
+    def write(self, data: bytes) -> None:
+        self._grid_in.write(data)
+
+    def abort(self) -> None:
+        if self._grid_in.closed:
+            # The file was stored but closing failed afterwards
+            self._db["fs.chunks"].delete_many({"files_id": self._id})
+            self._db["fs.files"].delete_one({"_id": self._id})
+        else:
+            self._grid_in.abort()
+
+    def close(self) -> None:
+        self._grid_in.close()
+        if self._upload_date is not None:
+            # GridIn always stamps the current time, keep the original date of a migrated file
+            self._db["fs.files"].update_one({"_id": self._id}, {"$set": {"uploadDate": self._upload_date}})
+
+
+class GridFSStorage(AttachmentStorage):
+    def __init__(self, db: Database):
+        self.db = db
+        self.fs = gridfs.GridFS(db)
+
+    def new_file(self, filename=None, content_type=None, file_id=None, upload_date=None):
+        options = {"filename": filename, "content_type": content_type}
+        if file_id is not None:
+            options["_id"] = file_id
+        return _GridFSWriter(self.db, self.fs.new_file(**options), upload_date)
+
+    def open(self, file_id: ObjectId):
+        try:
+            return self.fs.get(file_id)
+        except gridfs.errors.NoFile:
+            raise FileNotFound(file_id)
+
+    def exists(self, file_id: ObjectId) -> bool:
+        return self.fs.exists(file_id)
+
+    def delete(self, file_id: ObjectId) -> None:
+        self.fs.delete(file_id)
+
+    def delete_many(self, file_ids: List[ObjectId]) -> None:
+        # GridFS has no bulk delete, so remove the chunks and file documents directly
+        self.db["fs.chunks"].delete_many({"files_id": {"$in": file_ids}})
+        self.db["fs.files"].delete_many({"_id": {"$in": file_ids}})
+
+    def list_files(self) -> Iterator[Dict]:
+        for document in self.db["fs.files"].find({}, {"_id": 1, "length": 1, "uploadDate": 1}):
+            yield {"_id": document["_id"], "length": document.get("length", 0), "upload_date": document["uploadDate"]}
+
+
+class _LocalWriter:
+    def __init__(self, storage: "LocalFileStorage", file_id: ObjectId, attributes: Dict):
+        self._id = file_id
+        self._storage = storage
+        self._attributes = attributes
+        self._length = 0
+        self.metadata: Optional[Dict] = None
+        fd, self._temp_path = tempfile.mkstemp(dir=storage.directory, prefix=TEMP_PREFIX)
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._length += len(data)
+
+    def abort(self) -> None:
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self._file.close()
+        data_path = self._storage._data_path(self._id)
+        if os.path.exists(data_path):
+            self.abort()
+            raise FileExistsError(f"file with _id {self._id!r} already exists")
+        os.replace(self._temp_path, data_path)
+        try:
+            self._storage._write_attributes(self._id, {
+                **self._attributes,
+                "length": self._length,
+                "upload_date": (self._attributes["upload_date"] or utcnow()).replace(tzinfo=timezone.utc).timestamp(),
+                "metadata": self.metadata,
+            })
+        except Exception:
+            os.remove(data_path)
+            raise
+
+
+class LocalFileStorage(AttachmentStorage):
+    # One data file per attachment named after its id, with a JSON sidecar for the attributes.
+    # The sidecar is written last, so a file only exists once it is complete.
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _data_path(self, file_id: ObjectId) -> str:
+        return os.path.join(self.directory, str(file_id))
+
+    def _write_attributes(self, file_id: ObjectId, attributes: Dict) -> None:
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=TEMP_PREFIX)
+        with os.fdopen(fd, "w") as temp_file:
+            json.dump(attributes, temp_file)
+        os.replace(temp_path, self._data_path(file_id) + METADATA_SUFFIX)
+
+    def _read_attributes(self, file_id: ObjectId) -> Dict:
+        try:
+            with open(self._data_path(file_id) + METADATA_SUFFIX) as metadata_file:
+                attributes = json.load(metadata_file)
+        except FileNotFoundError:
+            raise FileNotFound(file_id)
+        attributes["upload_date"] = datetime.fromtimestamp(attributes["upload_date"], timezone.utc).replace(tzinfo=None)
+        return attributes
+
+    def new_file(self, filename=None, content_type=None, file_id=None, upload_date=None):
+        return _LocalWriter(self, file_id or ObjectId(), {
+            "filename": filename,
+            "content_type": content_type,
+            "upload_date": upload_date,
+        })
+
+    def open(self, file_id: ObjectId) -> StoredFile:
+        attributes = self._read_attributes(file_id)
+        try:
+            stream = open(self._data_path(file_id), "rb")
+        except FileNotFoundError:
+            raise FileNotFound(file_id)
+        return StoredFile(file_id, stream, attributes)
+
+    def exists(self, file_id: ObjectId) -> bool:
+        return os.path.exists(self._data_path(file_id) + METADATA_SUFFIX)
+
+    def delete(self, file_id: ObjectId) -> None:
+        data_path = self._data_path(file_id)
+        for path in (data_path + METADATA_SUFFIX, data_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def list_files(self) -> Iterator[Dict]:
+        with os.scandir(self.directory) as scanned:
+            names = [entry.name for entry in scanned if entry.name.endswith(METADATA_SUFFIX)]
+        for name in names:
+            file_id = name[:-len(METADATA_SUFFIX)]
+            if not ObjectId.is_valid(file_id):
+                continue
+            try:
+                attributes = self._read_attributes(ObjectId(file_id))
+            except FileNotFound:
+                continue
+            yield {"_id": ObjectId(file_id), "length": attributes["length"], "upload_date": attributes["upload_date"]}
+
+    def local_path(self, file_id: ObjectId) -> Optional[str]:
+        return self._data_path(file_id)
+
+
+class _S3Reader:
+    # Reads the object with ranged GETs, reopening the body only after a seek
+    def __init__(self, storage: "S3Storage", key: str, length: int):
+        self._storage = storage
+        self._key = key
+        self._length = length
+        self._position = 0
+        self._body = None
+
+    def read(self, size: int = -1) -> bytes:
+        if self._position >= self._length:
+            return b""
+        if self._body is None:
+            response = self._storage.client.get_object(
+                Bucket=self._storage.bucket,
+                Key=self._key,
+                Range=f"bytes={self._position}-"
+            )
+            self._body = response["Body"]
+        data = self._body.read() if size is None or size < 0 else self._body.read(size)
+        self._position += len(data)
+        return data
+
+    def seek(self, position: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += self._length
+        if position != self._position:
+            self.close()
+            self._position = position
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+
+class _S3Writer:
+    # Spools the upload to a temporary file so the metadata set after writing can be stored
+    # with the object, then hands it to boto3, which uploads large files as parallel parts
+    def __init__(self, storage: "S3Storage", file_id: ObjectId, filename: Optional[str],
+                 content_type: Optional[str], upload_date: Optional[datetime]):
+        self._id = file_id
+        self._storage = storage
+        self._filename = filename
+        self._content_type = content_type
+        self._upload_date = upload_date
+        self.metadata: Optional[Dict] = None
+        self._file = tempfile.SpooledTemporaryFile(max_size=storage.spool_bytes)
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+
+    def abort(self) -> None:
+        self._file.close()
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        object_metadata = {"attributes": json.dumps({
+            "filename": self._filename,
+            "upload_date": (self._upload_date or utcnow()).replace(tzinfo=timezone.utc).timestamp(),
+            "metadata": self.metadata,
+        })}
+        extra_args = {"Metadata": object_metadata}
+        if self._content_type:
+            extra_args["ContentType"] = self._content_type
+        try:
+            self._file.seek(0)
+            self._storage.client.upload_fileobj(
+                self._file,
+                self._storage.bucket,
+                self._storage._key(self._id),
+                ExtraArgs=extra_args
+            )
+        finally:
+            self._file.close()
+
+
+class S3Storage(AttachmentStorage):
+    # Works with AWS S3 and S3-compatible stores such as MinIO through endpoint_url
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None, region: Optional[str] = None,
+                 access_key_id: Optional[str] = None, secret_access_key: Optional[str] = None,
+                 spool_bytes: int = 8 * 1024 * 1024):
+        # boto3 is only needed when this backend is configured
+        import boto3
+        from botocore.exceptions import ClientError
+
+        if not bucket:
+            raise ValueError("S3_BUCKET must be set to use S3 attachment storage.")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.spool_bytes = spool_bytes
+        self.client_error = ClientError
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key
+        )
+
+    def _key(self, file_id: ObjectId) -> str:
+        return f"{self.prefix}{file_id}"
+
+    def _is_not_found(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def new_file(self, filename=None, content_type=None, file_id=None, upload_date=None):
+        return _S3Writer(self, file_id or ObjectId(), filename, content_type, upload_date)
+
+    def open(self, file_id: ObjectId) -> StoredFile:
+        key = self._key(file_id)
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client_error as e:
+            if self._is_not_found(e):
+                raise FileNotFound(file_id)
+            raise
+
+        attributes = json.loads(head.get("Metadata", {}).get("attributes", "{}"))
+        if "upload_date" in attributes:
+            upload_date = datetime.fromtimestamp(attributes["upload_date"], timezone.utc).replace(tzinfo=None)
+        else:
+            upload_date = head["LastModified"].astimezone(timezone.utc).replace(tzinfo=None)
+        return StoredFile(file_id, _S3Reader(self, key, head["ContentLength"]), {
+            "filename": attributes.get("filename"),
+            "content_type": head.get("ContentType"),
+            "length": head["ContentLength"],
+            "upload_date": upload_date,
+            "metadata": attributes.get("metadata"),
+        })
+
+    def exists(self, file_id: ObjectId) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(file_id))
+            return True
+        except self.client_error as e:
+            if self._is_not_found(e):
+                return False
+            raise
+
+    def delete(self, file_id: ObjectId) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(file_id))
+
+    def delete_many(self, file_ids: List[ObjectId]) -> None:
+        # DeleteObjects accepts at most 1000 keys per request
+        for start in range(0, len(file_ids), 1000):
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": self._key(file_id)} for file_id in file_ids[start:start + 1000]], "Quiet": True}
+            )
+            for error in response.get("Errors", []):
+                logging.error("Failed to delete %s: %s", error.get("Key"), error.get("Message"))
+
+    def list_files(self) -> Iterator[Dict]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                file_id = item["Key"][len(self.prefix):]
+                if not ObjectId.is_valid(file_id):
+                    continue
+                yield {
+                    "_id": ObjectId(file_id),
+                    "length": item["Size"],
+                    "upload_date": item["LastModified"].astimezone(timezone.utc).replace(tzinfo=None),
+                }
+
+
+def create_storage(backend: str, db: Database, config) -> AttachmentStorage:
+    if backend == "gridfs":
+        return GridFSStorage(db)
+    if backend == "local":
+        return LocalFileStorage(config['ATTACHMENT_STORAGE_DIR'])
+    if backend == "s3":
+        return S3Storage(
+            config['S3_BUCKET'],
+            prefix=config['S3_PREFIX'],
+            endpoint_url=config['S3_ENDPOINT_URL'],
+            region=config['S3_REGION'],
+            access_key_id=config['S3_ACCESS_KEY_ID'],
+            secret_access_key=config['S3_SECRET_ACCESS_KEY']
+        )
+    raise ValueError(f"Unknown attachment storage backend {backend!r}, expected one of {STORAGE_BACKENDS}.")
+
+
+def copy_file(source: AttachmentStorage, target: AttachmentStorage, file_id: ObjectId) -> int:
+    # Streams one file between backends, keeping its id, attributes and upload date
+    source_file = source.open(file_id)
+    writer = target.new_file(
+        filename=source_file.filename,
+        content_type=source_file.content_type,
+        file_id=file_id,
+        upload_date=source_file.upload_date
+    )
+    try:
+        while True:
+            block = source_file.read(source_file.chunk_size)
+            if not block:
+                break
+            writer.write(block)
+        writer.metadata = source_file.metadata
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        source_file.close()
+    return source_file.length
+
+
+def migrate_files(source: AttachmentStorage, target: AttachmentStorage, delete_source: bool = False) -> Dict:
+    # Files already in the target are skipped, so an interrupted migration can be run again
+    report = {"copied_files": 0, "copied_bytes": 0, "skipped_files": 0, "failed_files": 0, "deleted_files": 0}
+    for entry in list(source.list_files()):
+        file_id = entry["_id"]
+        try:
+            if target.exists(file_id):
+                report["skipped_files"] += 1
+            else:
+                report["copied_bytes"] += copy_file(source, target, file_id)
+                report["copied_files"] += 1
+            if delete_source:
+                source.delete(file_id)
+                report["deleted_files"] += 1
+        except Exception as e:
+            logging.error("Failed to migrate file %s: %s", file_id, e)
+            report["failed_files"] += 1
+    return report
+
+
+attachment_storage: AttachmentStorage = create_storage(
+    current_app.config['ATTACHMENT_STORAGE'],
+    current_app.client[current_app.config['DB_NAME']],
+    current_app.config
+)
@@ -0,0 +1,173 @@
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+from bson.objectid import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.database import Database
+
+# team_roster holds one document per team, keyed by the team id, with the team's teacher and
+# its first TEAM_ROSTER_MAX_STUDENTS students embedded, so listing teams and building reports
+# read a single collection. The teams, students and teacher_info collections stay the source
+# of truth. Routes that change a team refresh its roster document from them, and routes that
+# change single student fields update the embedded copies in place. A roster document is
+# always rebuilt from the sources as a whole, so rebuilds can be repeated safely, and
+# check_team_rosters compares every document with a fresh rebuild to find drift.
+
+TEACHER_FIELDS = ("first_name", "last_name", "email", "contact_number", "shirt_size", "school_name")
+STUDENT_FIELDS = ("student_account_id", "first_name", "last_name", "email", "shirt_size", "liability_form_id", "is_verified")
+
+
+def _find_teachers(db: Database, config, teacher_ids: Iterable[str]) -> Dict[str, Dict]:
+    # Teams created by a teacher store the teacher's account id, teams created by an admin
+    # may store the teacher_info id, so match either
+    object_ids = [ObjectId(teacher_id) for teacher_id in set(teacher_ids) if ObjectId.is_valid(teacher_id)]
+    if not object_ids:
+        return {}
+    teachers: Dict[str, Dict] = {}
+    for teacher in db[config['DB_TEACHER_INFO_COLLECTION']].find(
+        {"$or": [{"account_id": {"$in": object_ids}}, {"_id": {"$in": object_ids}}]}
+    ):
+        teachers[str(teacher["_id"])] = teacher
+        if teacher.get("account_id") is not None:
+            teachers[str(teacher["account_id"])] = teacher
+    return teachers
+
+
+def build_roster_documents(db: Database, config, teams: List[Dict]) -> List[Dict]:
+    # Three queries for any number of teams
+    max_students = config['TEAM_ROSTER_MAX_STUDENTS']
+    teachers = _find_teachers(db, config, (team["teacher_id"] for team in teams if team.get("teacher_id")))
+
+    students_by_team: Dict[ObjectId, List[Dict]] = {team["_id"]: [] for team in teams}
+    for student in db[config['DB_STUDENT_INFO_COLLECTION']].find({"team_id": {"$in": list(students_by_team)}}).sort("_id", 1):
+        students_by_team[student["team_id"]].append(student)
+
+    rosters = []
+    for team in teams:
+        teacher = teachers.get(str(team.get("teacher_id")))
+        students = students_by_team[team["_id"]]
+        rosters.append({
+            "_id": team["_id"],
+            "teacher_id": team.get("teacher_id"),
+            "competition_id": team.get("competition_id"),
+            "name": team["name"],
+            "division": team["division"],
+            "is_virtual": team["is_virtual"],
+            "teacher": {"id": teacher["_id"], **{field: teacher.get(field) for field in TEACHER_FIELDS}} if teacher else None,
+            "students": [
+                {"id": student["_id"], **{field: student.get(field) for field in STUDENT_FIELDS}}
+                for student in students[:max_students]
+            ],
+            # Readers that need every student fall back to student_info when this is larger
+            "student_count": len(students),
+        })
+    return rosters
+
+
+def refresh_team_rosters(db: Database, config, team_ids: Iterable[ObjectId]) -> None:
+    team_ids = list(set(team_ids))
+    if not team_ids:
+        return
+    roster_collection = db[config['DB_TEAM_ROSTER_COLLECTION']]
+    teams = list(db[config['DB_TEAMS_COLLECTION']].find({"_id": {"$in": team_ids}}))
+    now = datetime.now()
+    writes = [
+        ReplaceOne({"_id": roster["_id"]}, {**roster, "refreshed_at": now}, upsert=True)
+        for roster in build_roster_documents(db, config, teams)
+    ]
+    if writes:
+        roster_collection.bulk_write(writes, ordered=False)
+
+    # Teams that no longer exist
+    deleted_ids = set(team_ids) - {team["_id"] for team in teams}
+    if deleted_ids:
+        roster_collection.delete_many({"_id": {"$in": list(deleted_ids)}})
+
+
+def refresh_team_roster(db: Database, config, team_id: ObjectId) -> None:
+    refresh_team_rosters(db, config, [team_id])
+
+
+def delete_team_roster(db: Database, config, team_id: ObjectId) -> None:
+    db[config['DB_TEAM_ROSTER_COLLECTION']].delete_one({"_id": team_id})
+
+
+def update_roster_students(db: Database, config, student_updates: Dict[ObjectId, Dict]) -> None:
+    # Sets fields of embedded students in place, e.g. {student_id: {"is_verified": True}}.
+    # Students past the embedded limit aren't in any roster, so those updates match nothing.
+    writes = [
+        UpdateOne(
+            {"students.id": student_id},
+            {"$set": {f"students.$.{field}": value for field, value in fields.items()}}
+        )
+        for student_id, fields in student_updates.items()
+    ]
+    if writes:
+        db[config['DB_TEAM_ROSTER_COLLECTION']].bulk_write(writes, ordered=False)
+
+
+def _team_batches(db: Database, config, batch_size: int) -> Iterable[List[Dict]]:
+    batch: List[Dict] = []
+    for team in db[config['DB_TEAMS_COLLECTION']].find().sort("_id", 1).batch_size(batch_size):
+        batch.append(team)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _roster_differs(stored: Optional[Dict], expected: Dict) -> bool:
+    if stored is None:
+        return True
+    stored = {key: value for key, value in stored.items() if key != "refreshed_at"}
+    return stored != expected
+
+
+def check_team_rosters(db: Database, config, repair: bool = False, batch_size: int = 500) -> Dict:
+    # Compares every roster document with one rebuilt from the sources. With repair, missing
+    # and stale documents are rewritten and documents of deleted teams are removed, which
+    # makes it a full rebuild that only writes what changed.
+    roster_collection = db[config['DB_TEAM_ROSTER_COLLECTION']]
+    report = {"repaired": repair, "teams": 0, "missing": 0, "stale": 0, "orphaned": 0}
+    team_ids = set()
+    now = datetime.now()
+
+    for teams in _team_batches(db, config, batch_size):
+        expected_rosters = build_roster_documents(db, config, teams)
+        stored_rosters = {
+            roster["_id"]: roster
+            for roster in roster_collection.find({"_id": {"$in": [team["_id"] for team in teams]}})
+        }
+        writes = []
+        for expected in expected_rosters:
+            team_ids.add(expected["_id"])
+            stored = stored_rosters.get(expected["_id"])
+            if not _roster_differs(stored, expected):
+                continue
+            if stored is None:
+                report["missing"] += 1
+            else:
+                report["stale"] += 1
+                logging.warning("Team roster %s is out of date", expected["_id"])
+            writes.append(ReplaceOne({"_id": expected["_id"]}, {**expected, "refreshed_at": now}, upsert=True))
+        report["teams"] += len(teams)
+        if repair and writes:
+            roster_collection.bulk_write(writes, ordered=False)
+
+    orphaned_ids = [roster["_id"] for roster in roster_collection.find({}, {"_id": 1}) if roster["_id"] not in team_ids]
+    if orphaned_ids:
+        # Skip teams created while the check ran
+        created_ids = {team["_id"] for team in db[config['DB_TEAMS_COLLECTION']].find({"_id": {"$in": orphaned_ids}}, {"_id": 1})}
+        orphaned_ids = [roster_id for roster_id in orphaned_ids if roster_id not in created_ids]
+    report["orphaned"] = len(orphaned_ids)
+    if repair and orphaned_ids:
+        for start in range(0, len(orphaned_ids), batch_size):
+            roster_collection.delete_many({"_id": {"$in": orphaned_ids[start:start + batch_size]}})
+
+    logging.info("Team roster check finished: %s", report)
+    return report
+
+
+def rebuild_team_rosters(db: Database, config, batch_size: int = 500) -> Dict:
+    return check_team_rosters(db, config, repair=True, batch_size=batch_size)
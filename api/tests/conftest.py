@@ -0,0 +1,34 @@
+import os
+import sys
+import mongomock
+import mongomock.gridfs
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# mongomock only patches GridFS once this is called, before any GridFS instance is created
+mongomock.gridfs.enable_gridfs_integration()
+
+
+@pytest.fixture(scope="session")
+def mongo_client():
+    return mongomock.MongoClient()
+
+
+@pytest.fixture(scope="session")
+def app(mongo_client):
+    # Modules that read the app config when imported, such as storage, need an app context.
+    # This is the smallest app they accept, without the routes and background workers.
+    app = Flask(__name__)
+    app.client = mongo_client
+    app.config.update(DB_NAME="crimsondefense_ctf_test", ATTACHMENT_STORAGE="gridfs")
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def db(mongo_client):
+    database = mongo_client["crimsondefense_ctf_test"]
+    yield database
+    mongo_client.drop_database("crimsondefense_ctf_test")
@@ -0,0 +1,180 @@
+import os
+from datetime import datetime
+import boto3
+import pytest
+from bson.objectid import ObjectId
+from moto import mock_aws
+
+
+@pytest.fixture
+def storage_module(app):
+    import storage
+    return storage
+
+
+@pytest.fixture
+def local_storage(storage_module, tmp_path):
+    return storage_module.LocalFileStorage(str(tmp_path / "attachments"))
+
+
+@pytest.fixture
+def gridfs_storage(storage_module, db):
+    return storage_module.GridFSStorage(db)
+
+
+@pytest.fixture
+def s3_storage(storage_module, monkeypatch):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    with mock_aws():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="attachments")
+        yield storage_module.S3Storage("attachments", prefix="files/", region="us-east-1", spool_bytes=1024)
+
+
+@pytest.fixture(params=["local", "gridfs", "s3"])
+def storage(request):
+    return request.getfixturevalue(f"{request.param}_storage")
+
+
+def write(storage, data: bytes, **options) -> ObjectId:
+    writer = storage.new_file(filename="notes.txt", content_type="text/plain", **options)
+    writer.write(data[:10])
+    writer.write(data[10:])
+    writer.metadata = {"sha256": "abc"}
+    writer.close()
+    return writer._id
+
+
+def read(storage, file_id: ObjectId) -> bytes:
+    stored_file = storage.open(file_id)
+    try:
+        return stored_file.read()
+    finally:
+        stored_file.close()
+
+
+def test_round_trip(storage):
+    data = os.urandom(5000)
+    file_id = write(storage, data)
+
+    stored_file = storage.open(file_id)
+    assert stored_file.filename == "notes.txt"
+    assert stored_file.content_type == "text/plain"
+    assert stored_file.length == len(data)
+    assert stored_file.metadata == {"sha256": "abc"}
+    assert stored_file.read() == data
+    stored_file.seek(100)
+    assert stored_file.read(50) == data[100:150]
+    assert stored_file.tell() == 150
+    stored_file.close()
+
+    assert storage.exists(file_id)
+    assert [entry["_id"] for entry in storage.list_files()] == [file_id]
+
+
+def test_keeps_id_and_upload_date(storage):
+    file_id = ObjectId()
+    upload_date = datetime(2021, 3, 4, 5, 6, 7)
+    assert write(storage, b"x" * 20, file_id=file_id, upload_date=upload_date) == file_id
+    assert storage.open(file_id).upload_date == upload_date
+
+
+def test_delete(storage):
+    file_ids = [write(storage, bytes([i]) * 20) for i in range(3)]
+    storage.delete(file_ids[0])
+    storage.delete_many(file_ids[1:])
+    for file_id in file_ids:
+        assert not storage.exists(file_id)
+    assert list(storage.list_files()) == []
+    # Deleting a missing file is not an error
+    storage.delete(file_ids[0])
+
+
+def test_open_missing(storage, storage_module):
+    with pytest.raises(storage_module.FileNotFound):
+        storage.open(ObjectId())
+
+
+def test_backend_must_implement_every_operation(storage_module):
+    class Incomplete(storage_module.AttachmentStorage):
+        def open(self, file_id):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_abort_leaves_nothing(storage):
+    writer = storage.new_file(filename="partial.txt")
+    writer.write(b"partial")
+    writer.abort()
+    assert not storage.exists(writer._id)
+    assert list(storage.list_files()) == []
+
+
+def test_local_abort_removes_temporary_file(local_storage):
+    writer = local_storage.new_file()
+    writer.write(b"partial")
+    writer.abort()
+    assert os.listdir(local_storage.directory) == []
+
+
+def test_local_refuses_existing_id(local_storage):
+    file_id = write(local_storage, b"first" * 10)
+    writer = local_storage.new_file(file_id=file_id)
+    writer.write(b"second")
+    with pytest.raises(FileExistsError):
+        writer.close()
+    assert read(local_storage, file_id) == b"first" * 10
+    assert sorted(os.listdir(local_storage.directory)) == [str(file_id), f"{file_id}.json"]
+
+
+def test_gridfs_abort_after_close_removes_file(gridfs_storage, db):
+    writer = gridfs_storage.new_file()
+    writer.write(b"stored")
+    writer.close()
+    writer.abort()
+    assert not gridfs_storage.exists(writer._id)
+    assert db["fs.chunks"].count_documents({"files_id": writer._id}) == 0
+
+
+def test_migrate_files(gridfs_storage, local_storage, storage_module):
+    file_ids = [write(gridfs_storage, bytes([i]) * 300, upload_date=datetime(2022, 1, 1)) for i in range(3)]
+    storage_module.copy_file(gridfs_storage, local_storage, file_ids[0])
+
+    report = storage_module.migrate_files(gridfs_storage, local_storage)
+    assert report == {"copied_files": 2, "copied_bytes": 600, "skipped_files": 1, "failed_files": 0, "deleted_files": 0}
+    for i, file_id in enumerate(file_ids):
+        migrated = local_storage.open(file_id)
+        assert migrated.read() == bytes([i]) * 300
+        assert migrated.metadata == {"sha256": "abc"}
+        assert migrated.upload_date == datetime(2022, 1, 1)
+        migrated.close()
+
+    report = storage_module.migrate_files(gridfs_storage, local_storage, delete_source=True)
+    assert report["skipped_files"] == 3
+    assert report["deleted_files"] == 3
+    assert list(gridfs_storage.list_files()) == []
+
+
+def test_migrate_to_s3(local_storage, s3_storage, storage_module):
+    file_id = write(local_storage, b"y" * 2000)
+    report = storage_module.migrate_files(local_storage, s3_storage, delete_source=True)
+    assert report["copied_files"] == 1
+    assert read(s3_storage, file_id) == b"y" * 2000
+    assert not local_storage.exists(file_id)
+
+
+def test_failed_copy_is_aborted_and_reported(gridfs_storage, s3_storage, storage_module, monkeypatch):
+    file_id = write(gridfs_storage, b"z" * 100)
+
+    def fail_upload(*args, **kwargs):
+        raise OSError("connection reset")
+
+    monkeypatch.setattr(s3_storage.client, "upload_fileobj", fail_upload)
+    report = storage_module.migrate_files(gridfs_storage, s3_storage, delete_source=True)
+    assert report["failed_files"] == 1
+    assert report["deleted_files"] == 0
+    assert not s3_storage.exists(file_id)
+    # The source is kept when the copy fails
+    assert read(gridfs_storage, file_id) == b"z" * 100